@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import dash
-from dash import dcc, html, dash_table
+from dash import dcc, html, dash_table, Patch
 from dash.dependencies import Input, Output, State
 import dash_bootstrap_components as dbc
 import geopandas as gpd
@@ -13,10 +13,29 @@ import os
 from dotenv import load_dotenv
 import unicodedata
 from sqlalchemy.exc import SQLAlchemyError
-from functools import lru_cache
 import numpy as np
 import math
 import socket
+import time
+import threading
+import multiprocessing
+import gc
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+from collections import OrderedDict
+import re
+import json
+import gzip
+import hashlib
+import pickle
+import flask
+import tempfile
+import openpyxl
+from urllib.parse import urlencode
+import shapely
+from sqlalchemy import text
+from shapely import STRtree
+from pandas.api.types import union_categoricals
 
 def is_port_in_use(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -84,196 +103,1924 @@ engine = create_engine(
     }
 )
 
-# Verificar la conexión
-with engine.connect() as conn:
-    print("Conexión exitosa a la base de datos")
+# Primero definimos las fuentes disponibles
+FUENTES_DATOS = ['UNGRD', 'DAGRAN', 'SIMMA']
+
+def normalizar_texto(texto):
+    """
+    Elimina tildes y convierte a mayúsculas
+    """
+    if pd.isna(texto):
+        return texto
+    texto_sin_tildes = ''.join(c for c in unicodedata.normalize('NFD', str(texto))
+                              if unicodedata.category(c) != 'Mn')
+    return texto_sin_tildes.upper().strip()
+
+# Archivo externo con las reglas de normalización de tipos de eventos
+RUTA_REGLAS_TIPOS = os.getenv(
+    'REGLAS_TIPOS_EVENTOS',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reglas_tipos_eventos.json')
+)
+
+# Normalizador compilado; se reemplaza completo cada vez que cambia el archivo de reglas
+NORMALIZADOR_TIPOS = {'version': None, 'modificado': None, 'patron': None, 'categorias': [], 'memo': {}}
+
+def compilar_reglas_tipos(reglas):
+    """
+    Combina las variantes de todas las categorías en una sola expresión regular.
+    Cada categoría es una alternativa anclada al inicio con un lookahead, así que
+    la primera categoría (en el orden del archivo) con alguna variante contenida gana.
+    """
+    categorias = []
+    alternativas = []
+    for regla in reglas['categorias']:
+        variantes = [str(v).upper().strip() for v in regla['variantes'] if str(v).strip()]
+        if not variantes:
+            continue
+        variantes = '|'.join(re.escape(v) for v in sorted(set(variantes), key=len, reverse=True))
+        alternativas.append(f"(?P<c{len(categorias)}>(?=.*?(?:{variantes})))")
+        categorias.append(regla['categoria'])
+    patron = re.compile('|'.join(alternativas), re.DOTALL) if alternativas else None
+    return patron, categorias
+
+def cargar_reglas_tipos(forzar=False):
+    """
+    Lee y compila el archivo de reglas si cambió desde la última lectura.
+    Devuelve True cuando se cargaron reglas nuevas
+    """
+    global NORMALIZADOR_TIPOS
+    try:
+        modificado = os.path.getmtime(RUTA_REGLAS_TIPOS)
+        if not forzar and modificado == NORMALIZADOR_TIPOS['modificado']:
+            return False
+        with open(RUTA_REGLAS_TIPOS, encoding='utf-8') as archivo:
+            reglas = json.load(archivo)
+        patron, categorias = compilar_reglas_tipos(reglas)
+    except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+        print(f"Error al cargar reglas de tipos de eventos: {str(e)}")
+        return False
+
+    NORMALIZADOR_TIPOS = {
+        'version': reglas.get('version'),
+        'modificado': modificado,
+        'patron': patron,
+        'categorias': categorias,
+        'memo': {}
+    }
+    print(f"Reglas de tipos de eventos cargadas (versión {NORMALIZADOR_TIPOS['version']}, "
+          f"{len(categorias)} categorías)")
+    return True
+
+cargar_reglas_tipos()
+
+def normalizar_tipo_evento(tipo):
+    """
+    Normaliza los tipos de eventos para asegurar consistencia entre las tres fuentes de datos.
+    El resultado de cada tipo distinto se memoriza hasta que cambian las reglas.
+    """
+    if pd.isna(tipo):
+        return "NO ESPECIFICADO"
+    
+    tipo = str(tipo).upper().strip()
+    
+    normalizador = NORMALIZADOR_TIPOS
+    memo = normalizador['memo']
+    if tipo not in memo:
+        coincidencia = normalizador['patron'].match(tipo) if normalizador['patron'] else None
+        memo[tipo] = normalizador['categorias'][int(coincidencia.lastgroup[1:])] if coincidencia else tipo
+    return memo[tipo]
+
+def mapear_valores_unicos(serie, funcion):
+    """
+    Aplica la función una sola vez por valor distinto de la serie y devuelve
+    el resultado como categórico, sin recorrer las filas en Python
+    """
+    codigos, unicos = pd.factorize(serie, use_na_sentinel=False)
+    mapeados = pd.Index([funcion(valor) for valor in unicos], dtype=object)
+    categorias = mapeados.dropna().unique()
+    codigos_mapeados = categorias.get_indexer(mapeados)
+    return pd.Categorical.from_codes(codigos_mapeados[codigos], categories=categorias)
+
+# Las fechas se guardan como días desde 1970-01-01 en int32 (DIA); este valor marca los eventos sin fecha
+DIA_SIN_FECHA = np.iinfo(np.int32).min
+
+def dias_desde_fechas(fechas):
+    """
+    Días desde 1970-01-01 (int32) de una serie datetime64; DIA_SIN_FECHA donde no hay fecha
+    """
+    dias = fechas.to_numpy().astype('datetime64[D]')
+    return np.where(np.isnat(dias), DIA_SIN_FECHA, dias.view(np.int64)).astype(np.int32)
+
+def fechas_desde_dias(dias):
+    """
+    FECHA en datetime64 a partir de DIA; solo se reconstruye para las filas que se muestran
+    """
+    dias = np.asarray(dias)
+    fechas = dias.astype('datetime64[D]')
+    fechas[dias == DIA_SIN_FECHA] = np.datetime64('NaT')
+    return fechas.astype('datetime64[ns]')
+
+def preparar_eventos(df):
+    """
+    Deja un DataFrame de eventos listo para consultar con máscaras vectorizadas:
+    MUNICIPIO, TIPO y FUENTE categóricos (códigos enteros), clave de municipio normalizada,
+    la fecha como DIA (int32) y columnas enteras de año y mes (0 cuando no hay fecha)
+    """
+    df = df.reset_index(drop=True)
+    if 'MUNICIPIO' in df.columns:
+        df['MUNICIPIO'] = df['MUNICIPIO'].astype('category')
+        df['MUNICIPIO_NORM'] = mapear_valores_unicos(df['MUNICIPIO'], normalizar_texto)
+    df['TIPO_ORIGINAL'] = df['TIPO'].astype('category')
+    df['TIPO'] = mapear_valores_unicos(df['TIPO_ORIGINAL'], normalizar_tipo_evento)
+    df['FUENTE'] = pd.Categorical(df['FUENTE'], categories=FUENTES_DATOS)
+    # El catálogo del modo SQL no tiene fechas
+    if 'FECHA' in df.columns:
+        fechas = pd.to_datetime(df.pop('FECHA'), errors='coerce')
+        df['DIA'] = dias_desde_fechas(fechas)
+        df['AÑO'] = fechas.dt.year.fillna(0).astype('int16')
+        df['MES'] = fechas.dt.month.fillna(0).astype('int8')
+    return df
+
+def memoria_eventos(*dfs):
+    """
+    Memoria de las tablas de eventos en MB por millón de eventos
+    """
+    filas = sum(len(df) for df in dfs)
+    if not filas:
+        return 0.0
+    return sum(int(df.memory_usage(deep=True, index=False).sum()) for df in dfs) / filas * 1e6 / 2**20
+
+def anexar_eventos(df, nuevos):
+    """
+    Agrega eventos ya preparados al final de df. Las filas existentes conservan su
+    posición y las columnas categóricas siguen siendo categóricas (se unen las categorías).
+    """
+    combinados = pd.concat([df, nuevos], ignore_index=True)
+    for columna in df.select_dtypes('category').columns:
+        if combinados[columna].dtype != df[columna].dtype:
+            try:
+                combinados[columna] = union_categoricals([df[columna], nuevos[columna]])
+            except TypeError:
+                combinados[columna] = combinados[columna].astype('category')
+    return combinados
+
+# Tamaño máximo de los n-gramas del índice de municipios
+NGRAMA_MAXIMO = 3
+
+def nombre_municipio(clave):
+    """
+    Devuelve solo el municipio de una clave con formato "DEPARTAMENTO / MUNICIPIO"
+    """
+    return clave.split('/')[1].strip() if '/' in clave else clave
+
+def extraer_ngramas(texto, n_maximo=NGRAMA_MAXIMO):
+    """
+    Devuelve todas las subcadenas del texto de longitud 1 hasta n_maximo
+    """
+    return {texto[i:i + n] for n in range(1, n_maximo + 1) for i in range(len(texto) - n + 1)}
+
+def construir_tabla_busqueda(claves):
+    """
+    Precalcula las estructuras para buscar claves normalizadas por nombre exacto,
+    por prefijo (lista ordenada) y por subcadena (tabla de n-gramas)
+    """
+    tabla_ngramas = {}
+    for clave in claves:
+        for ngrama in extraer_ngramas(clave):
+            tabla_ngramas.setdefault(ngrama, set()).add(clave)
+
+    # Cada clave se puede encontrar por su texto completo y por su parte de municipio
+    nombres = sorted({(texto, clave) for clave in claves for texto in (clave, nombre_municipio(clave))})
+    por_nombre = {}
+    for texto, clave in nombres:
+        por_nombre.setdefault(texto, []).append(clave)
+
+    return {
+        'ngramas': tabla_ngramas,
+        'nombres': nombres,
+        'textos': [texto for texto, _ in nombres],
+        'por_nombre': por_nombre
+    }
+
+def buscar_claves(tabla, consulta, modo='subcadena'):
+    """
+    Busca las claves que coinciden con la consulta normalizada.
+    Modos: 'exacto', 'prefijo' o 'subcadena'. El costo depende de las coincidencias,
+    no del número de eventos.
+    """
+    if not consulta:
+        return []
+
+    if modo == 'exacto':
+        return sorted(set(tabla['por_nombre'].get(consulta, [])))
+
+    if modo == 'prefijo':
+        claves = set()
+        posicion = bisect.bisect_left(tabla['textos'], consulta)
+        while posicion < len(tabla['nombres']) and tabla['textos'][posicion].startswith(consulta):
+            claves.add(tabla['nombres'][posicion][1])
+            posicion += 1
+        return sorted(claves)
+
+    # Las consultas cortas son un n-grama completo: la tabla ya tiene la respuesta
+    if len(consulta) <= NGRAMA_MAXIMO:
+        return sorted(tabla['ngramas'].get(consulta, ()))
+
+    conjuntos = sorted(
+        (tabla['ngramas'].get(consulta[i:i + NGRAMA_MAXIMO], set())
+         for i in range(len(consulta) - NGRAMA_MAXIMO + 1)),
+        key=len
+    )
+    candidatas = conjuntos[0].intersection(*conjuntos[1:])
+    return sorted(clave for clave in candidatas if consulta in clave)
+
+def nombres_municipios(*series):
+    """
+    Nombre para mostrar (sin departamento) de cada municipio de las series, por su nombre normalizado.
+    Se recorre una vez cada valor distinto, no cada fila.
+    """
+    nombres = {}
+    for serie in series:
+        for valor in serie.dropna().unique():
+            nombre = nombre_municipio(str(valor)).strip()
+            nombres.setdefault(normalizar_texto(nombre), nombre)
+    return nombres
+
+def construir_indice_municipios(df_eventos_municipio, gdf_eventos_shp, gdf_municipios):
+    """
+    Construye el índice invertido de municipios: clave normalizada -> posiciones
+    de fila por fuente en df_eventos_municipio y -> filas de polígono en gdf_municipios.
+    Los puntos SIMMA se indexan por la fila del polígono que los contiene.
+    Incluye los nombres de municipio (de eventos y de polígonos) para el autocompletado.
+    """
+    eventos = df_eventos_municipio.groupby(['MUNICIPIO_NORM', 'FUENTE'], observed=True).indices
+    poligonos = gdf_municipios['MpNombre'].map(normalizar_texto).reset_index(drop=True)
+    poligonos = poligonos.groupby(poligonos).indices
+    codigos_simma = gdf_eventos_shp['COD_MUNICIPIO'].reset_index(drop=True)
+    simma = codigos_simma.groupby(codigos_simma).indices
+    simma.pop(-1, None)
+    nombres = nombres_municipios(df_eventos_municipio['MUNICIPIO'], gdf_municipios['MpNombre'])
+    return armar_indice_municipios(eventos, poligonos, simma, nombres)
+
+def armar_indice_municipios(eventos, poligonos, simma, nombres):
+    """
+    Índice de municipios a partir de sus posiciones por grupo y sus nombres, con las tablas
+    de búsqueda de sus claves (ver construir_indice_municipios y abrir_indice_almacen)
+    """
+    return {
+        'eventos': eventos,
+        'poligonos': poligonos,
+        'simma': simma,
+        'nombres': nombres,
+        'tabla_eventos': construir_tabla_busqueda({clave for clave, _ in eventos}),
+        'tabla_poligonos': construir_tabla_busqueda(poligonos.keys()),
+        'tabla_nombres': construir_tabla_busqueda(nombres.keys())
+    }
+
+def actualizar_indice_municipios(indice, agregados):
+    """
+    Agrega al índice filas nuevas que quedaron al final de las tablas sin recorrer las existentes.
+    agregados: lista de (fuente, filas nuevas preparadas, posición de la primera fila nueva)
+    """
+    eventos = dict(indice['eventos'])
+    simma = dict(indice['simma'])
+    nombres = dict(indice['nombres'])
+    for fuente, filas, desplazamiento in agregados:
+        if fuente == 'SIMMA':
+            codigos = filas['COD_MUNICIPIO'].reset_index(drop=True)
+            grupos, destino = codigos.groupby(codigos).indices, simma
+            grupos.pop(-1, None)
+        else:
+            grupos, destino = filas.groupby(['MUNICIPIO_NORM', 'FUENTE'], observed=True).indices, eventos
+            for clave, nombre in nombres_municipios(filas['MUNICIPIO']).items():
+                nombres.setdefault(clave, nombre)
+        for clave, posiciones in grupos.items():
+            posiciones = posiciones + desplazamiento
+            destino[clave] = np.concatenate([destino[clave], posiciones]) if clave in destino else posiciones
+
+    # Las tablas de búsqueda solo se reconstruyen si aparecieron municipios nuevos
+    claves = {clave for clave, _ in eventos}
+    tabla_eventos = indice['tabla_eventos']
+    if len(claves) != len({clave for clave, _ in indice['eventos']}):
+        tabla_eventos = construir_tabla_busqueda(claves)
+    tabla_nombres = indice['tabla_nombres']
+    if len(nombres) != len(indice['nombres']):
+        tabla_nombres = construir_tabla_busqueda(nombres.keys())
+
+    return dict(indice, eventos=eventos, simma=simma, nombres=nombres,
+                tabla_eventos=tabla_eventos, tabla_nombres=tabla_nombres)
+
+# Cantidad máxima de sugerencias del buscador de municipios
+MAXIMO_SUGERENCIAS = 20
+
+def sugerir_municipios(indice, consulta, limite=MAXIMO_SUGERENCIAS):
+    """
+    Nombres de municipio para el autocompletado: primero los que empiezan por la consulta
+    y luego los que la contienen. El costo depende de las coincidencias, no de los eventos.
+    """
+    consulta_norm = normalizar_texto(consulta)
+    claves = buscar_claves(indice['tabla_nombres'], consulta_norm, 'prefijo')
+    if len(claves) < limite:
+        vistas = set(claves)
+        claves += [clave for clave in buscar_claves(indice['tabla_nombres'], consulta_norm) if clave not in vistas]
+    return [indice['nombres'][clave] for clave in claves[:limite]]
+
+def filas_eventos_municipio(indice, municipio_norm, fuentes, modo='subcadena'):
+    """
+    Devuelve, en orden, las posiciones de df_eventos_municipio del municipio para las fuentes dadas
+    """
+    filas = [
+        indice['eventos'][(clave, fuente)]
+        for clave in buscar_claves(indice['tabla_eventos'], municipio_norm, modo)
+        for fuente in fuentes
+        if (clave, fuente) in indice['eventos']
+    ]
+    if not filas:
+        return np.empty(0, dtype=np.intp)
+    return np.sort(np.concatenate(filas))
+
+def filas_simma_municipio(indice, municipio_norm, modo='subcadena'):
+    """
+    Devuelve las posiciones de gdf_eventos_shp asignadas al primer polígono que coincide con el municipio
+    """
+    filas_poligono = poligonos_municipio(indice, municipio_norm, modo)
+    if not len(filas_poligono):
+        return np.empty(0, dtype=np.intp)
+    return indice['simma'].get(filas_poligono[0], np.empty(0, dtype=np.intp))
+
+def asignar_municipios_simma(gdf_eventos_shp, gdf_municipios):
+    """
+    Asigna cada punto SIMMA a una fila de gdf_municipios con una consulta masiva
+    sobre un STRtree. Si un punto queda dentro de varios polígonos, o sobre un límite
+    compartido, se asigna al de menor fila; si no cae en ninguno queda con -1.
+    """
+    arbol = STRtree(gdf_municipios.geometry.values)
+    puntos = gdf_eventos_shp.geometry.values
+    sin_asignar = np.iinfo(np.int32).max
+    codigos = np.full(len(puntos), sin_asignar, dtype=np.int32)
+
+    idx_puntos, idx_poligonos = arbol.query(puntos, predicate='within')
+    np.minimum.at(codigos, idx_puntos, idx_poligonos.astype(np.int32))
+    en_varios = int((np.bincount(idx_puntos, minlength=len(puntos)) > 1).sum())
+
+    # Los puntos sobre un límite no están "dentro" de ningún polígono pero sí lo tocan
+    pendientes = np.flatnonzero(codigos == sin_asignar)
+    idx_puntos, idx_poligonos = arbol.query(puntos[pendientes], predicate='intersects')
+    np.minimum.at(codigos, pendientes[idx_puntos], idx_poligonos.astype(np.int32))
+    en_limite = len(np.unique(idx_puntos))
+
+    codigos[codigos == sin_asignar] = -1
+    fuera = int((codigos == -1).sum())
+    print(f"Puntos SIMMA asignados a municipios: {len(puntos) - fuera} de {len(puntos)} "
+          f"({en_limite} sobre límites, {en_varios} dentro de varios polígonos, {fuera} fuera de todo municipio)")
+    return codigos
+
+def poligonos_municipio(indice, municipio_norm, modo='subcadena'):
+    """
+    Devuelve, en orden, las filas de gdf_municipios que coinciden con el municipio
+    """
+    filas = [indice['poligonos'][clave] for clave in buscar_claves(indice['tabla_poligonos'], municipio_norm, modo)]
+    if not filas:
+        return np.empty(0, dtype=np.intp)
+    return np.sort(np.concatenate(filas))
+
+# Eventos que se cuentan por bloque al construir el cubo
+TAMAÑO_BLOQUE_CUBO = 1_000_000
+
+def grupos_cubo(indice):
+    """
+    Grupos del cubo a partir del índice: (municipio, fuente) -> grupo, polígono SIMMA -> grupo,
+    y la fuente de cada grupo
+    """
+    grupos_eventos = {clave: grupo for grupo, clave in enumerate(sorted(indice['eventos']))}
+    grupos_simma = {fila: grupo for grupo, fila in enumerate(sorted(indice['simma']), start=len(grupos_eventos))}
+    fuente_grupo = np.array(
+        [FUENTES_DATOS.index(fuente) for _, fuente in sorted(indice['eventos'])]
+        + [FUENTES_DATOS.index('SIMMA')] * len(grupos_simma), dtype=np.int8)
+    return grupos_eventos, grupos_simma, fuente_grupo
+
+def contar_celdas(indices, forma):
+    """
+    Cubo de conteos de las celdas dadas (índices planos), en el entero sin signo más chico que
+    alcanza. Se cuentan bloque por bloque solo las celdas no vacías, y el cubo se reserva una
+    sola vez con su tipo final: nunca hay una copia en int64 del tamaño del cubo.
+    """
+    celdas, cantidades = [], []
+    for parte in indices:
+        for inicio in range(0, len(parte), TAMAÑO_BLOQUE_CUBO):
+            celdas_bloque, cantidades_bloque = np.unique(parte[inicio:inicio + TAMAÑO_BLOQUE_CUBO], return_counts=True)
+            celdas.append(celdas_bloque)
+            cantidades.append(cantidades_bloque)
+    celdas, posiciones = np.unique(np.concatenate(celdas or [np.empty(0, dtype=np.int64)]), return_inverse=True)
+    totales = np.zeros(len(celdas), dtype=np.int64)
+    np.add.at(totales, posiciones, np.concatenate(cantidades or [np.empty(0, dtype=np.int64)]))
+    conteos = np.zeros(math.prod(forma), dtype=np.min_scalar_type(totales.max(initial=0)))
+    conteos[celdas] = totales
+    return conteos.reshape(forma)
+
+def construir_cubo_eventos(df_eventos_municipio, gdf_eventos_shp, indice):
+    """
+    Cubo denso de conteos grupo × tipo × año × mes, calculado una vez con códigos enteros
+    (ver contar_celdas). Cada grupo es un (municipio, fuente) del índice o, para SIMMA, un polígono,
+    así el cubo no reserva celdas para fuentes que un municipio nunca tiene.
+    Junto a él se guardan los conteos nacionales fuente × tipo × año × mes, que incluyen
+    también los eventos sin municipio reconocido.
+    Los tipos van en orden alfabético y los años solo incluyen los presentes (0 sin fecha),
+    de modo que recorrer las celdas no vacías da el mismo orden que un groupby.
+    """
+    grupos_eventos, grupos_simma, fuente_grupo = grupos_cubo(indice)
+
+    tipos = pd.Index(sorted(set(df_eventos_municipio['TIPO'].cat.categories)
+                            | set(gdf_eventos_shp['TIPO'].cat.categories)), dtype=object)
+    años = np.union1d(df_eventos_municipio['AÑO'].unique(), gdf_eventos_shp['AÑO'].unique()).astype(np.int16)
+    forma = (len(fuente_grupo), len(tipos), len(años), 13)
+    forma_nacional = (len(FUENTES_DATOS), len(tipos), len(años), 13)
+
+    indices, indices_nacionales = [], []
+    for df, grupos, posiciones in ((df_eventos_municipio, grupos_eventos, indice['eventos']),
+                                   (gdf_eventos_shp, grupos_simma, indice['simma'])):
+        grupo = np.full(len(df), -1, dtype=np.int64)
+        for clave, codigo in grupos.items():
+            grupo[posiciones[clave]] = codigo
+        fuente = pd.Index(FUENTES_DATOS).get_indexer(df['FUENTE'].cat.categories)[df['FUENTE'].cat.codes.to_numpy()]
+        tipo = tipos.get_indexer(df['TIPO'].cat.categories)[df['TIPO'].cat.codes.to_numpy()]
+        año = np.searchsorted(años, df['AÑO'].to_numpy())
+        mes = df['MES'].to_numpy()
+        validas = (fuente >= 0) & (tipo >= 0)
+        indices_nacionales.append(np.ravel_multi_index(
+            (fuente[validas], tipo[validas], año[validas], mes[validas]), forma_nacional))
+        validas &= grupo >= 0
+        indices.append(np.ravel_multi_index((grupo[validas], tipo[validas], año[validas], mes[validas]), forma))
+
+    nacional = np.bincount(np.concatenate(indices_nacionales),
+                           minlength=math.prod(forma_nacional)).reshape(forma_nacional)
+    return {
+        'conteos': contar_celdas(indices, forma),
+        'nacional': nacional,
+        'fuente_grupo': fuente_grupo,
+        'grupos_eventos': grupos_eventos,
+        'grupos_simma': grupos_simma,
+        'tipos': tipos,
+        'años': años
+    }
+
+def tipos_cubo(cubo, tipos_seleccionados):
+    """
+    Posiciones, en orden, de los tipos seleccionados en el eje de tipos del cubo ('todos' o ninguno no filtran)
+    """
+    if tipos_seleccionados and 'todos' not in tipos_seleccionados:
+        tipos = np.sort(cubo['tipos'].get_indexer(pd.unique(pd.Series(tipos_seleccionados))))
+        return tipos[tipos >= 0]
+    return np.arange(len(cubo['tipos']))
+
+def tabla_conteos_cubo(cubo, rebanadas, tipos):
+    """
+    Tabla de conteos (como la de agregar_eventos) con las celdas no vacías de las rebanadas
+    del cubo: fuente -> conteos tipo × año × mes de los tipos dados
+    """
+    fuentes = sorted(rebanadas)
+    if not fuentes:
+        return pd.DataFrame(columns=COLUMNAS_AGREGADOS + ['CANTIDAD'])
+    conteos = np.stack([rebanadas[fuente] for fuente in fuentes])
+    fuente, tipo, año, mes = np.nonzero(conteos)
+    if not len(fuente):
+        return pd.DataFrame(columns=COLUMNAS_AGREGADOS + ['CANTIDAD'])
+    return pd.DataFrame({
+        'FUENTE': np.array(fuentes, dtype=object)[fuente],
+        'TIPO': cubo['tipos'].to_numpy()[tipos[tipo]],
+        'AÑO': cubo['años'][año],
+        'MES': mes.astype(np.int8),
+        'CANTIDAD': conteos[fuente, tipo, año, mes]
+    })
+
+def conteos_cubo(cubo, grupos, tipos_seleccionados):
+    """
+    Conteos de los grupos dados: para cada fuente se suma la rebanada de sus grupos
+    """
+    grupos = np.asarray(grupos, dtype=np.intp)
+    tipos = tipos_cubo(cubo, tipos_seleccionados)
+    fuente_grupo = cubo['fuente_grupo'][grupos]
+    rebanadas = {
+        FUENTES_DATOS[codigo]: cubo['conteos'][grupos[fuente_grupo == codigo]][:, tipos].sum(axis=0, dtype=np.int64)
+        for codigo in np.unique(fuente_grupo)
+    }
+    return tabla_conteos_cubo(cubo, rebanadas, tipos)
+
+def conteos_nacionales_cubo(cubo, fuentes, tipos_seleccionados):
+    """
+    Conteos de todo el país para las fuentes dadas, leídos de los totales precalculados del cubo
+    """
+    tipos = tipos_cubo(cubo, tipos_seleccionados)
+    rebanadas = {fuente: cubo['nacional'][FUENTES_DATOS.index(fuente)][tipos]
+                 for fuente in set(fuentes) if fuente in FUENTES_DATOS}
+    return tabla_conteos_cubo(cubo, rebanadas, tipos)
+
+def grupos_cubo_municipio(cubo, indice, municipio_norm, fuentes, modo='subcadena'):
+    """
+    Grupos del cubo del municipio para las fuentes dadas, resueltos con el mismo índice
+    que las filas de la tabla detallada
+    """
+    grupos = [
+        cubo['grupos_eventos'][(clave, fuente)]
+        for clave in buscar_claves(indice['tabla_eventos'], municipio_norm, modo)
+        for fuente in fuentes
+        if (clave, fuente) in cubo['grupos_eventos']
+    ]
+    if 'SIMMA' in fuentes:
+        filas_poligono = poligonos_municipio(indice, municipio_norm, modo)
+        if len(filas_poligono) and filas_poligono[0] in cubo['grupos_simma']:
+            grupos.append(cubo['grupos_simma'][filas_poligono[0]])
+    return grupos
+
+# Snapshot local de los datos procesados para no volver a descargarlos en cada arranque
+CARPETA_CACHE = os.getenv('CARPETA_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+# Cambiar este número cuando cambie la estructura de los datos guardados en el snapshot
+VERSION_SNAPSHOT = 3
+ARCHIVOS_SNAPSHOT = {
+    'municipios': 'municipios.parquet',
+    'eventos': 'eventos.parquet',
+    'simma': 'eventos_simma.parquet'
+}
+
+try:
+    import pyarrow as pa  # necesario para leer y escribir parquet y el almacén compartido
+    SNAPSHOT_DISPONIBLE = True
+except ImportError:
+    SNAPSHOT_DISPONIBLE = False
+
+# Tablas de eventos y la fuente que representan
+TABLAS_EVENTOS = {
+    'eventos_ungrd': 'UNGRD',
+    'eventos_dagran': 'DAGRAN',
+    'eventos_simma': 'SIMMA'
+}
+
+# Columna de clave primaria por tabla. Identifica cada evento en la tabla detallada: las posiciones
+# en memoria cambian si una recarga trae las filas en otro orden, y el ctid cambia con UPDATE o VACUUM FULL
+COLUMNAS_ID = {
+    'eventos_ungrd': os.getenv('ID_UNGRD', 'id'),
+    'eventos_dagran': os.getenv('ID_DAGRAN', 'id'),
+    'eventos_simma': os.getenv('ID_SIMMA', 'id')
+}
+
+# Columna de marca de agua por tabla: un id o una fecha de ingreso que solo crece, con índice.
+# Por defecto es la clave primaria (serial o identity). Al actualizar se traen de la base solo las
+# filas con un valor mayor al último visto; sin columna (variable vacía), la tabla se recarga
+# completa cuando cambia su conteo. La fecha del evento no sirve: los eventos se registran con
+# fechas pasadas, varios en el mismo día y algunos sin fecha.
+COLUMNAS_MARCA_AGUA = {
+    'eventos_ungrd': os.getenv('MARCA_AGUA_UNGRD', COLUMNAS_ID['eventos_ungrd']) or None,
+    'eventos_dagran': os.getenv('MARCA_AGUA_DAGRAN', COLUMNAS_ID['eventos_dagran']) or None,
+    'eventos_simma': os.getenv('MARCA_AGUA_SIMMA', COLUMNAS_ID['eventos_simma']) or None
+}
+
+# Modo de consulta de eventos de UNGRD y DAGRAN:
+# - 'memoria': todas las filas se cargan en memoria y los filtros y agregados se calculan en pandas
+# - 'sql': en memoria queda solo un catálogo (municipio, tipo, fuente y cantidad de eventos);
+#   los filtros y agregados de cada consulta se resuelven en PostgreSQL
+MODO_CONSULTA = os.getenv('MODO_CONSULTA', 'memoria').lower()
+
+# Los gráficos se calculan sobre conteos de eventos por estas columnas (año y mes 0 sin fecha);
+# en ambos modos de consulta se construye la misma tabla de conteos
+COLUMNAS_AGREGADOS = ['FUENTE', 'TIPO', 'AÑO', 'MES']
+
+# Columnas de la tabla detallada que se guardan con el resultado filtrado en modo memoria (en modo SQL
+# se guarda la consulta, ver consultar_eventos_sql). ID identifica el evento para traer los comentarios
+# solo al mostrarlo; FILA es su posición en memoria al calcular el resultado, que se usa si todavía
+# corresponde al mismo ID
+COLUMNAS_DETALLE = ['FUENTE', 'TIPO', 'FECHA', 'ID', 'FILA']
+COLUMNAS_TABLA_DETALLADA = ['FUENTE', 'TIPO', 'FECHA', 'COMENTARIOS']
+TAMAÑO_PAGINA_DETALLE = 10
+
+def agregar_eventos(df):
+    """
+    Cuenta las filas de eventos por fuente, tipo, año y mes
+    """
+    if df.empty:
+        return pd.DataFrame(columns=COLUMNAS_AGREGADOS + ['CANTIDAD'])
+    return df.groupby(COLUMNAS_AGREGADOS, dropna=False).size().reset_index(name='CANTIDAD')
+
+def consultar_huella_fuentes():
+    """
+    Huella de las tablas fuente (conteos y marca de agua máxima). Si no cambia, el snapshot
+    local sigue vigente. El máximo usa el índice de la marca de agua (la clave primaria, por
+    defecto), pero COUNT(*) recorre la tabla o su clave primaria: se consulta al arrancar y,
+    en las actualizaciones, solo si consultar_señal_fuentes indica cambios.
+    """
+    columnas = ['(SELECT COUNT(*) FROM municipios) AS municipios']
+    for tabla, columna in COLUMNAS_MARCA_AGUA.items():
+        columnas.append(f'(SELECT COUNT(*) FROM {tabla}) AS {tabla}')
+        if columna:
+            columnas.append(f'(SELECT MAX("{columna}") FROM {tabla}) AS marca_{tabla}')
+    query = "SELECT " + ",\n       ".join(columnas)
+    with engine.connect().execution_options(timeout=10) as conn:
+        fila = conn.execute(text(query)).mappings().one()
+    return {columna: str(valor) for columna, valor in fila.items()}
+
+def consultar_señal_fuentes():
+    """
+    Señal barata de cambios en las tablas fuente: los contadores de filas insertadas, actualizadas,
+    borradas y vivas de pg_stat_user_tables, que PostgreSQL mantiene sin recorrer las tablas.
+    Llegan con hasta un minuto de retraso y se reinician con las estadísticas, así que solo
+    indican cuándo vale la pena consultar la huella. None si las estadísticas están desactivadas.
+    """
+    query_señal = """
+    SELECT relid::regclass::text AS tabla, n_tup_ins, n_tup_upd, n_tup_del, n_live_tup
+    FROM pg_stat_user_tables
+    WHERE relid = ANY(CAST(:tablas AS regclass[]))
+    """
+    with engine.connect().execution_options(timeout=10) as conn:
+        if conn.execute(text("SELECT current_setting('track_counts')")).scalar() != 'on':
+            return None
+        filas = conn.execute(text(query_señal), {'tablas': ['municipios', *TABLAS_EVENTOS]}).all()
+    return {tabla: list(contadores) for tabla, *contadores in filas}
+
+def huella_sin_fuentes(huella, fallidas):
+    """
+    Huella con las tablas que no se pudieron cargar en None: no coincide con la de la base,
+    así la próxima actualización las vuelve a cargar
+    """
+    if huella is None or not fallidas:
+        return huella
+    return {clave: None if clave.removeprefix('marca_') in fallidas else valor for clave, valor in huella.items()}
+
+def huella_completa(huella):
+    """
+    True si la huella corresponde a todas las tablas (ninguna fuente quedó sin cargar)
+    """
+    return huella is not None and None not in huella.values()
+
+def leer_snapshot(huella):
+    """
+    Lee el snapshot local (mapeado en memoria) si existe y corresponde a la huella.
+    Con huella None (base de datos no disponible) se usa el snapshot que haya.
+    Devuelve los datos y la huella con la que se guardaron.
+    """
+    ruta_metadatos = os.path.join(CARPETA_CACHE, 'snapshot.json')
+    if not SNAPSHOT_DISPONIBLE or not os.path.exists(ruta_metadatos):
+        return None
+    try:
+        with open(ruta_metadatos, encoding='utf-8') as archivo:
+            metadatos = json.load(archivo)
+        if metadatos.get('version') != VERSION_SNAPSHOT or metadatos.get('modo', 'memoria') != MODO_CONSULTA:
+            return None
+        if huella is not None and metadatos.get('huella') != huella:
+            print("El snapshot local está desactualizado; se recargan los datos desde la base de datos")
+            return None
+
+        inicio = time.perf_counter()
+        rutas = {nombre: os.path.join(CARPETA_CACHE, archivo) for nombre, archivo in ARCHIVOS_SNAPSHOT.items()}
+        gdf_municipios = gpd.read_parquet(rutas['municipios'], memory_map=True)
+        df_eventos_municipio = pd.read_parquet(rutas['eventos'], memory_map=True)
+        gdf_eventos_shp = gpd.read_parquet(rutas['simma'], memory_map=True)
+        print(f"Datos cargados desde el snapshot local en {time.perf_counter() - inicio:.2f} s")
+    except (OSError, ValueError) as e:
+        print(f"Error al leer el snapshot local: {str(e)}")
+        return None
+
+    # TIPO depende de las reglas vigentes, que pueden haber cambiado desde que se guardó
+    for df in (df_eventos_municipio, gdf_eventos_shp):
+        df['TIPO'] = mapear_valores_unicos(df['TIPO_ORIGINAL'], normalizar_tipo_evento)
+    return (gdf_municipios, df_eventos_municipio, gdf_eventos_shp), metadatos['huella']
+
+def guardar_snapshot(datos, huella):
+    """
+    Guarda los datos procesados en parquet. Los metadatos se escriben al final,
+    así un snapshot incompleto nunca se toma como válido. Se reescribe completo en cada
+    actualización, aunque solo hayan llegado filas nuevas.
+    """
+    if not SNAPSHOT_DISPONIBLE or not huella_completa(huella):
+        return
+    ruta_metadatos = os.path.join(CARPETA_CACHE, 'snapshot.json')
+    try:
+        os.makedirs(CARPETA_CACHE, exist_ok=True)
+        if os.path.exists(ruta_metadatos):
+            os.remove(ruta_metadatos)
+        for df, archivo in zip(datos, ARCHIVOS_SNAPSHOT.values()):
+            ruta = os.path.join(CARPETA_CACHE, archivo)
+            df.to_parquet(ruta + '.tmp')
+            os.replace(ruta + '.tmp', ruta)
+        with open(ruta_metadatos, 'w', encoding='utf-8') as archivo:
+            json.dump({'version': VERSION_SNAPSHOT, 'modo': MODO_CONSULTA, 'huella': huella}, archivo)
+    except (OSError, ValueError) as e:
+        print(f"Error al guardar el snapshot local: {str(e)}")
+
+# Modificar la función cargar_datos
+def cargar_datos():
+    """
+    Carga los datos desde el snapshot local si sigue vigente; si no, desde PostgreSQL.
+    Devuelve los datos y la huella de las tablas a la que corresponden (en None las que fallaron).
+    """
+    try:
+        huella = consultar_huella_fuentes()
+    except SQLAlchemyError as e:
+        print(f"No se pudo verificar la frescura de los datos: {str(e)}")
+        huella = None
+
+    snapshot = leer_snapshot(huella)
+    if snapshot is not None:
+        return snapshot
+
+    datos, fallidas = cargar_datos_bd()
+    # Un snapshot con fuentes incompletas se volvería a usar en el próximo arranque
+    # (guardar_snapshot no guarda con una huella incompleta)
+    huella = huella_sin_fuentes(huella, fallidas)
+    guardar_snapshot(datos, huella)
+    return datos, huella
+
+# Almacén compartido (modo producción): las tablas se guardan en archivos Arrow IPC sin comprimir
+# que todos los procesos mapean en memoria de solo lectura. Las columnas son vistas sin copia de
+# esos archivos: el sistema operativo comparte sus páginas entre procesos y, como no hay objetos
+# de Python por fila, el conteo de referencias no las ensucia. Cada versión va en archivos nuevos
+# y el puntero almacen.json se reemplaza en un solo paso. El cubo de eventos y las posiciones del
+# índice de municipios van en archivos .npy, que los procesos de trabajo también mapean en lugar
+# de reconstruirlos.
+CARPETA_ALMACEN = os.path.join(CARPETA_CACHE, 'almacen')
+TABLAS_ALMACEN = ['municipios', 'eventos', 'simma']
+# Tipo de texto por defecto de pandas; desde pandas 3 está respaldado por Arrow y se puede usar sin copia
+TEXTO_ARROW = pd.Series([''], dtype=str).dtype
+TEXTO_ARROW = TEXTO_ARROW if getattr(TEXTO_ARROW, 'storage', None) == 'pyarrow' else None
+
+def tabla_almacen(df):
+    """
+    Convierte un DataFrame en una tabla Arrow que se puede leer sin copias: los categóricos
+    como códigos enteros (categorías en los metadatos), las fechas como enteros de nanosegundos,
+    la geometría como WKB y el texto como cadenas Arrow
+    """
+    columnas, campos = [], []
+    for nombre in df.columns:
+        serie = df[nombre]
+        metadatos = {}
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            valores = pa.array(serie.cat.codes.to_numpy())
+            metadatos['categorias'] = json.dumps(serie.cat.categories.tolist())
+        elif isinstance(serie.dtype, gpd.array.GeometryDtype):
+            valores = pa.array(shapely.to_wkb(serie.values), type=pa.binary())
+            metadatos['crs'] = serie.crs.to_json() if serie.crs else ''
+        elif serie.dtype.kind == 'M':
+            valores = pa.array(serie.to_numpy(dtype='datetime64[ns]').view(np.int64))
+            metadatos['fecha'] = ''
+        elif serie.dtype.kind in 'iufb':
+            valores = pa.array(serie.to_numpy())
+        else:
+            valores = pa.array(serie, type=pa.large_string(), from_pandas=True)
+        columnas.append(valores)
+        campos.append(pa.field(nombre, valores.type, metadata=metadatos or None))
+    return pa.Table.from_arrays(columnas, schema=pa.schema(campos))
+
+def marco_almacen(tabla):
+    """
+    Convierte una tabla del almacén en DataFrame (o GeoDataFrame) cuyas columnas numéricas,
+    categóricas y de fecha son vistas de los buffers mapeados. Solo la geometría se decodifica.
+    """
+    columnas, geometria = {}, None
+    for campo, columna in zip(tabla.schema, tabla.columns):
+        valores = columna.chunk(0) if columna.num_chunks == 1 else columna.combine_chunks()
+        metadatos = campo.metadata or {}
+        if b'categorias' in metadatos:
+            columnas[campo.name] = pd.Categorical.from_codes(
+                valores.to_numpy(), categories=json.loads(metadatos[b'categorias']), validate=False)
+        elif b'crs' in metadatos:
+            geometria = (campo.name, metadatos[b'crs'].decode('utf-8') or None)
+            columnas[campo.name] = shapely.from_wkb(valores.to_numpy(zero_copy_only=False))
+        elif b'fecha' in metadatos:
+            columnas[campo.name] = valores.to_numpy().view('datetime64[ns]')
+        elif pa.types.is_large_string(valores.type):
+            columnas[campo.name] = (pd.arrays.ArrowStringArray(valores, dtype=TEXTO_ARROW) if TEXTO_ARROW is not None
+                                    else pd.arrays.ArrowExtensionArray(valores))
+        else:
+            columnas[campo.name] = valores.to_numpy()
+    df = pd.DataFrame(columnas, copy=False)
+    if geometria is not None:
+        df = gpd.GeoDataFrame(df, geometry=geometria[0], crs=geometria[1])
+    return df
+
+def leer_puntero_almacen():
+    """
+    Metadatos de la versión vigente del almacén (versión, huella, reglas de tipos y archivos), o None
+    """
+    try:
+        with open(os.path.join(CARPETA_ALMACEN, 'almacen.json'), encoding='utf-8') as archivo:
+            return json.load(archivo)
+    except (OSError, ValueError):
+        return None
+
+def abrir_archivo_almacen(archivo):
+    """
+    Mapea en memoria, de solo lectura, un archivo del almacén
+    """
+    fuente = pa.memory_map(os.path.join(CARPETA_ALMACEN, archivo), 'r')
+    return marco_almacen(pa.ipc.open_file(fuente).read_all())
+
+def escribir_archivo_almacen(df, archivo):
+    """
+    Escribe df en un archivo del almacén (Arrow IPC sin comprimir, para poder mapearlo)
+    """
+    tabla = tabla_almacen(df)
+    with pa.OSFile(os.path.join(CARPETA_ALMACEN, archivo), 'wb') as destino:
+        with pa.ipc.new_file(destino, tabla.schema) as escritor:
+            escritor.write_table(tabla)
+
+def limpiar_almacen(conservar):
+    """
+    Borra los archivos del almacén que no están en conservar
+    """
+    for entrada in os.scandir(CARPETA_ALMACEN):
+        if entrada.name.endswith(('.arrow', '.npy')) and entrada.name not in conservar:
+            try:
+                os.remove(entrada.path)
+            except OSError:
+                pass  # En Windows no se puede borrar un archivo que otro proceso tiene mapeado
+
+def abrir_tabla_almacen(puntero, nombre):
+    """
+    Mapea en memoria, de solo lectura, una tabla de la versión del puntero
+    """
+    df = abrir_archivo_almacen(puntero['archivos'][nombre])
+    # TIPO depende de las reglas vigentes en este proceso, que pueden ser otras que al guardar
+    if 'TIPO_ORIGINAL' in df.columns and puntero['reglas'] != [NORMALIZADOR_TIPOS['version'], NORMALIZADOR_TIPOS['modificado']]:
+        df['TIPO'] = mapear_valores_unicos(df['TIPO_ORIGINAL'], normalizar_tipo_evento)
+    return df
+
+def guardar_almacen(datos, archivos_comentarios, huella, version, cubo=None, indice=None):
+    """
+    Escribe una versión del almacén en archivos nuevos y después cambia el puntero con
+    os.replace, así un proceso nunca mapea una versión a medio escribir. Los comentarios ya
+    están en sus propios archivos (ver separar_comentarios); el puntero solo los referencia.
+    Se conservan los archivos de la versión anterior por si algún proceso la está abriendo;
+    los demás se borran.
+    """
+    try:
+        os.makedirs(CARPETA_ALMACEN, exist_ok=True)
+        anterior = leer_puntero_almacen()
+        archivos = {}
+        for nombre, df in zip(TABLAS_ALMACEN, datos):
+            # Los puntos SIMMA solo se usan al asignarlos a municipios, en el proceso principal
+            if nombre == 'simma':
+                df = pd.DataFrame(df.drop(columns='geometry', errors='ignore'))
+            archivos[nombre] = f"{nombre}-{version}-{time.time_ns()}.arrow"
+            escribir_archivo_almacen(df, archivos[nombre])
+        for nombre, archivo in archivos_comentarios.items():
+            if archivo is not None:
+                archivos[f'comentarios_{nombre}'] = archivo
+        cubo_guardado = None
+        if cubo is not None:
+            for nombre in ('conteos', 'nacional'):
+                archivos[f'cubo_{nombre}'] = f"cubo_{nombre}-{version}-{time.time_ns()}.npy"
+                np.save(os.path.join(CARPETA_ALMACEN, archivos[f'cubo_{nombre}']), cubo[nombre])
+            cubo_guardado = {'tipos': cubo['tipos'].tolist(), 'años': cubo['años'].tolist()}
+        indice_guardado = None
+        if indice is not None:
+            # Las posiciones de todos los grupos van seguidas en un solo arreglo; el puntero
+            # guarda las claves de cada grupo, en el mismo orden, y dónde empieza cada uno
+            posiciones = [filas for nombre in ('eventos', 'poligonos', 'simma') for filas in indice[nombre].values()]
+            archivos['indice'] = f"indice-{version}-{time.time_ns()}.npy"
+            np.save(os.path.join(CARPETA_ALMACEN, archivos['indice']),
+                    np.concatenate(posiciones or [np.empty(0, dtype=np.intp)]).astype(np.intp, copy=False))
+            indice_guardado = {
+                'eventos': [list(clave) for clave in indice['eventos']],
+                'poligonos': list(indice['poligonos']),
+                'simma': [int(codigo) for codigo in indice['simma']],
+                'limites': np.cumsum([0] + [len(filas) for filas in posiciones]).tolist(),
+                'nombres': indice['nombres']
+            }
+
+        puntero = {'version': version, 'huella': huella, 'archivos': archivos, 'cubo': cubo_guardado,
+                   'indice': indice_guardado,
+                   'reglas': [NORMALIZADOR_TIPOS['version'], NORMALIZADOR_TIPOS['modificado']]}
+        ruta_puntero = os.path.join(CARPETA_ALMACEN, 'almacen.json')
+        with open(ruta_puntero + '.tmp', 'w', encoding='utf-8') as archivo:
+            json.dump(puntero, archivo)
+        os.replace(ruta_puntero + '.tmp', ruta_puntero)
+
+        limpiar_almacen(set(archivos.values()) | set((anterior or {}).get('archivos', {}).values()))
+        return True
+    except (OSError, ValueError, pa.ArrowException) as e:
+        print(f"Error al guardar el almacén compartido: {str(e)}")
+        # Sin puntero los procesos de trabajo usan el snapshot, en lugar de una versión vieja
+        # que podría tener el mismo número (de una ejecución anterior)
+        try:
+            os.remove(os.path.join(CARPETA_ALMACEN, 'almacen.json'))
+        except OSError:
+            pass
+        return False
+
+def abrir_cubo_almacen(puntero, indice):
+    """
+    Cubo de eventos de la versión del puntero, con los conteos mapeados en memoria de solo
+    lectura. Los grupos salen del índice, que se construye con las mismas tablas.
+    None si no hay cubo o si se guardó con otras reglas de tipos.
+    """
+    if not puntero.get('cubo') or puntero['reglas'] != [NORMALIZADOR_TIPOS['version'], NORMALIZADOR_TIPOS['modificado']]:
+        return None
+    grupos_eventos, grupos_simma, fuente_grupo = grupos_cubo(indice)
+    try:
+        conteos = np.asarray(np.load(os.path.join(CARPETA_ALMACEN, puntero['archivos']['cubo_conteos']), mmap_mode='r'))
+        nacional = np.load(os.path.join(CARPETA_ALMACEN, puntero['archivos']['cubo_nacional']))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error al abrir el cubo del almacén compartido: {str(e)}")
+        return None
+    if conteos.shape[0] != len(fuente_grupo):
+        return None
+    return {
+        'conteos': conteos,
+        'nacional': nacional,
+        'fuente_grupo': fuente_grupo,
+        'grupos_eventos': grupos_eventos,
+        'grupos_simma': grupos_simma,
+        'tipos': pd.Index(puntero['cubo']['tipos'], dtype=object),
+        'años': np.array(puntero['cubo']['años'], dtype=np.int16)
+    }
+
+def abrir_indice_almacen(puntero):
+    """
+    Índice de municipios de la versión del puntero, con las posiciones de cada grupo como vistas
+    de un solo arreglo mapeado en memoria de solo lectura. Solo las tablas de búsqueda, que
+    dependen de las claves y no de los eventos, se vuelven a armar. None si no hay índice guardado.
+    """
+    guardado = puntero.get('indice')
+    if not guardado:
+        return None
+    try:
+        posiciones = np.asarray(np.load(os.path.join(CARPETA_ALMACEN, puntero['archivos']['indice']), mmap_mode='r'))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error al abrir el índice del almacén compartido: {str(e)}")
+        return None
+    limites = guardado['limites']
+    if limites[-1] != len(posiciones):
+        return None
+    grupos = iter(posiciones[inicio:fin] for inicio, fin in zip(limites[:-1], limites[1:]))
+    eventos = {(clave, fuente): next(grupos) for clave, fuente in guardado['eventos']}
+    poligonos = {clave: next(grupos) for clave in guardado['poligonos']}
+    simma = {codigo: next(grupos) for codigo in guardado['simma']}
+    return armar_indice_municipios(eventos, poligonos, simma, guardado['nombres'])
+
+def guardar_comentarios(nombre, comentarios):
+    """
+    Guarda los comentarios de una tabla de eventos en su propio archivo del almacén y los
+    devuelve mapeados en memoria, junto con el nombre del archivo. Sin pyarrow, o si no se
+    pueden guardar, quedan en memoria (sin archivo).
+    """
+    comentarios = comentarios.reset_index(drop=True)
+    if not SNAPSHOT_DISPONIBLE:
+        return comentarios, None
+    try:
+        os.makedirs(CARPETA_ALMACEN, exist_ok=True)
+        archivo = f"comentarios_{nombre}-{time.time_ns()}.arrow"
+        escribir_archivo_almacen(comentarios.to_frame('COMENTARIOS'), archivo)
+        return abrir_archivo_almacen(archivo)['COMENTARIOS'], archivo
+    except (OSError, ValueError, pa.ArrowException) as e:
+        print(f"Error al guardar los comentarios de {nombre}: {str(e)}")
+        return comentarios, None
+
+def separar_comentarios(eventos, eventos_simma):
+    """
+    Saca los comentarios (texto libre) de las tablas de eventos que recorren las consultas.
+    Quedan en archivos aparte, mapeados en memoria, y solo se leen por posición de fila
+    para las filas que se muestran o exportan (ver comentarios_detalle).
+    Devuelve las tablas sin la columna, los comentarios y sus archivos, por tabla.
+    """
+    tablas, comentarios, archivos = [], {}, {}
+    for nombre, df in (('eventos', eventos), ('simma', eventos_simma)):
+        comentarios[nombre], archivos[nombre] = None, None
+        if 'COMENTARIOS' in df.columns:
+            comentarios[nombre], archivos[nombre] = guardar_comentarios(nombre, df['COMENTARIOS'])
+            df = df.drop(columns='COMENTARIOS')
+        tablas.append(df)
+    return tablas[0], tablas[1], comentarios, archivos
+
+def cargar_municipios_bd():
+    """
+    Carga los polígonos de los municipios. El orden es el mismo con el que la vista
+    de PostGIS numera los municipios (ver VISTA_SIMMA)
+    """
+    query_municipios = f"""
+    SELECT "MpNombre", ST_Transform(geometry, 4326) as geometry 
+    FROM municipios
+    ORDER BY {ORDEN_MUNICIPIOS}
+    """
+    return gpd.GeoDataFrame.from_postgis(
+        query_municipios, 
+        engine, 
+        geom_col='geometry',
+        crs='EPSG:4326'
+    )
+
+def condicion_marca_agua(tabla, marca):
+    """
+    Filtro SQL y parámetros para traer solo las filas posteriores a la marca de agua.
+    Sin marca se trae la tabla completa.
+    """
+    if marca is None:
+        return "", {}
+    return f'WHERE "{COLUMNAS_MARCA_AGUA[tabla]}" > :marca', {'marca': marca}
+
+def cargar_catalogo_bd(tabla, fuente, marca=None):
+    """
+    Modo SQL: en lugar de las filas carga el catálogo de municipios y tipos de la tabla
+    con su cantidad de eventos (solo de los posteriores a la marca, si se da)
+    """
+    condicion, parametros = condicion_marca_agua(tabla, marca)
+    query_catalogo = f"""
+    SELECT "MUNICIPIO",
+           "TIPO",
+           COUNT(*) as "CANTIDAD"
+    FROM {tabla}
+    {condicion}
+    GROUP BY "MUNICIPIO", "TIPO"
+    """
+    with engine.connect().execution_options(timeout=30) as conn:
+        return pd.read_sql(text(query_catalogo), conn, params=parametros)
+
+def filtros_catalogo_sql(catalogo, nacional=False):
+    """
+    Modo SQL: por cada tabla de eventos con filas en el catálogo filtrado, la condición
+    que selecciona en PostgreSQL los mismos eventos (municipios y tipos originales).
+    En la vista nacional no se filtra por municipio, así entran también los eventos sin él.
+    """
+    filtros = []
+    for tabla, fuente in TABLAS_EVENTOS.items():
+        filas = catalogo[catalogo['FUENTE'] == fuente]
+        if fuente == 'SIMMA' or filas.empty:
+            continue
+        i = len(filtros)
+        parametros = {} if nacional else {f'municipios_{i}': filas['MUNICIPIO'].dropna().unique().tolist()}
+        condiciones_tipo = []
+        tipos = filas['TIPO_ORIGINAL'].dropna().unique().tolist()
+        if tipos:
+            condiciones_tipo.append(f'"TIPO" = ANY(:tipos_{i})')
+            parametros[f'tipos_{i}'] = tipos
+        # Los eventos sin tipo también están en el catálogo cuando no se filtra por tipo
+        if filas['TIPO_ORIGINAL'].isna().any():
+            condiciones_tipo.append('"TIPO" IS NULL')
+        condicion = f'({" OR ".join(condiciones_tipo)})'
+        if not nacional:
+            condicion = f'"MUNICIPIO" = ANY(:municipios_{i}) AND {condicion}'
+        filtros.append((tabla, fuente, condicion, parametros))
+    return filtros
+
+def tipos_originales_seleccionados(tipos_originales, tipos_seleccionados):
+    """
+    Tipos originales (categorías, no filas) cuyo tipo normalizado está entre los seleccionados,
+    y si entran los eventos sin tipo. None si no se filtra por tipo.
+    """
+    if not tipos_seleccionados or 'todos' in tipos_seleccionados:
+        return None
+    originales = [tipo for tipo in tipos_originales if normalizar_tipo_evento(tipo) in tipos_seleccionados]
+    return originales, normalizar_tipo_evento(None) in tipos_seleccionados
+
+def filtros_nacionales_sql(tipos_originales, tipos_seleccionados, fuentes_seleccionadas):
+    """
+    Modo SQL, vista nacional: condiciones equivalentes a filtros_catalogo_sql sin recorrer el
+    catálogo, a partir de los tipos originales distintos. Sin filtro de tipos se lee toda la tabla.
+    """
+    filtros = []
+    tipos = tipos_originales_seleccionados(tipos_originales, tipos_seleccionados)
+    for tabla, fuente in TABLAS_EVENTOS.items():
+        if fuente == 'SIMMA' or fuente not in fuentes_seleccionadas:
+            continue
+        condicion, parametros = condicion_tipos_sql(tipos, f'tipos_{len(filtros)}')
+        filtros.append((tabla, fuente, condicion, parametros))
+    return filtros
+
+def condicion_tipos_sql(tipos, nombre):
+    """
+    Condición de PostgreSQL sobre la columna TIPO para los tipos de tipos_originales_seleccionados
+    """
+    if tipos is None:
+        return 'TRUE', {}
+    originales, sin_tipo = tipos
+    condiciones = ['"TIPO" = ANY(:' + nombre + ')'] + (['"TIPO" IS NULL'] if sin_tipo else [])
+    return f'({" OR ".join(condiciones)})', {nombre: list(originales)}
+
+def consultar_agregados_bd(filtros):
+    """
+    Modo SQL: conteo de eventos por tipo original, fuente, año y mes con las condiciones
+    por tabla dadas, calculado en PostgreSQL. Devuelve una fila por grupo, no una por evento.
+    """
+    consultas = []
+    parametros = {}
+    for tabla, fuente, condicion, parametros_tabla in filtros:
+        consultas.append(f"""
+    SELECT "TIPO",
+           '{fuente}' as "FUENTE",
+           EXTRACT(YEAR FROM "FECHA") as "AÑO",
+           EXTRACT(MONTH FROM "FECHA") as "MES",
+           COUNT(*) as "CANTIDAD"
+    FROM {tabla}
+    WHERE {condicion}
+    GROUP BY "TIPO", EXTRACT(YEAR FROM "FECHA"), EXTRACT(MONTH FROM "FECHA")
+    """)
+        parametros.update(parametros_tabla)
+    if not consultas:
+        return pd.DataFrame(columns=COLUMNAS_AGREGADOS + ['CANTIDAD'])
+
+    with engine.connect().execution_options(timeout=30) as conn:
+        agregados = pd.read_sql(text("UNION ALL".join(consultas)), conn, params=parametros)
+    agregados['TIPO'] = agregados['TIPO'].map(normalizar_tipo_evento)
+    agregados['AÑO'] = agregados['AÑO'].fillna(0).astype('int16')
+    agregados['MES'] = agregados['MES'].fillna(0).astype('int8')
+    # Varios tipos originales pueden corresponder al mismo tipo normalizado
+    return agregados.groupby(COLUMNAS_AGREGADOS, dropna=False)['CANTIDAD'].sum().reset_index()
+
+def consulta_detalle_bd(detalle):
+    """
+    Modo SQL: subconsulta con los eventos de la tabla detallada de un resultado (ver
+    consultar_eventos_sql): FUENTE, TIPO normalizado, FECHA y COMENTARIOS, más la fuente
+    como código y la clave primaria para desempatar el orden. Devuelve la consulta y sus parámetros.
+    """
+    consultas = []
+    parametros = {'fuentes': FUENTES_DATOS, 'originales': detalle['tipos'][0], 'normalizados': detalle['tipos'][1]}
+    for tabla, fuente, condicion, parametros_tabla in detalle['filtros']:
+        consultas.append(f"""
+        SELECT {FUENTES_DATOS.index(fuente)} as "CODIGO_FUENTE",
+               "{COLUMNAS_ID[tabla]}" as "ID",
+               "TIPO" as "TIPO_ORIGINAL",
+               CAST("FECHA" AS timestamp) as "FECHA",
+               "COMENTARIOS"
+        FROM {tabla}
+        WHERE {condicion}
+        """)
+        parametros.update(parametros_tabla)
+    # Los eventos SIMMA se eligen en memoria: se traen de la base por clave primaria o, en la vista
+    # nacional, por tipo
+    if detalle['simma'] is not None:
+        condicion, parametros_simma = detalle['simma']
+        consultas.append(f"""
+        SELECT {FUENTES_DATOS.index('SIMMA')} as "CODIGO_FUENTE",
+               "{COLUMNAS_ID['eventos_simma']}" as "ID",
+               "TIPO" as "TIPO_ORIGINAL",
+               NULL::timestamp as "FECHA",
+               "SUBTIPO" as "COMENTARIOS"
+        FROM eventos_simma
+        WHERE {condicion}
+        """)
+        parametros.update(parametros_simma)
+    if not consultas:
+        consultas.append("""
+        SELECT 0 as "CODIGO_FUENTE", NULL as "ID", NULL as "TIPO_ORIGINAL", NULL::timestamp as "FECHA",
+               NULL as "COMENTARIOS"
+        WHERE FALSE
+        """)
+    # Los tipos se normalizan con la tabla de tipos originales del resultado, como en memoria
+    consulta = f"""
+    SELECT e."CODIGO_FUENTE",
+           e."ID",
+           (CAST(:fuentes AS text[]))[e."CODIGO_FUENTE" + 1] as "FUENTE",
+           COALESCE(t.normalizado, 'NO ESPECIFICADO') as "TIPO",
+           e."FECHA",
+           e."COMENTARIOS"
+    FROM ({"UNION ALL".join(consultas)}) e
+    LEFT JOIN unnest(CAST(:originales AS text[]), CAST(:normalizados AS text[])) AS t(original, normalizado)
+           ON t.original = e."TIPO_ORIGINAL"
+    """
+    return consulta, parametros
+
+def pagina_tabla_detallada_bd(detalle, pagina, filtro, orden):
+    """
+    Modo SQL: página visible de la tabla detallada y cantidad de páginas. PostgreSQL filtra,
+    ordena y cuenta; solo viajan las filas de la página, con sus comentarios.
+    """
+    eventos, parametros = consulta_detalle_bd(detalle)
+    condicion, parametros_filtro = condicion_filtro_sql(filtro)
+    parametros.update(parametros_filtro)
+    with engine.connect().execution_options(timeout=30) as conn:
+        cantidad = conn.execute(text(f"SELECT COUNT(*) FROM ({eventos}) d WHERE {condicion}"), parametros).scalar()
+        paginas = max(1, math.ceil(cantidad / TAMAÑO_PAGINA_DETALLE))
+        pagina = min(pagina or 0, paginas - 1)
+        query_pagina = f"""
+        SELECT {", ".join(f'"{columna}"' for columna in COLUMNAS_TABLA_DETALLADA)}
+        FROM ({eventos}) d
+        WHERE {condicion}
+        ORDER BY {orden_sql(orden)}
+        LIMIT :limite OFFSET :desplazamiento
+        """
+        visibles = pd.read_sql(text(query_pagina), conn, params={
+            **parametros, 'limite': TAMAÑO_PAGINA_DETALLE, 'desplazamiento': pagina * TAMAÑO_PAGINA_DETALLE})
+    return visibles[COLUMNAS_TABLA_DETALLADA].to_dict('records'), paginas, pagina
+
+def contar_tabla_detallada_bd(detalle, filtro):
+    """
+    Modo SQL: cantidad de filas de la tabla detallada que pasan los filtros, contadas en PostgreSQL
+    """
+    eventos, parametros = consulta_detalle_bd(detalle)
+    condicion, parametros_filtro = condicion_filtro_sql(filtro)
+    parametros.update(parametros_filtro)
+    with engine.connect().execution_options(timeout=30) as conn:
+        return conn.execute(text(f"SELECT COUNT(*) FROM ({eventos}) d WHERE {condicion}"), parametros).scalar()
+
+def bloques_tabla_detallada_bd(detalle, filtro, orden, tamaño):
+    """
+    Modo SQL: filas de la tabla detallada filtradas y ordenadas, en bloques del tamaño dado.
+    El cursor del servidor las entrega a medida que se leen, sin cargar todo el resultado.
+    """
+    eventos, parametros = consulta_detalle_bd(detalle)
+    condicion, parametros_filtro = condicion_filtro_sql(filtro)
+    parametros.update(parametros_filtro)
+    query_filas = f"""
+    SELECT {", ".join(f'"{columna}"' for columna in COLUMNAS_TABLA_DETALLADA)}
+    FROM ({eventos}) d
+    WHERE {condicion}
+    ORDER BY {orden_sql(orden)}
+    """
+    with engine.connect().execution_options(stream_results=True, timeout=30) as conn:
+        yield from pd.read_sql(text(query_filas), conn, params=parametros, chunksize=tamaño)
+
+def cargar_eventos_ungrd_bd(marca=None):
+    """
+    Carga los eventos desde la base UNGRD (solo los posteriores a la marca, si se da)
+    """
+    if MODO_CONSULTA == 'sql':
+        return cargar_catalogo_bd('eventos_ungrd', 'UNGRD', marca)
+    condicion, parametros = condicion_marca_agua('eventos_ungrd', marca)
+    query_eventos = f"""
+    SELECT "{COLUMNAS_ID['eventos_ungrd']}" as "ID",
+           "MUNICIPIO", 
+           "TIPO", 
+           "FECHA",
+           "COMENTARIOS"
+    FROM eventos_ungrd
+    {condicion}
+    """
+    with engine.connect().execution_options(timeout=30) as conn:
+        return pd.read_sql(text(query_eventos), conn, params=parametros)
+
+def cargar_eventos_dagran_bd(marca=None):
+    """
+    Carga los eventos desde DAGRAN (solo los posteriores a la marca, si se da)
+    """
+    if MODO_CONSULTA == 'sql':
+        return cargar_catalogo_bd('eventos_dagran', 'DAGRAN', marca)
+    condicion, parametros = condicion_marca_agua('eventos_dagran', marca)
+    query_eventos_dagran = f"""
+    SELECT "{COLUMNAS_ID['eventos_dagran']}" as "ID",
+           "MUNICIPIO",
+           "TIPO",
+           "FECHA",
+           "COMENTARIOS"
+    FROM eventos_dagran
+    {condicion}
+    """
+    with engine.connect().execution_options(timeout=30) as conn:
+        return pd.read_sql(text(query_eventos_dagran), conn, params=parametros)
+
+# Asignación de los puntos SIMMA a municipios:
+# - 'postgis': la calcula PostgreSQL una sola vez en una vista materializada (VISTA_SIMMA)
+#   con índices GiST, y se lee ya resuelta junto con los eventos
+# - 'python': se calcula al cargar con un STRtree (ver asignar_municipios_simma)
+# Si la vista no se puede crear o refrescar (p. ej. sin permisos) se usa 'python'
+ASIGNACION_SIMMA = os.getenv('ASIGNACION_SIMMA', 'postgis').lower()
+VISTA_SIMMA = 'simma_municipios'
+
+# Orden con el que se numeran los municipios: la fila de gdf_municipios es el código de municipio
+ORDEN_MUNICIPIOS = '"MpNombre", ST_AsBinary(geometry)'
+
+def consultar_huella_vista_simma(conn):
+    """
+    Huella de las tablas de las que depende la vista: si no cambia, la vista está al día
+    """
+    columna = COLUMNAS_MARCA_AGUA['eventos_simma']
+    marca = f'(SELECT MAX("{columna}") FROM eventos_simma)' if columna else 'NULL'
+    fila = conn.execute(text(f"""
+    SELECT (SELECT COUNT(*) FROM municipios) AS municipios,
+           (SELECT COUNT(*) FROM eventos_simma) AS eventos_simma,
+           {marca} AS marca_eventos_simma
+    """)).mappings().one()
+    return json.dumps({clave: str(valor) for clave, valor in fila.items()}, sort_keys=True)
+
+def preparar_vista_simma():
+    """
+    Crea la vista materializada con la asignación de cada punto SIMMA a su municipio, o la
+    refresca si cambiaron los puntos o los municipios. Misma regla que asignar_municipios_simma:
+    el municipio de menor código que contiene el punto; si no, el de menor código que lo toca
+    en el límite; si no, -1. Los joins usan índices GiST sobre la geometría en EPSG:4326.
+    La huella con la que se construyó queda como comentario de la vista, así varios procesos
+    comparten la misma vista sin recalcularla. Devuelve False si no se pudo usar.
+    """
+    if ASIGNACION_SIMMA != 'postgis':
+        return False
+    query_vista = f"""
+    CREATE MATERIALIZED VIEW {VISTA_SIMMA} AS
+    WITH codigos AS (
+        SELECT ctid, ROW_NUMBER() OVER (ORDER BY {ORDEN_MUNICIPIOS}) - 1 AS cod_municipio
+        FROM municipios
+    )
+    SELECT s.*,
+           ST_Transform(s.geometry, 4326) AS geometry_4326,
+           COALESCE(dentro.cod_municipio, limite.cod_municipio, -1) AS cod_municipio
+    FROM eventos_simma s
+    LEFT JOIN LATERAL (
+        SELECT MIN(c.cod_municipio) AS cod_municipio
+        FROM municipios m JOIN codigos c ON c.ctid = m.ctid
+        WHERE ST_Within(ST_Transform(s.geometry, 4326), ST_Transform(m.geometry, 4326))
+    ) dentro ON true
+    LEFT JOIN LATERAL (
+        SELECT MIN(c.cod_municipio) AS cod_municipio
+        FROM municipios m JOIN codigos c ON c.ctid = m.ctid
+        WHERE ST_Intersects(ST_Transform(s.geometry, 4326), ST_Transform(m.geometry, 4326))
+    ) limite ON true
+    """
+    try:
+        inicio = time.perf_counter()
+        with engine.begin() as conn:
+            # Un solo proceso a la vez crea o refresca la vista; los demás esperan y la reutilizan
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:vista))"), {'vista': VISTA_SIMMA})
+            huella = consultar_huella_vista_simma(conn)
+            existe = conn.execute(text("SELECT to_regclass(:vista) IS NOT NULL"), {'vista': VISTA_SIMMA}).scalar()
+            if existe:
+                huella_vista = conn.execute(
+                    text("SELECT obj_description(to_regclass(:vista), 'pg_class')"), {'vista': VISTA_SIMMA}
+                ).scalar()
+                if huella_vista == huella:
+                    return True
+                conn.execute(text(f"REFRESH MATERIALIZED VIEW {VISTA_SIMMA}"))
+            else:
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS municipios_geometry_4326_gist "
+                    "ON municipios USING GIST (ST_Transform(geometry, 4326))"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS eventos_simma_geometry_4326_gist "
+                    "ON eventos_simma USING GIST (ST_Transform(geometry, 4326))"))
+                conn.execute(text(query_vista))
+            # Las vistas creadas antes sin marca de agua también reciben el índice
+            if COLUMNAS_MARCA_AGUA['eventos_simma']:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS {VISTA_SIMMA}_marca '
+                                  f'ON {VISTA_SIMMA} ("{COLUMNAS_MARCA_AGUA["eventos_simma"]}")'))
+            # COMMENT no admite parámetros: la huella va como literal, con las comillas escapadas
+            comentario = huella.replace("'", "''")
+            conn.exec_driver_sql(f"COMMENT ON MATERIALIZED VIEW {VISTA_SIMMA} IS '{comentario}'")
+        print(f"  Vista {VISTA_SIMMA} {'refrescada' if existe else 'creada'} en {time.perf_counter() - inicio:.2f} s")
+        return True
+    except SQLAlchemyError as e:
+        print(f"  No se pudo preparar la vista {VISTA_SIMMA}, los puntos SIMMA se asignan en Python ({str(e)})")
+        return False
+
+def cargar_eventos_simma_bd(marca=None):
+    """
+    Carga los eventos puntuales desde SIMMA (solo los posteriores a la marca, si se da).
+    Con la vista de PostGIS disponible se trae también el municipio asignado (COD_MUNICIPIO).
+    """
+    if preparar_vista_simma():
+        tabla, geometria, codigo = VISTA_SIMMA, 'geometry_4326', ', cod_municipio as "COD_MUNICIPIO"'
+    else:
+        tabla, geometria, codigo = 'eventos_simma', 'ST_Transform(geometry, 4326)', ''
+    condicion, parametros = condicion_marca_agua('eventos_simma', marca)
+    query_eventos_simma = f"""
+    SELECT "{COLUMNAS_ID['eventos_simma']}" as "ID",
+           "TIPO",
+           "SUBTIPO" as "COMENTARIOS",
+           {geometria} as geometry{codigo}
+    FROM {tabla}
+    {condicion}
+    """
+    gdf_eventos_shp = gpd.GeoDataFrame.from_postgis(
+        text(query_eventos_simma),
+        engine,
+        geom_col='geometry',
+        crs='EPSG:4326',
+        params=parametros
+    )
+    gdf_eventos_shp['FECHA'] = None
+    if 'COD_MUNICIPIO' in gdf_eventos_shp.columns:
+        gdf_eventos_shp['COD_MUNICIPIO'] = gdf_eventos_shp['COD_MUNICIPIO'].astype(np.int32)
+    return gdf_eventos_shp
+
+# Fuentes que se cargan en paralelo: nombre -> (función de carga, tabla vacía si la carga falla)
+FUENTES_CARGA = {
+    'municipios': (
+        cargar_municipios_bd,
+        lambda: gpd.GeoDataFrame({'MpNombre': []}, geometry=gpd.GeoSeries([], crs='EPSG:4326'))
+    ),
+    'eventos_ungrd': (
+        cargar_eventos_ungrd_bd,
+        lambda: pd.DataFrame(columns=['ID', 'MUNICIPIO', 'TIPO', 'FECHA', 'COMENTARIOS', 'FUENTE'])
+    ),
+    'eventos_dagran': (
+        cargar_eventos_dagran_bd,
+        lambda: pd.DataFrame(columns=['ID', 'MUNICIPIO', 'TIPO', 'FECHA', 'COMENTARIOS', 'FUENTE'])
+    ),
+    'eventos_simma': (
+        cargar_eventos_simma_bd,
+        lambda: gpd.GeoDataFrame({'ID': [], 'TIPO': [], 'COMENTARIOS': [], 'FUENTE': [], 'FECHA': []},
+                                 geometry=gpd.GeoSeries([], crs='EPSG:4326'))
+    )
+}
+
+def cargar_fuente_bd(nombre, *argumentos):
+    """
+    Carga una fuente y mide su tiempo. Si falla, devuelve su tabla vacía
+    para que solo esa fuente quede sin datos.
+    """
+    funcion_carga, tabla_vacia = FUENTES_CARGA[nombre]
+    inicio = time.perf_counter()
+    try:
+        df = funcion_carga(*argumentos)
+        if nombre in TABLAS_EVENTOS:
+            # La fuente es la misma en toda la tabla: se agrega aquí como categórico
+            # en lugar de traer el mismo texto en cada fila desde PostgreSQL
+            codigo = FUENTES_DATOS.index(TABLAS_EVENTOS[nombre])
+            df['FUENTE'] = pd.Categorical.from_codes(np.full(len(df), codigo, dtype=np.int8), categories=FUENTES_DATOS)
+        print(f"  {nombre}: {len(df)} filas en {time.perf_counter() - inicio:.2f} s")
+        return df, False
+    except Exception as e:
+        print(f"  {nombre}: error tras {time.perf_counter() - inicio:.2f} s, se continúa sin esta fuente ({str(e)})")
+        return tabla_vacia(), True
+
+def cargar_datos_bd():
+    """
+    Descarga las tablas desde PostgreSQL en paralelo (una conexión del pool por fuente)
+    y las deja listas para consultar. Devuelve los datos y las fuentes que fallaron.
+    """
+    inicio = time.perf_counter()
+    print("Cargando datos desde la base de datos:")
+    with ThreadPoolExecutor(max_workers=len(FUENTES_CARGA)) as ejecutor:
+        resultados = dict(zip(FUENTES_CARGA, ejecutor.map(cargar_fuente_bd, FUENTES_CARGA)))
+    fallidas = [nombre for nombre, (_, fallo) in resultados.items() if fallo]
+    gdf_municipios = resultados['municipios'][0]
+    gdf_eventos_shp = resultados['eventos_simma'][0]
+
+    # Combinar todos los eventos
+    df_eventos_municipio = pd.concat([
+        resultados['eventos_ungrd'][0],
+        resultados['eventos_dagran'][0]
+    ], ignore_index=True)
+
+    # Normalizar una sola vez para que los callbacks solo apliquen máscaras
+    df_eventos_municipio = preparar_eventos(df_eventos_municipio)
+    gdf_eventos_shp = preparar_eventos(gdf_eventos_shp)
+
+    # Asignar cada punto SIMMA a su municipio una sola vez, con la geometría completa,
+    # si no vino ya resuelto desde la vista de PostGIS
+    if 'COD_MUNICIPIO' not in gdf_eventos_shp.columns:
+        gdf_eventos_shp['COD_MUNICIPIO'] = asignar_municipios_simma(gdf_eventos_shp, gdf_municipios)
+
+    print(f"Carga desde la base de datos completada en {time.perf_counter() - inicio:.2f} s"
+          + (f" (sin datos de: {', '.join(fallidas)})" if fallidas else ""))
+    return (gdf_municipios, df_eventos_municipio, gdf_eventos_shp), fallidas
+
+# Datos publicados: todo lo que sale de una misma carga, en un solo diccionario que se reemplaza
+# completo al publicar (ver publicar_datos), como NORMALIZADOR_TIPOS. Cada callback lo lee una vez
+# y usa esa lectura de principio a fin, así nunca combina el índice de una carga con las tablas,
+# el cubo o la geometría de otra. Contiene:
+# - 'version': versión de los datos (0 mientras no hay datos)
+# - 'huella': huella de las tablas fuente a la que corresponden (conteos y marcas de agua),
+#   con None en las tablas que no se pudieron cargar
+# - 'reglas': versión de las reglas de tipos con la que se normalizó TIPO
+# - 'municipios', 'eventos', 'simma': las tablas; 'indice': el índice de municipios
+# - 'cubo': cubo de conteos de eventos (ver construir_cubo_eventos); solo se usa en modo memoria
+# - 'comentarios', 'archivos_comentarios': comentarios de cada tabla de eventos ('eventos' y 'simma')
+#   por posición de fila, fuera de las tablas (ver separar_comentarios), y los archivos del
+#   almacén de donde están mapeados
+# - 'tipos': opciones del filtro de tipos. Las de municipio las sugiere el índice a medida que
+#   se escribe (ver sugerir_opciones_municipio)
+# - 'geometria': la geometría de los municipios con su propia versión, que solo cambia si cambian
+#   los polígonos; el mismo diccionario pasa de una publicación a la siguiente mientras no cambie
+# - 'memo': valores derivados de estos datos (como la capa base del mapa), calculados al pedirlos;
+#   la geometría tiene su propio 'memo' (niveles de detalle y GeoJSON servido)
+# Los datos se cargan en segundo plano (ver cargar_datos_en_segundo_plano) para que el
+# servidor responda de inmediato; mientras tanto las tablas están vacías
+DATOS_PUBLICADOS = {
+    'version': 0,
+    'huella': None,
+    'reglas': None,
+    'municipios': FUENTES_CARGA['municipios'][1](),
+    'eventos': FUENTES_CARGA['eventos_ungrd'][1](),
+    'simma': FUENTES_CARGA['eventos_simma'][1](),
+    'indice': None,
+    'cubo': None,
+    'comentarios': {'eventos': None, 'simma': None},
+    'archivos_comentarios': {'eventos': None, 'simma': None},
+    'tipos': [],
+    'geometria': {'version': 0, 'municipios': FUENTES_CARGA['municipios'][1](), 'memo': {}},
+    'memo': {}
+}
+# Un solo hilo a la vez arma y publica datos nuevos (la carga o actualización, y las reglas de tipos)
+BLOQUEO_PUBLICACION = threading.Lock()
+
+# Señal de cambios (ver consultar_señal_fuentes) de la última vez que se confirmó la huella completa
+SEÑAL_FUENTES = None
+
+# Estado de la carga que se muestra en el sidebar
+ESTADO_CARGA = {'listo': False, 'actualizando': False, 'etapa': 'Iniciando', 'progreso': 0, 'error': None}
+
+# Minutos entre actualizaciones automáticas de los datos (0 las desactiva)
+INTERVALO_ACTUALIZACION_MIN = float(os.getenv('INTERVALO_ACTUALIZACION_MIN', '15'))
+# Segundos antes de reintentar una carga inicial fallida; la espera se duplica en cada intento
+# hasta REINTENTO_CARGA_MAXIMO_S. El botón "Actualizar datos" adelanta el reintento.
+REINTENTO_CARGA_S = float(os.getenv('REINTENTO_CARGA_S', '30'))
+REINTENTO_CARGA_MAXIMO_S = float(os.getenv('REINTENTO_CARGA_MAXIMO_S', '600'))
+BLOQUEO_ACTUALIZACION = threading.Lock()
+
+# Señales entre procesos: en modo producción los procesos de trabajo las heredan al bifurcarse.
+# Un proceso de trabajo pide la actualización, el proceso principal la hace y publica en
+# VERSION_PUBLICADA la versión de los datos que dejó en el almacén compartido y el snapshot local.
+SOLICITUD_ACTUALIZACION = multiprocessing.Event()
+ACTUALIZACION_EN_CURSO = multiprocessing.Value('b', 0)
+VERSION_PUBLICADA = multiprocessing.Value('i', 0)
+
+# Modo de servidor:
+# - 'desarrollo': servidor de Flask en un solo proceso; los datos se cargan en segundo plano
+# - 'produccion': servidor WSGI de varios procesos (gunicorn, solo en Linux/macOS). Los datos
+#   se cargan una vez en el proceso principal antes de bifurcar, así los procesos de trabajo
+#   comparten sus páginas de memoria (copia al escribir) en lugar de consultar cada uno PostgreSQL.
+#   Las tablas de eventos las toman del almacén compartido, mapeado en memoria (ver guardar_almacen).
+#   Se inicia con: MODO_SERVIDOR=produccion python app.py
+MODO_SERVIDOR = os.getenv('MODO_SERVIDOR', 'desarrollo').lower()
+HOST_SERVIDOR = os.getenv('HOST_SERVIDOR', '127.0.0.1')
+PUERTO_SERVIDOR = int(os.getenv('PUERTO_SERVIDOR', '8050'))
+PROCESOS_TRABAJO = int(os.getenv('PROCESOS_TRABAJO', str(os.cpu_count() or 1)))
+HILOS_POR_PROCESO = int(os.getenv('HILOS_POR_PROCESO', '4'))
+# En producción los procesos de trabajo usan las tablas del almacén compartido (ver guardar_almacen);
+# servir_produccion lo activa si pyarrow está disponible
+ALMACEN_ACTIVO = False
+
+def obtener_tipos_eventos(*dfs_eventos):
+    """
+    Tipos de evento normalizados para las opciones de filtro: el normalizador se aplica
+    una vez por tipo original distinto de los eventos cargados, igual que al filtrar
+    """
+    tipos_originales = set()
+    for df in dfs_eventos:
+        tipos_originales.update(df['TIPO_ORIGINAL'].cat.categories)
+    return sorted({normalizar_tipo_evento(tipo) for tipo in tipos_originales})
+
+def aplicar_reglas_tipos_actualizadas():
+    """
+    Si el archivo de reglas cambió, publica los datos con TIPO renormalizado a partir de las
+    categorías originales (un cálculo por tipo distinto) sin reiniciar la aplicación.
+    Las tablas publicadas no se modifican: las nuevas comparten con ellas las demás columnas.
+    """
+    global DATOS_PUBLICADOS
+    cargar_reglas_tipos()
+    reglas = [NORMALIZADOR_TIPOS['version'], NORMALIZADOR_TIPOS['modificado']]
+    if DATOS_PUBLICADOS['version'] == 0 or DATOS_PUBLICADOS['reglas'] == reglas:
+        return
+    with BLOQUEO_PUBLICACION:
+        datos = DATOS_PUBLICADOS
+        if datos['reglas'] == reglas:
+            return
+        eventos, eventos_simma = (
+            df.assign(TIPO=mapear_valores_unicos(df['TIPO_ORIGINAL'], normalizar_tipo_evento))
+            for df in (datos['eventos'], datos['simma'])
+        )
+        cubo = construir_cubo_eventos(eventos, eventos_simma, datos['indice']) if datos['cubo'] is not None else None
+        DATOS_PUBLICADOS = dict(datos, eventos=eventos, simma=eventos_simma, cubo=cubo, reglas=reglas,
+                                tipos=obtener_tipos_eventos(eventos, eventos_simma), memo={})
+
+def avanzar_carga(etapa, progreso):
+    ESTADO_CARGA.update(etapa=etapa, progreso=progreso)
 
-# Modificar la función cargar_datos
-@lru_cache(maxsize=32)
-def cargar_datos():
+def publicar_datos(municipios, eventos, eventos_simma, indice, huella, geometria_nueva, version=None,
+                   comentarios=None, cubo=None):
+    """
+    Arma la publicación de los datos (ver DATOS_PUBLICADOS) con la nueva versión (la siguiente,
+    o la dada si los datos ya se publicaron en otro proceso), deja listas la vista nacional y la
+    capa base del mapa y la publica reemplazando el diccionario en un solo paso.
+    Si las tablas traen COMENTARIOS se separan; si no, se dan en comentarios (con sus archivos).
+    El cubo de eventos se construye salvo que se dé (p. ej. el del almacén compartido).
+    """
+    global DATOS_PUBLICADOS
+    with BLOQUEO_PUBLICACION:
+        anterior = DATOS_PUBLICADOS
+        if comentarios is None:
+            eventos, eventos_simma, *comentarios = separar_comentarios(eventos, eventos_simma)
+        if cubo is None and MODO_CONSULTA == 'memoria':
+            cubo = construir_cubo_eventos(eventos, eventos_simma, indice)
+        geometria = anterior['geometria']
+        if geometria_nueva:
+            geometria = {'version': geometria['version'] + 1, 'municipios': municipios, 'memo': {}}
+        datos = {
+            'version': anterior['version'] + 1 if version is None else version,
+            'huella': huella,
+            'reglas': [NORMALIZADOR_TIPOS['version'], NORMALIZADOR_TIPOS['modificado']],
+            'municipios': municipios,
+            'eventos': eventos,
+            'simma': eventos_simma,
+            'indice': indice,
+            'cubo': cubo,
+            'comentarios': comentarios[0],
+            'archivos_comentarios': comentarios[1],
+            'tipos': obtener_tipos_eventos(eventos, eventos_simma),
+            'geometria': geometria,
+            'memo': {}
+        }
+        vaciar_cache_resultados()
+
+        # Dejar listos los gráficos, la capa base y la geometría de la vista nacional antes de publicar los datos
+        precalcular_vista_nacional(datos)
+        construir_geometria_servida(geometria, nivel_detalle_para_zoom(VISTA_NACIONAL['zoom']))
+        construir_capa_base(datos)
+        DATOS_PUBLICADOS = datos
+    # En producción el proceso principal limpia el almacén al guardar cada versión (ver guardar_almacen)
+    if not ALMACEN_ACTIVO and SNAPSHOT_DISPONIBLE:
+        limpiar_almacen(set(datos['archivos_comentarios'].values()))
+    print(f"Tablas de eventos: {memoria_eventos(eventos, eventos_simma):.1f} MB por millón de eventos (sin comentarios)")
+
+def datos_con_comentarios(datos):
+    """
+    Tablas de una publicación con los comentarios de vuelta en las tablas de eventos, para guardar
+    el snapshot o para agregarles filas nuevas
+    """
+    tablas = [
+        df if datos['comentarios'][nombre] is None else df.assign(COMENTARIOS=datos['comentarios'][nombre].array)
+        for nombre, df in (('eventos', datos['eventos']), ('simma', datos['simma']))
+    ]
+    return datos['municipios'], tablas[0], tablas[1]
+
+def anunciar_version():
+    """
+    Anuncia a los procesos de trabajo la versión publicada, después de dejarla en el almacén compartido
+    """
+    datos = DATOS_PUBLICADOS
+    if ALMACEN_ACTIVO:
+        guardar_almacen((datos['municipios'], datos['eventos'], datos['simma']), datos['archivos_comentarios'],
+                        datos['huella'], datos['version'], datos['cubo'], datos['indice'])
+    VERSION_PUBLICADA.value = datos['version']
+
+def cargar_datos_iniciales():
+    """
+    Carga los datos, el índice de municipios, las listas de filtros y la capa base del mapa.
+    Devuelve True si los datos quedaron listos.
+    """
+    inicio = time.perf_counter()
+    ESTADO_CARGA['error'] = None
     try:
-        # Cargar municipios
-        query_municipios = """
-        SELECT "MpNombre", ST_Transform(geometry, 4326) as geometry 
-        FROM municipios
-        """
-        gdf_municipios = gpd.GeoDataFrame.from_postgis(
-            query_municipios, 
-            engine, 
-            geom_col='geometry',
-            crs='EPSG:4326'
-        )
+        avanzar_carga("Conectando a la base de datos", 5)
+        try:
+            with engine.connect() as conn:
+                print("Conexión exitosa a la base de datos")
+        except SQLAlchemyError as e:
+            # Sin conexión todavía puede usarse el snapshot local
+            print(f"No se pudo conectar a la base de datos: {str(e)}")
 
-        # Cargar eventos desde la base UNGRD
-        query_eventos = """
-        SELECT "MUNICIPIO", 
-               "TIPO", 
-               "FECHA",
-               "COMENTARIOS",
-               'UNGRD' as "FUENTE"
-        FROM eventos_ungrd
-        """
-        with engine.connect().execution_options(timeout=30) as conn:
-            df_eventos_ungrd = pd.read_sql(query_eventos, conn)
-
-        # Cargar eventos desde DAGRAN
-        query_eventos_dagran = """
-        SELECT "MUNICIPIO",
-               "TIPO",
-               "FECHA",
-               "COMENTARIOS",
-               'DAGRAN' as "FUENTE"
-        FROM eventos_dagran
-        """
-        with engine.connect().execution_options(timeout=30) as conn:
-            df_eventos_dagran = pd.read_sql(query_eventos_dagran, conn)
-
-        # Cargar eventos desde SIMMA
-        query_eventos_simma = """
-        SELECT "TIPO",
-               "SUBTIPO" as "COMENTARIOS",
-               ST_Transform(geometry, 4326) as geometry,
-               'SIMMA' as "FUENTE"
-        FROM eventos_simma
-        """
-        gdf_eventos_shp = gpd.GeoDataFrame.from_postgis(
-            query_eventos_simma,
-            engine,
-            geom_col='geometry',
-            crs='EPSG:4326'
-        )
-        gdf_eventos_shp['FECHA'] = None
+        avanzar_carga("Cargando eventos", 15)
+        (municipios, eventos, eventos_simma), huella = cargar_datos()
 
-        # Combinar todos los eventos
-        df_eventos_municipio = pd.concat([
-            df_eventos_ungrd,
-            df_eventos_dagran
-        ], ignore_index=True)
+        # La geometría se conserva completa: el mapa usa niveles de detalle precalculados
+        # (ver NIVELES_DETALLE) y el municipio resaltado se dibuja con el más detallado
+        municipios = municipios[['MpNombre', 'geometry']]  # Mantén solo las columnas necesarias
 
-        return gdf_municipios, df_eventos_municipio, gdf_eventos_shp
+        # Índice invertido de municipios para no recorrer todas las filas en cada consulta
+        avanzar_carga("Indexando municipios", 60)
+        indice = construir_indice_municipios(eventos, eventos_simma, municipios)
 
-    except SQLAlchemyError as e:
-        print(f"Error al cargar datos: {str(e)}")
-        return gpd.GeoDataFrame(), pd.DataFrame(), gpd.GeoDataFrame()
+        avanzar_carga("Preparando el mapa", 75)
+        publicar_datos(municipios, eventos, eventos_simma, indice, huella, geometria_nueva=True)
+
+        anunciar_version()
+        ESTADO_CARGA.update(listo=True, etapa="Datos listos", progreso=100)
+        print(f"Datos listos en {time.perf_counter() - inicio:.2f} s")
+        return True
+    except Exception as e:
+        print(f"Error al cargar los datos: {str(e)}")
+        ESTADO_CARGA.update(error=str(e), etapa="Error al cargar los datos")
+        return False
 
-# Modificar la carga inicial de datos
-gdf_municipios, df_eventos_municipio, gdf_eventos_shp = cargar_datos()
+def cargar_datos_con_reintentos():
+    """
+    Carga inicial de los datos. Si falla (p. ej. sin base de datos y sin snapshot local) se
+    reintenta con una espera creciente, o de inmediato si se pide desde la interfaz.
+    """
+    espera = REINTENTO_CARGA_S
+    while not cargar_datos_iniciales():
+        reintento = time.strftime('%H:%M:%S', time.localtime(time.time() + espera))
+        ESTADO_CARGA['etapa'] = f"Error al cargar los datos (nuevo intento a las {reintento})"
+        print(f"Se reintentará la carga en {espera:.0f} s")
+        SOLICITUD_ACTUALIZACION.wait(espera)
+        SOLICITUD_ACTUALIZACION.clear()
+        espera = min(espera * 2, REINTENTO_CARGA_MAXIMO_S)
 
-# Ajusta el valor de tolerancia para la simplificación
-# Un valor más pequeño preservará más detalles, un valor más grande simplificará más
-# Prueba con diferentes valores hasta encontrar el equilibrio adecuado
-gdf_municipios['geometry'] = gdf_municipios['geometry'].simplify(tolerance=0.003)
+def cargar_datos_en_segundo_plano():
+    """
+    Carga los datos sin bloquear el servidor y después queda atendiendo las actualizaciones periódicas
+    """
+    cargar_datos_con_reintentos()
+    ciclo_actualizacion()
 
-gdf_municipios = gdf_municipios[['MpNombre', 'geometry']]  # Mantén solo las columnas necesarias
+def contar_eventos_fuente(df, fuente):
+    """
+    Eventos de la fuente en df; en modo SQL cada fila del catálogo trae su cantidad
+    """
+    filas = df['FUENTE'] == fuente
+    if 'CANTIDAD' in df.columns:
+        return int(df.loc[filas, 'CANTIDAD'].sum())
+    return int(filas.sum())
 
-# Modificar la función obtener_municipios_unicos
-def obtener_municipios_unicos():
+def actualizar_datos(forzar=False):
+    """
+    Actualiza los datos sin reiniciar. Por cada tabla de eventos que cambió se traen de
+    PostgreSQL solo las filas posteriores a su marca de agua, que son las únicas que se
+    normalizan y se asignan a municipios. Publicarlas cuesta lo mismo que publicar una carga
+    completa ya en memoria: las tablas se copian al anexar las filas, el cubo se recalcula y el
+    snapshot y el almacén compartido se reescriben. Si los conteos no cuadran (filas borradas o
+    insertadas con una marca vieja), la tabla no tiene marca de agua o no se pudo cargar antes,
+    esa tabla se recarga completa; si cambiaron los municipios se recarga todo.
+    La huella solo se consulta si cambió la señal de las tablas o si se fuerza (botón
+    "Actualizar datos"), porque la señal llega con retraso. Devuelve True si los datos cambiaron.
+    """
+    global SEÑAL_FUENTES
+    if not ESTADO_CARGA['listo'] or not BLOQUEO_ACTUALIZACION.acquire(blocking=False):
+        return False
+    ESTADO_CARGA['actualizando'] = True
+    ACTUALIZACION_EN_CURSO.value = 1
+    inicio = time.perf_counter()
     try:
-        query = """
-        SELECT DISTINCT "MUNICIPIO" FROM (
-            SELECT "MUNICIPIO" FROM eventos_ungrd
-            UNION
-            SELECT "MUNICIPIO" FROM eventos_dagran
-        ) as municipios
-        WHERE "MUNICIPIO" IS NOT NULL
-        """
-        with engine.connect().execution_options(timeout=10) as conn:
-            municipios = pd.read_sql(query, conn)['MUNICIPIO'].unique()
-        return sorted([mun.split('/')[1].strip() if '/' in mun else mun for mun in municipios])
-    except SQLAlchemyError as e:
-        print(f"Error al obtener municipios: {str(e)}")
-        return []
+        # La señal se lee antes que la huella: un cambio entre ambas consultas cambia la próxima señal
+        señal = consultar_señal_fuentes()
+        if not forzar and señal is not None and señal == SEÑAL_FUENTES:
+            ESTADO_CARGA['etapa'] = f"Datos al día ({time.strftime('%H:%M')})"
+            return False
+        huella = consultar_huella_fuentes()
+        publicados = DATOS_PUBLICADOS
+        anterior = publicados['huella'] or {}
+        if huella == anterior:
+            SEÑAL_FUENTES = señal
+            ESTADO_CARGA['etapa'] = f"Datos al día ({time.strftime('%H:%M')})"
+            return False
+        print("Actualizando datos desde la base de datos:")
 
-municipios_unicos = obtener_municipios_unicos()
+        if huella['municipios'] != anterior.get('municipios'):
+            # La asignación de SIMMA y el índice de polígonos dependen de los municipios
+            datos, fallidas = cargar_datos_bd()
+            if fallidas:
+                return False
+            municipios, eventos, eventos_simma = datos
+            municipios = municipios[['MpNombre', 'geometry']]
+            indice = construir_indice_municipios(eventos, eventos_simma, municipios)
+            publicar_datos(municipios, eventos, eventos_simma, indice, huella, geometria_nueva=True)
+        else:
+            municipios, eventos, eventos_simma = datos_con_comentarios(publicados)
+            agregados = []
+            reconstruir_indice = False
+            for tabla, fuente in TABLAS_EVENTOS.items():
+                clave_marca = f'marca_{tabla}'
+                if huella[tabla] == anterior.get(tabla) and huella.get(clave_marca) == anterior.get(clave_marca):
+                    continue
+                actuales = eventos_simma if fuente == 'SIMMA' else eventos
+                nuevas = None
+                if anterior.get(clave_marca) not in (None, 'None'):
+                    nuevas, fallo = cargar_fuente_bd(tabla, anterior[clave_marca])
+                    if fallo:
+                        return False
+                    if contar_eventos_fuente(actuales, fuente) + contar_eventos_fuente(nuevas, fuente) != int(huella[tabla]):
+                        print(f"  {tabla}: los conteos no cuadran con la marca de agua, se recarga completa")
+                        nuevas = None
+                if nuevas is None:
+                    nuevas, fallo = cargar_fuente_bd(tabla)
+                    if fallo:
+                        return False
+                    actuales = actuales[actuales['FUENTE'] != fuente]
+                    reconstruir_indice = True
 
-def normalizar_texto(texto):
+                nuevas = preparar_eventos(nuevas)
+                if fuente == 'SIMMA' and 'COD_MUNICIPIO' not in nuevas.columns:
+                    nuevas['COD_MUNICIPIO'] = asignar_municipios_simma(nuevas, municipios)
+                agregados.append((fuente, nuevas, len(actuales)))
+                if fuente == 'SIMMA':
+                    eventos_simma = anexar_eventos(actuales, nuevas)
+                else:
+                    eventos = anexar_eventos(actuales, nuevas)
+
+            if reconstruir_indice:
+                indice = construir_indice_municipios(eventos, eventos_simma, municipios)
+            else:
+                indice = actualizar_indice_municipios(publicados['indice'], agregados)
+            publicar_datos(municipios, eventos, eventos_simma, indice, huella, geometria_nueva=False)
+
+        guardar_snapshot(datos_con_comentarios(DATOS_PUBLICADOS), huella)
+        anunciar_version()
+        SEÑAL_FUENTES = señal
+        ESTADO_CARGA['etapa'] = f"Datos actualizados ({time.strftime('%H:%M')})"
+        print(f"Datos actualizados en {time.perf_counter() - inicio:.2f} s")
+        return True
+    except Exception as e:
+        print(f"Error al actualizar los datos: {str(e)}")
+        ESTADO_CARGA['etapa'] = "Error al actualizar los datos"
+        return False
+    finally:
+        ESTADO_CARGA['actualizando'] = False
+        ACTUALIZACION_EN_CURSO.value = 0
+        BLOQUEO_ACTUALIZACION.release()
+
+def ciclo_actualizacion():
     """
-    Elimina tildes y convierte a mayúsculas
+    Actualiza los datos cada INTERVALO_ACTUALIZACION_MIN minutos, o antes si se solicita
+    desde la interfaz con el botón "Actualizar datos"
     """
-    if pd.isna(texto):
-        return texto
-    texto_sin_tildes = ''.join(c for c in unicodedata.normalize('NFD', str(texto))
-                              if unicodedata.category(c) != 'Mn')
-    return texto_sin_tildes.upper().strip()
+    espera = INTERVALO_ACTUALIZACION_MIN * 60 if INTERVALO_ACTUALIZACION_MIN > 0 else None
+    while True:
+        solicitada = SOLICITUD_ACTUALIZACION.wait(espera)
+        SOLICITUD_ACTUALIZACION.clear()
+        actualizar_datos(forzar=solicitada)
 
-def normalizar_tipo_evento(tipo):
+def iniciar_carga_datos():
     """
-    Normaliza los tipos de eventos para asegurar consistencia entre las tres fuentes de datos.
+    Lanza la carga de datos en un hilo aparte; el servidor queda disponible mientras tanto.
+    El mismo hilo atiende luego las actualizaciones de los datos.
     """
-    if pd.isna(tipo):
-        return "NO ESPECIFICADO"
-    
-    tipo = str(tipo).upper().strip()
-    
-    normalizacion = {
-        'MOVIMIENTO EN MASA': [
-            'DESLIZAMIENTO', 'REMOCION EN MASA', 'DERRUMBE', 
-            'MOVIMIENTOS EN MASA', 'DESLIZAMIENTOS', 'REPTACIÓN',
-            'MOVIMIENTO', 'MASA'
-        ],
-        'INUNDACION': [
-            'INUNDACIONES', 'DESBORDAMIENTO', 'ANEGACIÓN',
-            'ENCHARCAMIENTO', 'INUNDACIÓN', 'DESBORDAMIENTOS'
-        ],
-        'AVENIDA TORRENCIAL': [
-            'AVENIDA', 'TORRENCIAL', 'CRECIENTE', 
-            'FLUJO TORRENCIAL', 'AVENIDAS TORRENCIALES',
-            'FLUJOS', 'AVENIDAS'
-        ],
-        'VENDAVAL': [
-            'VIENTOS FUERTES', 'TORMENTA', 'VENDAVALES',
-            'TORNADO', 'TORMENTA ELÉCTRICA', 'VENDAVAL'
-        ],
-        'SISMO': [
-            'TEMBLOR', 'TERREMOTO', 'ACTIVIDAD SÍSMICA',
-            'SISMICIDAD', 'MICROSISMICIDAD'
-        ],
-        'INCENDIO FORESTAL': [
-            'INCENDIO DE COBERTURA VEGETAL', 'INCENDIO COBERTURA',
-            'QUEMA', 'CONFLAGRACIÓN', 'INCENDIOS'
-        ],
-        'SEQUIA': [
-            'DESABASTECIMIENTO', 'SEQUÍA', 'DÉFICIT HÍDRICO',
-            'SEQUIA', 'DESABASTECIMIENTO DE AGUA'
-        ],
-        'GRANIZADA': [
-            'GRANIZO', 'PRECIPITACIÓN SÓLIDA', 'GRANIZADAS'
-        ],
-        'EROSION': [
-            'SOCAVACIÓN', 'EROSIÓN COSTERA', 'EROSIÓN FLUVIAL',
-            'EROSIÓN', 'SOCAVAMIENTO'
-        ]
-    }
-    
-    for categoria, variantes in normalizacion.items():
-        if tipo in variantes or any(variante in tipo for variante in variantes):
-            return categoria
-    
-    return tipo
+    hilo = threading.Thread(target=cargar_datos_en_segundo_plano, name='carga-datos', daemon=True)
+    hilo.start()
+    return hilo
 
-# Modificar la función obtener_tipos_eventos
-def obtener_tipos_eventos():
+# Segundos entre revisiones de los procesos de trabajo por datos publicados por el proceso principal
+INTERVALO_SEGUIMIENTO_S = 5
+
+def abrir_almacen(version_minima):
+    """
+    Proceso de trabajo: tablas de eventos del almacén compartido, mapeadas sin copia, si tiene
+    la versión dada o una posterior. Devuelve el puntero, las tablas y sus comentarios (con
+    sus archivos, como los recibe publicar_datos), o None.
+    """
+    puntero = leer_puntero_almacen() if ALMACEN_ACTIVO else None
+    if puntero is None or puntero['version'] < version_minima:
+        return None
     try:
-        query = """
-        SELECT DISTINCT "TIPO" FROM (
-            SELECT "TIPO" FROM eventos_ungrd
-            UNION
-            SELECT "TIPO" FROM eventos_dagran
-            UNION
-            SELECT "TIPO" FROM eventos_simma
-        ) as tipos
-        WHERE "TIPO" IS NOT NULL
-        """
-        with engine.connect().execution_options(timeout=10) as conn:
-            tipos = pd.read_sql(query, conn)['TIPO'].unique()
-        tipos_normalizados = [normalizar_tipo_evento(tipo) for tipo in tipos if pd.notna(tipo)]
-        return sorted(list(set(tipos_normalizados)))
-    except SQLAlchemyError as e:
-        print(f"Error al obtener tipos de eventos: {str(e)}")
-        return []
+        tablas = [abrir_tabla_almacen(puntero, nombre) for nombre in ('eventos', 'simma')]
+        archivos = {nombre: puntero['archivos'].get(f'comentarios_{nombre}') for nombre in ('eventos', 'simma')}
+        comentarios = {nombre: abrir_archivo_almacen(archivo)['COMENTARIOS'] if archivo else None
+                       for nombre, archivo in archivos.items()}
+        return puntero, *tablas, (comentarios, archivos)
+    except (OSError, ValueError, KeyError, pa.ArrowException) as e:
+        # El proceso principal ya pudo haber publicado dos versiones más y borrado estos archivos
+        print(f"Error al abrir el almacén compartido: {str(e)}")
+        return None
+
+def recargar_datos_publicados():
+    """
+    Proceso de trabajo: carga los datos que publicó el proceso principal, del almacén compartido
+    o del snapshot local, sin consultar PostgreSQL (salvo que no haya ninguno), y los publica
+    con su misma versión
+    """
+    publicados = DATOS_PUBLICADOS
+    version = VERSION_PUBLICADA.value
+    almacen = abrir_almacen(version)
+    if almacen is not None:
+        puntero, eventos, eventos_simma, comentarios = almacen
+        version, huella = puntero['version'], puntero['huella']
+        # La geometría solo se decodifica si cambiaron los municipios
+        if huella is not None and huella.get('municipios') == (publicados['huella'] or {}).get('municipios'):
+            municipios = publicados['municipios']
+        else:
+            municipios = abrir_tabla_almacen(puntero, 'municipios')
+    else:
+        datos = leer_snapshot(None) or cargar_datos()
+        (municipios, eventos, eventos_simma), huella = datos
+        municipios = municipios[['MpNombre', 'geometry']]
+        comentarios = None
+    # El índice se mapea del almacén; solo sin almacén se recorren las tablas para construirlo
+    indice = abrir_indice_almacen(puntero) if almacen is not None else None
+    if indice is None:
+        indice = construir_indice_municipios(eventos, eventos_simma, municipios)
+    cubo = abrir_cubo_almacen(puntero, indice) if almacen is not None and MODO_CONSULTA == 'memoria' else None
+    geometria_nueva = huella is None or huella.get('municipios') != (publicados['huella'] or {}).get('municipios')
+    publicar_datos(municipios, eventos, eventos_simma, indice, huella, geometria_nueva, version=version,
+                   comentarios=comentarios, cubo=cubo)
+    ESTADO_CARGA['etapa'] = f"Datos actualizados ({time.strftime('%H:%M')})"
+
+def seguir_publicaciones():
+    """
+    Proceso de trabajo: refleja el estado de las actualizaciones del proceso principal
+    y recarga los datos cuando este publica una versión nueva
+    """
+    while True:
+        time.sleep(INTERVALO_SEGUIMIENTO_S)
+        try:
+            ESTADO_CARGA['actualizando'] = bool(ACTUALIZACION_EN_CURSO.value) or SOLICITUD_ACTUALIZACION.is_set()
+            if VERSION_PUBLICADA.value != DATOS_PUBLICADOS['version']:
+                recargar_datos_publicados()
+        except Exception as e:
+            print(f"Error al recargar los datos publicados: {str(e)}")
+
+def adoptar_almacen():
+    """
+    Proceso de trabajo: cambia las tablas de eventos y el índice de municipios heredados del
+    proceso principal por vistas del almacén compartido de la misma versión. Los heredados se
+    comparten solo hasta que el conteo de referencias toca sus páginas; los del almacén quedan
+    compartidos siempre. Las filas están en el mismo orden, así el cubo heredado sigue valiendo.
+    """
+    global DATOS_PUBLICADOS
+    datos = DATOS_PUBLICADOS
+    almacen = abrir_almacen(datos['version'])
+    if almacen is not None and almacen[0]['version'] == datos['version']:
+        # Los comentarios heredados ya están mapeados desde los mismos archivos
+        puntero, eventos, eventos_simma, _ = almacen
+        indice = abrir_indice_almacen(puntero) or datos['indice']
+        DATOS_PUBLICADOS = dict(datos, eventos=eventos, simma=eventos_simma, indice=indice)
 
-# Obtener los tipos de eventos después de definir las funciones
-tipos_eventos = obtener_tipos_eventos()
+def iniciar_proceso_trabajo():
+    """
+    Se ejecuta en cada proceso de trabajo recién bifurcado. Los bloqueos y las conexiones
+    se heredan en el estado en que estaban en el proceso principal, así que se renuevan.
+    """
+    global BLOQUEO_CACHE_RESULTADOS, CALCULOS_EN_CURSO, BLOQUEO_ACTUALIZACION, BLOQUEO_PUBLICACION
+    BLOQUEO_CACHE_RESULTADOS = threading.Lock()
+    CALCULOS_EN_CURSO = {}
+    BLOQUEO_ACTUALIZACION = threading.Lock()
+    BLOQUEO_PUBLICACION = threading.Lock()
+    # Las conexiones del pool pertenecen al proceso principal: no se cierran, solo se olvidan
+    engine.dispose(close=False)
+    adoptar_almacen()
+    threading.Thread(target=seguir_publicaciones, name='seguimiento-datos', daemon=True).start()
 
 # Inicializar la aplicación Dash con un tema de Bootstrap
 app = dash.Dash(__name__, 
@@ -335,9 +2082,6 @@ GRAPH_COLORS = [
     '#ffc107'   # Amarillo
 ]
 
-# Primero definimos las fuentes disponibles
-FUENTES_DATOS = ['UNGRD', 'DAGRAN', 'SIMMA']
-
 
 # Modificar el sidebar para incluir iconos
 sidebar = html.Div([
@@ -346,6 +2090,19 @@ sidebar = html.Div([
         "Filtros"
     ], className="mb-3 text-secondary d-flex align-items-center"),
     html.Hr(style={'border-color': COLORS['border']}),
+
+    # Estado de los datos: progreso de la carga (se oculta cuando terminan) y actualización manual
+    html.Div([
+        html.Small(id='estado-carga-texto', className="text-secondary"),
+        dbc.Progress(id='estado-carga-progreso', value=0, striped=True, animated=True,
+                     className="mt-1", style={'height': '6px'}),
+        dbc.Button([
+            html.I(className="fas fa-sync-alt me-2"),  # Icono para actualizar
+            "Actualizar datos"
+        ], id='btn-actualizar-datos', size="sm", color="secondary", outline=True, className="mt-2 w-100")
+    ], className="mb-3"),
+    dcc.Interval(id='intervalo-carga', interval=1000),
+    dcc.Store(id='version-datos'),
     
     # Filtro de municipio con icono
     dbc.Row([
@@ -354,9 +2111,13 @@ sidebar = html.Div([
                 html.I(className="fas fa-map-marker-alt me-2"),  # Icono para Municipio
                 "Selecciona un municipio"
             ], html_for="municipio-input", className="mb-2 text-secondary fw-bold d-flex align-items-center"),
-            dbc.Input(
+            # El tablero solo se recalcula al elegir un municipio de la lista;
+            # al escribir solo se piden sugerencias al índice de municipios
+            dcc.Dropdown(
                 id="municipio-input",
-                type="text",
+                options=[],
+                searchable=True,
+                clearable=True,
                 placeholder="Nombre del municipio",
                 className="mb-3",
                 style={'border-radius': '6px'}
@@ -390,8 +2151,7 @@ sidebar = html.Div([
         dbc.CardBody(
             dcc.Checklist(
                 id='tipo-evento-checklist',
-                options=[{'label': 'Seleccionar todos', 'value': 'todos'}] + 
-                        [{'label': tipo, 'value': tipo} for tipo in tipos_eventos],
+                options=[],  # Se llenan al servir el layout o al terminar la carga
                 value=[],
                 labelStyle={'display': 'block', 'margin-bottom': '8px'},
                 className="checklist-custom"
@@ -400,6 +2160,9 @@ sidebar = html.Div([
     ], style={"maxHeight": "400px", "overflowY": "scroll"}, className="mb-3")
 ], style=SIDEBAR_STYLE)
 
+# Gráfico del mapa; su figura completa se asigna al servir el layout
+grafico_mapa = dcc.Graph(id='mapa-colombia')
+
 # Modificar el contenido principal para incluir la barra de título y el modal
 content = html.Div([
     # Barra de título
@@ -466,7 +2229,7 @@ content = html.Div([
                           style={'cursor': 'pointer', 'color': COLORS['primary']})
                 ], className="fw-bold d-flex align-items-center"),
                 dbc.CardBody([
-                    dbc.Spinner(dcc.Graph(id='mapa-colombia'), color="primary")
+                    dbc.Spinner(grafico_mapa, color="primary")
                 ]),
                 dbc.Tooltip(
                     "Este mapa muestra la densidad de eventos por km² en cada municipio. "
@@ -571,10 +2334,6 @@ content = html.Div([
         ], width=12, className="fade-in"),
     ], className="mb-4"),
 
-    # Componentes de descarga
-    dcc.Download(id="descargar-resumen"),
-    dcc.Download(id="descargar-detalle"),
-    
     # Tablas
     dbc.Row([
         dbc.Col([
@@ -587,11 +2346,13 @@ content = html.Div([
                 dbc.Button([
                     html.I(className="fas fa-file-excel me-2"),
                     "Descargar Resumen (Excel)"
-                ], id="btn-descargar-resumen-excel", color="primary", className="mt-2 me-2"),
+                ], id="btn-descargar-resumen-excel", color="primary", className="mt-2 me-2",
+                   external_link=True, disabled=True),
                 dbc.Button([
                     html.I(className="fas fa-file-csv me-2"),
                     "Descargar Resumen (CSV)"
-                ], id="btn-descargar-resumen-csv", color="secondary", className="mt-2"),
+                ], id="btn-descargar-resumen-csv", color="secondary", className="mt-2",
+                   external_link=True, disabled=True),
             ]),
         ], width=12),
     ], className="mb-4"),
@@ -602,17 +2363,40 @@ content = html.Div([
                 html.I(className="fas fa-list-alt me-2"),
                 "Detalle de Eventos"
             ], className="d-flex align-items-center"),
-            html.Div(id='tabla-detallada', className="fade-in"),
+            # Paginación, orden y filtros se resuelven en el servidor: el navegador solo recibe la página visible
+            html.Div(
+                dash_table.DataTable(
+                    id='tabla-detallada-datos',
+                    columns=[{'name': columna, 'id': columna, 'type': 'datetime' if columna == 'FECHA' else 'text'}
+                             for columna in COLUMNAS_TABLA_DETALLADA],
+                    data=[],
+                    page_action='custom',
+                    page_current=0,
+                    page_size=TAMAÑO_PAGINA_DETALLE,
+                    page_count=0,
+                    sort_action='custom',
+                    sort_mode='single',
+                    sort_by=[],
+                    filter_action='custom',
+                    filter_query='',
+                    style_cell={'textAlign': 'left', 'padding': '5px'},
+                    style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
+                ),
+                id='tabla-detallada', className="fade-in", style={'display': 'none'}
+            ),
             dbc.ButtonGroup([
                 dbc.Button([
                     html.I(className="fas fa-file-excel me-2"),
                     "Descargar Detalle (Excel)"
-                ], id="btn-descargar-detalle-excel", color="primary", className="mt-2 me-2"),
+                ], id="btn-descargar-detalle-excel", color="primary", className="mt-2 me-2",
+                   external_link=True, disabled=True),
                 dbc.Button([
                     html.I(className="fas fa-file-csv me-2"),
                     "Descargar Detalle (CSV)"
-                ], id="btn-descargar-detalle-csv", color="secondary", className="mt-2"),
+                ], id="btn-descargar-detalle-csv", color="secondary", className="mt-2",
+                   external_link=True, disabled=True),
             ]),
+            html.Small(id='aviso-descarga-detalle', className="text-muted d-block mt-1"),
         ], width=12),
     ], className="mb-5"),
 
@@ -847,239 +2631,768 @@ app.index_string = '''
     </body>
 </html>
 '''
-# Layout principal
-app.layout = html.Div([sidebar, content])
+@app.callback(
+    Output('tipo-evento-checklist', 'value'),
+    Input('tipo-evento-checklist', 'value')
+)
+def update_checklist(selected_values):
+    if 'todos' in selected_values:
+        return ['todos'] + list(DATOS_PUBLICADOS['tipos'])
+    else:
+        return [value for value in selected_values if value != 'todos']
+
+# Modificar la función crear_grafico_serie_tiempo
+def crear_grafico_serie_tiempo(agregados):
+    """
+    Crea un gráfico de línea que muestra la evolución temporal de eventos
+    """
+    try:
+        if agregados.empty:
+            return px.line(title="No hay datos disponibles")
+        
+        df = agregados[agregados['AÑO'] > 0]
+        eventos_por_año = df.groupby('AÑO')['CANTIDAD'].sum().reset_index()
+        eventos_por_año.columns = ['Año', 'Cantidad']
+        
+        fig = go.Figure()
+        
+        # Agregar área con relleno
+        fig.add_trace(go.Scatter(
+            x=eventos_por_año['Año'],
+            y=eventos_por_año['Cantidad'],
+            mode='lines+markers',
+            line=dict(color='rgb(66, 133, 244)', width=2),
+            fill='tozeroy',  # Relleno desde la línea hasta el eje x
+            fillcolor='rgba(66, 133, 244, 0.2)',  # Color azul semi-transparente
+            name='Eventos'
+        ))
+        
+        fig.update_layout(
+            title='Eventos por Año',
+            xaxis_title='Año',
+            yaxis_title='Número de eventos',
+            showlegend=False,
+            plot_bgcolor='white',
+            paper_bgcolor='white',
+            xaxis=dict(
+                showgrid=True,
+                gridcolor='rgba(0,0,0,0.1)'
+            ),
+            yaxis=dict(
+                showgrid=True,
+                gridcolor='rgba(0,0,0,0.1)'
+            )
+        )
+        
+        return fig
+        
+    except Exception as e:
+        print(f"Error en crear_grafico_serie_tiempo: {str(e)}")
+        return px.line(title="Error al crear el gráfico")
+
+# Caché de resultados por combinación de filtros: LRU en memoria con un presupuesto en MB y,
+# opcionalmente, un segundo nivel en disco que sobrevive a los reinicios (0 MB lo desactiva)
+MEMORIA_CACHE_RESULTADOS_MB = float(os.getenv('MEMORIA_CACHE_RESULTADOS_MB', '256'))
+DISCO_CACHE_RESULTADOS_MB = float(os.getenv('DISCO_CACHE_RESULTADOS_MB', '0'))
+CARPETA_CACHE_RESULTADOS = os.path.join(CARPETA_CACHE, 'resultados')
+# Cambiar este número cuando cambie cómo se calculan los resultados guardados en la caché
+VERSION_CACHE_RESULTADOS = 4
+CACHE_RESULTADOS = {
+    'entradas': OrderedDict(), 'bytes': 0,
+    'aciertos': 0, 'aciertos_disco': 0, 'fallos': 0, 'desalojos': 0
+}
+BLOQUEO_CACHE_RESULTADOS = threading.Lock()
+# Clave -> bloqueo de los cálculos en curso, para calcular cada clave una sola vez
+CALCULOS_EN_CURSO = {}
+
+def huella_consulta(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas):
+    """
+    Clave de la caché: los filtros normalizados (sin importar el orden ni los duplicados)
+    más la huella de los datos publicados, de sus reglas de tipos y el modo de consulta
+    """
+    if tipos_seleccionados and 'todos' not in tipos_seleccionados:
+        tipos = sorted(set(tipos_seleccionados))
+    else:
+        tipos = ['todos']
+    clave = {
+        'version': VERSION_CACHE_RESULTADOS,
+        'municipio': municipio_norm,
+        'tipos': tipos,
+        'fuentes': sorted(set(fuentes_seleccionadas)),
+        'datos': datos['huella'],
+        'reglas': datos['reglas'],
+        'modo': MODO_CONSULTA
+    }
+    return hashlib.sha256(json.dumps(clave, sort_keys=True).encode('utf-8')).hexdigest()
+
+def usa_cache_disco(datos):
+    """
+    Los resultados de datos cargados sin alguna fuente solo quedan en memoria: en disco se
+    servirían después de un reinicio, con la fuente ya disponible
+    """
+    return huella_completa(datos['huella'])
+
+def leer_cache_resultados(clave, disco=True):
+    """
+    Devuelve el resultado guardado para la clave (primero en memoria, luego en disco si se
+    indica) o None
+    """
+    cache = CACHE_RESULTADOS
+    with BLOQUEO_CACHE_RESULTADOS:
+        if clave in cache['entradas']:
+            cache['entradas'].move_to_end(clave)
+            cache['aciertos'] += 1
+            return cache['entradas'][clave][0]
+
+    ruta = os.path.join(CARPETA_CACHE_RESULTADOS, clave + '.pkl')
+    if DISCO_CACHE_RESULTADOS_MB > 0 and disco and os.path.exists(ruta):
+        try:
+            with open(ruta, 'rb') as archivo:
+                datos = archivo.read()
+            resultado = pickle.loads(datos)
+            os.utime(ruta)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"Error al leer la caché de resultados en disco: {str(e)}")
+        else:
+            with BLOQUEO_CACHE_RESULTADOS:
+                cache['aciertos_disco'] += 1
+            guardar_en_memoria(clave, resultado, len(datos))
+            return resultado
+
+    with BLOQUEO_CACHE_RESULTADOS:
+        cache['fallos'] += 1
+    return None
+
+def guardar_en_memoria(clave, resultado, tamaño):
+    """
+    Agrega el resultado al nivel en memoria y desaloja los menos usados hasta volver al presupuesto
+    """
+    cache = CACHE_RESULTADOS
+    presupuesto = MEMORIA_CACHE_RESULTADOS_MB * 1024 * 1024
+    if tamaño > presupuesto:
+        return
+    with BLOQUEO_CACHE_RESULTADOS:
+        if clave in cache['entradas']:
+            cache['bytes'] -= cache['entradas'].pop(clave)[1]
+        cache['entradas'][clave] = (resultado, tamaño)
+        cache['bytes'] += tamaño
+        while cache['bytes'] > presupuesto:
+            _, (_, tamaño_desalojado) = cache['entradas'].popitem(last=False)
+            cache['bytes'] -= tamaño_desalojado
+            cache['desalojos'] += 1
+
+def guardar_en_disco(clave, datos):
+    """
+    Escribe el resultado serializado en disco y borra los archivos usados hace más tiempo
+    si la carpeta supera su presupuesto
+    """
+    if DISCO_CACHE_RESULTADOS_MB <= 0:
+        return
+    ruta = os.path.join(CARPETA_CACHE_RESULTADOS, clave + '.pkl')
+    try:
+        os.makedirs(CARPETA_CACHE_RESULTADOS, exist_ok=True)
+        # Varios procesos de trabajo pueden escribir la misma clave: cada uno usa su propio temporal
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, 'wb') as archivo:
+            archivo.write(datos)
+        os.replace(temporal, ruta)
+
+        archivos = [entrada for entrada in os.scandir(CARPETA_CACHE_RESULTADOS) if entrada.name.endswith('.pkl')]
+        archivos.sort(key=lambda entrada: entrada.stat().st_mtime)
+        total = sum(entrada.stat().st_size for entrada in archivos)
+        presupuesto = DISCO_CACHE_RESULTADOS_MB * 1024 * 1024
+        for entrada in archivos:
+            if total <= presupuesto:
+                break
+            total -= entrada.stat().st_size
+            os.remove(entrada.path)
+    except OSError as e:
+        print(f"Error al guardar la caché de resultados en disco: {str(e)}")
+
+def guardar_cache_resultados(clave, resultado, disco=True):
+    """
+    Guarda el resultado en memoria y, si se indica, en disco. El tamaño que cuenta para el
+    presupuesto es el del resultado serializado.
+    """
+    try:
+        datos = pickle.dumps(resultado, protocol=pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        print(f"No se pudo guardar el resultado en la caché: {str(e)}")
+        return
+    guardar_en_memoria(clave, resultado, len(datos))
+    if disco:
+        guardar_en_disco(clave, datos)
+
+def consultar_cache_resultados(clave, calcular, disco=True):
+    """
+    Devuelve el resultado de la clave desde la caché o lo calcula y lo guarda.
+    Los callbacks que piden a la vez la misma clave esperan al primero en lugar de repetir el cálculo.
+    Sin disco el resultado solo se guarda en memoria (ver usa_cache_disco).
+    """
+    resultado = leer_cache_resultados(clave, disco)
+    if resultado is not None:
+        return resultado
+
+    with BLOQUEO_CACHE_RESULTADOS:
+        bloqueo = CALCULOS_EN_CURSO.setdefault(clave, threading.Lock())
+    try:
+        with bloqueo:
+            with BLOQUEO_CACHE_RESULTADOS:
+                if clave in CACHE_RESULTADOS['entradas']:
+                    return CACHE_RESULTADOS['entradas'][clave][0]
+            resultado = calcular()
+            guardar_cache_resultados(clave, resultado, disco)
+            return resultado
+    finally:
+        with BLOQUEO_CACHE_RESULTADOS:
+            CALCULOS_EN_CURSO.pop(clave, None)
+
+def vaciar_cache_resultados():
+    """
+    Descarta el nivel en memoria; se llama al publicar datos nuevos, cuyas claves ya son otras
+    """
+    with BLOQUEO_CACHE_RESULTADOS:
+        CACHE_RESULTADOS['entradas'].clear()
+        CACHE_RESULTADOS['bytes'] = 0
+
+@app.server.route('/estado/cache-resultados')
+def estado_cache_resultados():
+    """
+    Contadores de la caché de resultados: aciertos, fallos, desalojos y ocupación
+    """
+    cache = CACHE_RESULTADOS
+    with BLOQUEO_CACHE_RESULTADOS:
+        estado = {
+            'entradas': len(cache['entradas']),
+            'memoria_mb': round(cache['bytes'] / (1024 * 1024), 2),
+            'presupuesto_memoria_mb': MEMORIA_CACHE_RESULTADOS_MB,
+            'presupuesto_disco_mb': DISCO_CACHE_RESULTADOS_MB,
+            'aciertos': cache['aciertos'],
+            'aciertos_disco': cache['aciertos_disco'],
+            'fallos': cache['fallos'],
+            'desalojos': cache['desalojos']
+        }
+    return flask.jsonify(estado)
+
+def filtrar_tipos(df, tipos_seleccionados):
+    """
+    Deja solo los eventos de los tipos seleccionados ('todos' o ninguno no filtran)
+    """
+    if tipos_seleccionados and 'todos' not in tipos_seleccionados:
+        return df[df['TIPO'].isin(tipos_seleccionados)]
+    return df
+
+def filas_eventos_consulta(datos, municipio_norm, fuentes_seleccionadas):
+    """
+    Posiciones de los eventos y de los eventos SIMMA publicados que entran en la consulta:
+    las del municipio, resueltas con el índice, o sin municipio las de todo el país
+    """
+    if municipio_norm:
+        filas = filas_eventos_municipio(datos['indice'], municipio_norm, fuentes_seleccionadas, 'exacto')
+        filas_simma = filas_simma_municipio(datos['indice'], municipio_norm, 'exacto')
+    else:
+        filas = np.flatnonzero(datos['eventos']['FUENTE'].isin(fuentes_seleccionadas))
+        filas_simma = np.arange(len(datos['simma']))
+    if 'SIMMA' not in fuentes_seleccionadas:
+        filas_simma = np.empty(0, dtype=np.intp)
+    return filas, filas_simma
+
+def filas_detalle(df, posiciones):
+    """
+    Columnas de la tabla detallada de las filas dadas de df, con su posición como FILA
+    """
+    return df[['FUENTE', 'TIPO']].iloc[posiciones].assign(
+        FECHA=fechas_desde_dias(df['DIA'].to_numpy()[posiciones]), ID=df['ID'].to_numpy()[posiciones],
+        FILA=posiciones)
+
+def consultar_eventos_memoria(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas):
+    """
+    Modo memoria: los conteos salen de rebanadas del cubo de eventos (o de sus totales
+    nacionales si no hay municipio) y las filas de la tabla detallada, del índice invertido.
+    Devuelve los conteos y las filas para la tabla detallada, o None si no hay eventos
+    en las fuentes seleccionadas.
+    """
+    filas, filas_simma = filas_eventos_consulta(datos, municipio_norm, fuentes_seleccionadas)
+
+    # Concatenar los eventos de las fuentes seleccionadas (solo las columnas del detalle)
+    partes = [
+        filas_detalle(df, posiciones)
+        for df, posiciones in ((datos['eventos'], filas), (datos['simma'], filas_simma))
+        if len(posiciones)
+    ]
+    if not partes:
+        return None
+
+    df_total_municipio = pd.concat(partes, ignore_index=True).astype({'TIPO': object, 'FUENTE': object})
+    df_total_municipio = filtrar_tipos(df_total_municipio, tipos_seleccionados)
+    if municipio_norm:
+        grupos = grupos_cubo_municipio(datos['cubo'], datos['indice'], municipio_norm, fuentes_seleccionadas, 'exacto')
+        agregados = conteos_cubo(datos['cubo'], grupos, tipos_seleccionados)
+    else:
+        agregados = conteos_nacionales_cubo(datos['cubo'], fuentes_seleccionadas, tipos_seleccionados)
+    return agregados, df_total_municipio[COLUMNAS_DETALLE].reset_index(drop=True)
+
+def consultar_eventos_sql(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas):
+    """
+    Modo SQL: el índice se resuelve sobre el catálogo en memoria y los conteos de UNGRD
+    y DAGRAN se calculan en PostgreSQL; SIMMA, que ya está en memoria, se cuenta en pandas.
+    Sin municipio, PostgreSQL cuenta toda la tabla. Devuelve los conteos y, en lugar de las filas
+    de la tabla detallada, lo necesario para consultarlas página a página (ver consulta_detalle_bd):
+    las condiciones por tabla, la de los eventos SIMMA y la normalización de los tipos.
+    """
+    filas, filas_simma = filas_eventos_consulta(datos, municipio_norm, fuentes_seleccionadas)
+    if not len(filas) and not len(filas_simma):
+        return None
+
+    # De SIMMA solo hacen falta las columnas de los conteos, sin la geometría
+    simma = datos['simma'][['ID', 'TIPO_ORIGINAL', 'TIPO', 'FUENTE', 'AÑO', 'MES']].iloc[filas_simma]
+    simma = filtrar_tipos(simma.astype({'TIPO': object, 'FUENTE': object}), tipos_seleccionados)
+    if municipio_norm:
+        catalogo = datos['eventos'].iloc[filas].astype({'TIPO': object, 'FUENTE': object})
+        catalogo = filtrar_tipos(catalogo, tipos_seleccionados)
+        filtros = filtros_catalogo_sql(catalogo, False)
+        tipos_originales = catalogo['TIPO_ORIGINAL'].dropna().unique()
+        simma_detalle = (f'"{COLUMNAS_ID["eventos_simma"]}" = ANY(:ids_simma)', {'ids_simma': simma['ID'].tolist()})
+    else:
+        # Vista nacional: las condiciones salen de los tipos distintos, sin copiar el catálogo
+        # ni listar los eventos SIMMA
+        tipos_originales = datos['eventos']['TIPO_ORIGINAL'].cat.categories
+        filtros = filtros_nacionales_sql(tipos_originales, tipos_seleccionados, fuentes_seleccionadas)
+        simma_detalle = condicion_tipos_sql(tipos_originales_seleccionados(
+            datos['simma']['TIPO_ORIGINAL'].cat.categories, tipos_seleccionados), 'tipos_simma')
+    agregados = pd.concat([consultar_agregados_bd(filtros), agregar_eventos(simma)])
+    agregados = agregados.groupby(COLUMNAS_AGREGADOS, dropna=False)['CANTIDAD'].sum().reset_index()
+
+    originales = sorted({str(tipo) for tipo in tipos_originales} |
+                        {str(tipo) for tipo in simma['TIPO_ORIGINAL'].dropna().unique()})
+    detalle = {
+        'filtros': filtros,
+        'simma': simma_detalle if not simma.empty else None,
+        'tipos': (originales, [normalizar_tipo_evento(tipo) for tipo in originales])
+    }
+    return agregados, detalle
+
+def posiciones_eventos(df, fuente, ids, filas):
+    """
+    Posiciones en df de los eventos de la fuente con los IDs dados. FILA se usa mientras
+    siga correspondiendo al mismo ID; si no (p. ej. un resultado del caché en disco calculado
+    con otra carga), el evento se busca por su ID. -1 si el evento ya no existe.
+    """
+    ids = np.asarray(ids)
+    filas = np.asarray(filas, dtype=np.intp).copy()
+    tabla_ids = df['ID'].to_numpy()
+    tabla_fuentes, codigo_fuente = df['FUENTE'].cat.codes.to_numpy(), FUENTES_DATOS.index(fuente)
+    vigentes = (filas >= 0) & (filas < len(df))
+    vigentes[vigentes] = (tabla_ids[filas[vigentes]] == ids[vigentes]) & (tabla_fuentes[filas[vigentes]] == codigo_fuente)
+    if not vigentes.all():
+        candidatas = np.flatnonzero(tabla_fuentes == codigo_fuente)
+        indice = pd.Index(tabla_ids[candidatas])
+        unicas = ~indice.duplicated()
+        candidatas, indice = candidatas[unicas], indice[unicas]
+        encontradas = indice.get_indexer(ids[~vigentes])
+        filas[~vigentes] = np.where(encontradas >= 0, candidatas[encontradas], -1)
+    return filas
+
+def comentarios_detalle(detalle):
+    """
+    Modo memoria: comentarios de las filas dadas de la tabla detallada. Se buscan solo para
+    esas filas, en los comentarios separados de las tablas (ver separar_comentarios).
+    """
+    datos = DATOS_PUBLICADOS
+    comentarios = pd.Series(None, index=detalle.index, dtype=object)
+    for fuente, grupo in detalle.groupby('FUENTE', observed=True)[['ID', 'FILA']]:
+        df = datos['simma'] if fuente == 'SIMMA' else datos['eventos']
+        filas = posiciones_eventos(df, fuente, grupo['ID'].to_numpy(), grupo['FILA'].to_numpy())
+        existentes = filas >= 0
+        # Solo se tocan las páginas del archivo de comentarios de estas filas
+        tabla = datos['comentarios']['simma' if fuente == 'SIMMA' else 'eventos']
+        comentarios[grupo.index[existentes]] = tabla.iloc[filas[existentes]].to_numpy()
+    return comentarios
+
+def calcular_resultado(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas):
+    """
+    Resultado compartido de una combinación de filtros: los eventos filtrados (conteos
+    y filas de la tabla detallada) y el total. Cada gráfico y tabla se arma a partir de él.
+    """
+    eventos = consultar_eventos_municipio(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas)
+    if eventos is None:
+        return {'eventos': None, 'total': 0}
+    return {'eventos': eventos, 'total': int(eventos[0]['CANTIDAD'].sum())}
+
+def consultar_eventos_municipio(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas):
+    """
+    Conteos de eventos del municipio y filas para la tabla detallada, según MODO_CONSULTA.
+    Ambos modos dan los mismos resultados.
+    """
+    if MODO_CONSULTA == 'sql':
+        return consultar_eventos_sql(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas)
+    return consultar_eventos_memoria(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas)
+
+# Entradas de los filtros de las que dependen el total, los gráficos y las tablas
+# Sin municipio seleccionado el tablero muestra todo el país
+NOMBRE_VISTA_NACIONAL = "Colombia"
+
+ENTRADAS_FILTROS = [
+    Input('municipio-input', 'value'),
+    Input('tipo-evento-checklist', 'value'),
+    Input('fuentes-checklist', 'value'),
+    Input('version-datos', 'data')
+]
+
+def mensaje_filtros(municipio, fuentes_seleccionadas):
+    """
+    Mensaje para el total cuando todavía no se puede consultar; None si los filtros están completos.
+    Sin municipio se consulta todo el país (vista nacional).
+    """
+    if not ESTADO_CARGA['listo']:
+        return "Cargando datos, espere un momento..."
+    if not fuentes_seleccionadas:
+        return "Debe seleccionar al menos una fuente de datos"
+    return None
+
+def datos_vigentes():
+    """
+    Publicación vigente, con las reglas de tipos al día. Cada consulta la lee una sola vez
+    y trabaja con ella hasta el final, aunque entretanto se publique otra carga.
+    """
+    aplicar_reglas_tipos_actualizadas()
+    return DATOS_PUBLICADOS
+
+def obtener_resultado_filtros(municipio, tipos_seleccionados, fuentes_seleccionadas, datos=None):
+    """
+    Resultado compartido del estado de los filtros: se calcula una sola vez y lo reutilizan
+    todos los callbacks que dependen de él. Devuelve también su clave en la caché.
+    Sin datos se usa la publicación vigente.
+    """
+    if datos is None:
+        datos = datos_vigentes()
+    municipio_norm = normalizar_texto(municipio) or None
+    clave = huella_consulta(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas)
+    resultado = consultar_cache_resultados(
+        clave, lambda: calcular_resultado(datos, municipio_norm, tipos_seleccionados, fuentes_seleccionadas),
+        usa_cache_disco(datos)
+    )
+    return clave, resultado
+
+@app.callback(
+    Output('total-eventos', 'children'),
+    ENTRADAS_FILTROS
+)
+def actualizar_total_eventos(municipio, tipos_seleccionados, fuentes_seleccionadas, version_datos):
+    try:
+        mensaje = mensaje_filtros(municipio, fuentes_seleccionadas)
+        if mensaje:
+            return mensaje
+        _, resultado = obtener_resultado_filtros(municipio, tipos_seleccionados, fuentes_seleccionadas)
+        lugar = municipio or NOMBRE_VISTA_NACIONAL
+        if resultado['eventos'] is None:
+            return f"No se encontraron eventos para {lugar}"
+        return f"Total de eventos en {lugar}: {resultado['total']}"
+    except Exception as e:
+        print(f"Error en actualizar_total_eventos: {str(e)}")
+        return "Error"
+
+# Autocompletado del municipio: sugerencias del índice mientras se escribe
+@app.callback(
+    Output('municipio-input', 'options'),
+    Input('municipio-input', 'search_value'),
+    State('municipio-input', 'value')
+)
+def sugerir_opciones_municipio(busqueda, municipio):
+    if not busqueda or not ESTADO_CARGA['listo']:
+        raise PreventUpdate
+    sugerencias = sugerir_municipios(DATOS_PUBLICADOS['indice'], busqueda)
+    # El municipio elegido sigue entre las opciones para que el selector lo muestre
+    if municipio and municipio not in sugerencias:
+        sugerencias.append(municipio)
+    return sugerencias
+
+# El mapa solo depende del municipio: los demás filtros no lo cambian
+@app.callback(
+    Output('mapa-colombia', 'figure'),
+    Input('municipio-input', 'value')
+)
+def actualizar_mapa(municipio):
+    if not ESTADO_CARGA['listo']:
+        return dash.no_update
+    return parche_mapa_colombia(municipio or None)
+
+# Gráficos y tablas que se arman a partir del resultado filtrado:
+# id -> (propiedad, función que la arma a partir del resultado, salida sin datos, es de análisis avanzado)
+SALIDAS_RESULTADO = {
+    'grafico-eventos-tipo': (
+        'figure', lambda resultado: crear_grafico_eventos_tipo(resultado['eventos'][0]), px.bar, False),
+    'grafico-fuente-datos': (
+        'figure', lambda resultado: crear_grafico_fuente_datos(resultado['eventos'][0]), px.pie, False),
+    'grafico-eventos-tipo-fuente': (
+        'figure', lambda resultado: crear_grafico_eventos_tipo_fuente(resultado['eventos'][0]), px.bar, False),
+    'grafico-serie-tiempo': (
+        'figure', lambda resultado: crear_grafico_serie_tiempo(resultado['eventos'][0]), px.line, False),
+    'tabla-resumen': (
+        'children', lambda resultado: crear_tabla_resumen(resultado['eventos'][0], resultado['total']),
+        lambda: None, False),
+    'grafico-heatmap-temporal': (
+        'figure', lambda resultado: crear_grafico_serie_tiempo_mensual(resultado['eventos'][0]),
+        lambda: px.imshow([[0]], title="No hay datos disponibles"), True),
+    'grafico-estacionalidad': (
+        'figure', lambda resultado: crear_grafico_estacionalidad(resultado['eventos'][0]),
+        lambda: px.bar(title="No hay datos disponibles"), True),
+    'grafico-correlacion': (
+        'figure', lambda resultado: crear_matriz_correlacion(resultado['eventos'][0]),
+        lambda: px.imshow([[0]], title="No hay datos disponibles"), True),
+    'grafico-tendencias': (
+        'figure', lambda resultado: crear_grafico_tendencias(resultado['eventos'][0]),
+        lambda: px.line(title="No hay datos disponibles"), True)
+}
+
+def consultar_salida(id_salida, clave, resultado, disco=True):
+    """
+    Arma una salida a partir del resultado o la lee de la caché de resultados, con su propia clave
+    """
+    def armar_salida():
+        # Como diccionarios las figuras se serializan y se leen de la caché sin volver a validarlas
+        salida = SALIDAS_RESULTADO[id_salida][1](resultado)
+        return {'salida': salida.to_plotly_json() if isinstance(salida, go.Figure) else salida}
+    return consultar_cache_resultados(f"{clave}-{id_salida}", armar_salida, disco)['salida']
+
+def precalcular_vista_nacional(datos):
+    """
+    Deja en la caché el resultado y todas las salidas de la vista nacional con los filtros
+    iniciales (todas las fuentes y todos los tipos), que es lo primero que ve cada visitante.
+    Se llama con los datos antes de publicarlos.
+    """
+    inicio = time.perf_counter()
+    try:
+        clave, resultado = obtener_resultado_filtros(None, [], FUENTES_DATOS, datos)
+        if resultado['eventos'] is None:
+            return
+        for id_salida in SALIDAS_RESULTADO:
+            consultar_salida(id_salida, clave, resultado, usa_cache_disco(datos))
+        print(f"Vista nacional precalculada en {time.perf_counter() - inicio:.2f} s")
+    except Exception as e:
+        # Sin precálculo la vista nacional se arma en la primera visita
+        print(f"Error al precalcular la vista nacional: {str(e)}")
+
+def registrar_callback_salida(id_salida, propiedad, sin_datos, avanzada):
+    """
+    Un callback por gráfico o tabla. Cada salida armada se guarda en la caché de resultados
+    con su propia clave; las de análisis avanzado solo se calculan cuando están visibles.
+    """
+    entradas = ENTRADAS_FILTROS + ([Input('switch-analisis-avanzados', 'value')] if avanzada else [])
+
+    @app.callback(Output(id_salida, propiedad), entradas)
+    def actualizar_salida(municipio, tipos_seleccionados, fuentes_seleccionadas, version_datos, visible=True):
+        if not visible:
+            raise PreventUpdate
+        try:
+            if mensaje_filtros(municipio, fuentes_seleccionadas):
+                return sin_datos()
+            datos = datos_vigentes()
+            clave, resultado = obtener_resultado_filtros(municipio, tipos_seleccionados, fuentes_seleccionadas, datos)
+            if resultado['eventos'] is None:
+                return sin_datos()
+            return consultar_salida(id_salida, clave, resultado, usa_cache_disco(datos))
+        except Exception as e:
+            print(f"Error al actualizar {id_salida}: {str(e)}")
+            return sin_datos()
+
+    return actualizar_salida
+
+for id_salida, (propiedad, _, sin_datos, avanzada) in SALIDAS_RESULTADO.items():
+    registrar_callback_salida(id_salida, propiedad, sin_datos, avanzada)
 
+# Tabla detallada: cada cambio de página, orden o filtro pide solo la página visible
 @app.callback(
-    Output('tipo-evento-checklist', 'value'),
-    Input('tipo-evento-checklist', 'value')
+    [Output('tabla-detallada-datos', 'data'),
+     Output('tabla-detallada-datos', 'page_count'),
+     Output('tabla-detallada-datos', 'page_current'),
+     Output('tabla-detallada', 'style')],
+    ENTRADAS_FILTROS + [
+        Input('tabla-detallada-datos', 'page_current'),
+        Input('tabla-detallada-datos', 'sort_by'),
+        Input('tabla-detallada-datos', 'filter_query')
+    ]
 )
-def update_checklist(selected_values):
-    if 'todos' in selected_values:
-        return ['todos'] + list(tipos_eventos)
-    else:
-        return [value for value in selected_values if value != 'todos']
+def actualizar_tabla_detallada(municipio, tipos_seleccionados, fuentes_seleccionadas, version_datos,
+                               pagina, orden, filtro):
+    oculta = ([], 0, 0, {'display': 'none'})
+    try:
+        if mensaje_filtros(municipio, fuentes_seleccionadas):
+            return oculta
+        _, resultado = obtener_resultado_filtros(municipio, tipos_seleccionados, fuentes_seleccionadas)
+        if resultado['eventos'] is None or not resultado['total']:
+            return oculta
+        # Con filtros nuevos se vuelve a la primera página
+        if dash.callback_context.triggered_id != 'tabla-detallada-datos':
+            pagina = 0
+        datos, paginas, pagina = pagina_tabla_detallada(resultado['eventos'][1], pagina, filtro, orden)
+        return datos, paginas, pagina, {'display': 'block'}
+    except Exception as e:
+        print(f"Error en actualizar_tabla_detallada: {str(e)}")
+        return oculta
 
-# Modificar la función crear_grafico_serie_tiempo
-def crear_grafico_serie_tiempo(df):
+# Descargas: los botones enlazan a /exportar con el estado de los filtros y el servidor
+# regenera el archivo completo, sin que la tabla viaje de ida y vuelta por el navegador
+TAMAÑO_BLOQUE_EXPORTACION = 5000
+# Filas máximas de una exportación a Excel. El libro se escribe en modo de solo escritura, con
+# memoria constante, pero Excel no abre hojas de más de 1.048.576 filas (contando el encabezado).
+# Por encima del límite se desactiva el enlace de Excel y se indica descargar el CSV.
+MAXIMO_FILAS_XLSX = min(int(os.getenv('MAXIMO_FILAS_XLSX', '1048575')), 1_048_575)
+FORMATOS_EXPORTACION = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+def detalle_excede_xlsx(municipio, tipos_seleccionados, fuentes_seleccionadas, filtro):
     """
-    Crea un gráfico de línea que muestra la evolución temporal de eventos
+    True si el detalle a exportar, con los filtros de la tabla, tiene más de MAXIMO_FILAS_XLSX filas.
+    Solo se cuentan las filas filtradas si el total del resultado ya supera el límite.
     """
-    try:
-        if df.empty:
-            return px.line(title="No hay datos disponibles")
-        
-        df = df.copy()
-        df['FECHA'] = pd.to_datetime(df['FECHA'])
-        eventos_por_año = df.groupby(df['FECHA'].dt.year).size().reset_index()
-        eventos_por_año.columns = ['Año', 'Cantidad']
-        
-        fig = go.Figure()
-        
-        # Agregar área con relleno
-        fig.add_trace(go.Scatter(
-            x=eventos_por_año['Año'],
-            y=eventos_por_año['Cantidad'],
-            mode='lines+markers',
-            line=dict(color='rgb(66, 133, 244)', width=2),
-            fill='tozeroy',  # Relleno desde la línea hasta el eje x
-            fillcolor='rgba(66, 133, 244, 0.2)',  # Color azul semi-transparente
-            name='Eventos'
-        ))
-        
-        fig.update_layout(
-            title='Eventos por Año',
-            xaxis_title='Año',
-            yaxis_title='Número de eventos',
-            showlegend=False,
-            plot_bgcolor='white',
-            paper_bgcolor='white',
-            xaxis=dict(
-                showgrid=True,
-                gridcolor='rgba(0,0,0,0.1)'
-            ),
-            yaxis=dict(
-                showgrid=True,
-                gridcolor='rgba(0,0,0,0.1)'
-            )
-        )
-        
-        return fig
-        
-    except Exception as e:
-        print(f"Error en crear_grafico_serie_tiempo: {str(e)}")
-        return px.line(title="Error al crear el gráfico")
+    _, resultado = obtener_resultado_filtros(municipio, tipos_seleccionados, fuentes_seleccionadas)
+    if resultado['eventos'] is None or resultado['total'] <= MAXIMO_FILAS_XLSX:
+        return False
+    return contar_tabla_detallada(resultado['eventos'][1], filtro) > MAXIMO_FILAS_XLSX
 
-# Modificar el callback principal para incluir el nuevo input
 @app.callback(
-    [Output('total-eventos', 'children'),
-     Output('mapa-colombia', 'figure'),
-     Output('grafico-eventos-tipo', 'figure'),
-     Output('grafico-fuente-datos', 'figure'),
-     Output('grafico-eventos-tipo-fuente', 'figure'),
-     Output('grafico-serie-tiempo', 'figure'),
-     Output('tabla-resumen', 'children'),
-     Output('tabla-detallada', 'children'),
-     Output('grafico-heatmap-temporal', 'figure'),
-     Output('grafico-estacionalidad', 'figure'),
-     Output('grafico-correlacion', 'figure'),
-     Output('grafico-tendencias', 'figure')],
-    [Input('municipio-input', 'value'),
-     Input('tipo-evento-checklist', 'value'),
-     Input('fuentes-checklist', 'value')]
+    [Output(f"btn-descargar-{tabla}-{boton}", propiedad)
+     for tabla in ('resumen', 'detalle') for boton in ('excel', 'csv') for propiedad in ('href', 'disabled')]
+    + [Output('aviso-descarga-detalle', 'children')],
+    ENTRADAS_FILTROS + [
+        Input('tabla-detallada-datos', 'sort_by'),
+        Input('tabla-detallada-datos', 'filter_query')
+    ]
 )
-def actualizar_graficos(municipio, tipos_seleccionados, fuentes_seleccionadas):
+def actualizar_enlaces_descarga(municipio, tipos_seleccionados, fuentes_seleccionadas, version_datos,
+                                orden, filtro):
+    if mensaje_filtros(municipio, fuentes_seleccionadas):
+        return [None, True] * 4 + [None]
+    parametros = {'municipio': municipio or '', 'tipos': tipos_seleccionados or [], 'fuentes': fuentes_seleccionadas}
+    enlaces = []
+    for tabla in ('resumen', 'detalle'):
+        if tabla == 'detalle':
+            parametros.update({'orden': json.dumps(orden or []), 'filtro': filtro or ''})
+        for formato in ('xlsx', 'csv'):
+            enlaces += [app.get_relative_path(f"/exportar/{tabla}.{formato}?{urlencode(parametros, doseq=True)}"), False]
+    aviso = None
     try:
-        if not municipio:
-            return ("No se ha seleccionado ningún municipio", crear_mapa_colombia(), 
-                   px.bar(), px.pie(), px.bar(), px.line(), None, None,
-                   px.imshow([[0]], title="No hay datos disponibles"),
-                   px.bar(title="No hay datos disponibles"),
-                   px.imshow([[0]], title="No hay datos disponibles"),
-                   px.line(title="No hay datos disponibles"))
-
-        if not fuentes_seleccionadas:
-            return ("Debe seleccionar al menos una fuente de datos", crear_mapa_colombia(), 
-                   px.bar(), px.pie(), px.bar(), px.line(), None, None,
-                   px.imshow([[0]], title="No hay datos disponibles"),
-                   px.bar(title="No hay datos disponibles"),
-                   px.imshow([[0]], title="No hay datos disponibles"),
-                   px.line(title="No hay datos disponibles"))
-
-        municipio_norm = normalizar_texto(municipio)
-        
-        # Filtrar eventos del municipio seleccionado por cada fuente
-        eventos_ungrd = pd.DataFrame()
-        eventos_dagran = pd.DataFrame()
-        eventos_simma = gpd.GeoDataFrame()
-
-        if 'UNGRD' in fuentes_seleccionadas:
-            eventos_ungrd = df_eventos_municipio[
-                (df_eventos_municipio['MUNICIPIO'].apply(normalizar_texto).str.contains(municipio_norm, case=False, na=False)) & 
-                (df_eventos_municipio['FUENTE'] == 'UNGRD')
-            ].copy()
-
-        if 'DAGRAN' in fuentes_seleccionadas:
-            eventos_dagran = df_eventos_municipio[
-                (df_eventos_municipio['MUNICIPIO'].apply(normalizar_texto).str.contains(municipio_norm, case=False, na=False)) & 
-                (df_eventos_municipio['FUENTE'] == 'DAGRAN')
-            ].copy()
-
-        if 'SIMMA' in fuentes_seleccionadas:
-            municipio_geom = gdf_municipios[gdf_municipios['MpNombre'].apply(normalizar_texto).str.contains(municipio_norm, case=False)].geometry
-            if not municipio_geom.empty:
-                eventos_simma = gdf_eventos_shp[gdf_eventos_shp.geometry.within(municipio_geom.iloc[0])].copy()
-                eventos_simma['FUENTE'] = 'SIMMA'
-
-        # Concatenar los eventos de las fuentes seleccionadas
-        df_total_municipio = pd.concat([
-            df for df in [eventos_ungrd, eventos_dagran, eventos_simma] 
-            if not df.empty
-        ])
+        if detalle_excede_xlsx(municipio, tipos_seleccionados, fuentes_seleccionadas, filtro):
+            # Detalle en Excel (posiciones 4 y 5): sin enlace, solo queda el CSV
+            enlaces[4:6] = [None, True]
+            aviso = f"El detalle supera las {MAXIMO_FILAS_XLSX} filas que admite Excel; descárguelo en CSV."
+    except Exception as e:
+        # Sin el conteo el enlace queda activo; la exportación vuelve a verificar el límite
+        print(f"Error al contar las filas del detalle: {str(e)}")
+    return enlaces + [aviso]
 
-        if df_total_municipio.empty:
-            return (f"No se encontraron eventos para {municipio}", crear_mapa_colombia(), 
-                   px.bar(), px.pie(), px.bar(), px.line(), None, None,
-                   px.imshow([[0]], title="No hay datos disponibles"),
-                   px.bar(title="No hay datos disponibles"),
-                   px.imshow([[0]], title="No hay datos disponibles"),
-                   px.line(title="No hay datos disponibles"))
+def bloques_exportacion(tabla, resultado, orden, filtro):
+    """
+    Filas a exportar en bloques de TAMAÑO_BLOQUE_EXPORTACION. Los comentarios del detalle
+    se buscan bloque por bloque, de modo que la memoria no crece con el tamaño de la exportación.
+    """
+    agregados, detalle = resultado['eventos']
+    if tabla == 'resumen':
+        yield datos_tabla_resumen(agregados, resultado['total'])
+        return
+    if MODO_CONSULTA == 'sql':
+        yield from bloques_tabla_detallada_bd(detalle, filtro, orden, TAMAÑO_BLOQUE_EXPORTACION)
+        return
+    filas = consultar_tabla_detallada(detalle, filtro, orden)
+    for inicio in range(0, len(filas), TAMAÑO_BLOQUE_EXPORTACION):
+        bloque = filas.iloc[inicio:inicio + TAMAÑO_BLOQUE_EXPORTACION]
+        if 'COMENTARIOS' not in bloque.columns:
+            bloque = bloque.assign(COMENTARIOS=comentarios_detalle(bloque))
+        yield bloque[COLUMNAS_TABLA_DETALLADA]
 
-        # Asegurarse de que la columna FECHA esté en formato datetime
-        df_total_municipio['FECHA'] = pd.to_datetime(df_total_municipio['FECHA'], errors='coerce')
-        
-        # Normalizar los tipos de eventos
-        df_total_municipio['TIPO'] = df_total_municipio['TIPO'].apply(normalizar_tipo_evento)
-        
-        # Filtrar por tipos de eventos seleccionados
-        if tipos_seleccionados and 'todos' not in tipos_seleccionados:
-            df_total_municipio = df_total_municipio[df_total_municipio['TIPO'].isin(tipos_seleccionados)]
-
-        total_eventos = len(df_total_municipio)
-
-        # Crear todos los gráficos
-        fig_mapa = crear_mapa_colombia(municipio)
-        fig_eventos_tipo = crear_grafico_eventos_tipo(df_total_municipio)
-        fig_fuente_datos = crear_grafico_fuente_datos(df_total_municipio)
-        fig_eventos_tipo_fuente = crear_grafico_eventos_tipo_fuente(df_total_municipio)
-        fig_serie_tiempo = crear_grafico_serie_tiempo(df_total_municipio)
-        tabla_resumen = crear_tabla_resumen(df_total_municipio, total_eventos)
-        tabla_detallada = crear_tabla_detallada(df_total_municipio)
-        
-        # Crear los nuevos gráficos de análisis avanzado
-        fig_heatmap = crear_grafico_serie_tiempo_mensual(df_total_municipio)
-        fig_estacionalidad = crear_grafico_estacionalidad(df_total_municipio)
-        fig_correlacion = crear_matriz_correlacion(df_total_municipio)
-        fig_tendencias = crear_grafico_tendencias(df_total_municipio)
-
-        return (f"Total de eventos en {municipio}: {total_eventos}",
-                fig_mapa, fig_eventos_tipo, fig_fuente_datos,
-                fig_eventos_tipo_fuente, fig_serie_tiempo,
-                tabla_resumen, tabla_detallada,
-                fig_heatmap, fig_estacionalidad,
-                fig_correlacion, fig_tendencias)
+def generar_csv(bloques, columnas):
+    """
+    Escribe el CSV bloque por bloque para enviarlo a medida que se genera
+    """
+    encabezado = True
+    for bloque in bloques:
+        yield bloque.to_csv(index=False, header=encabezado)
+        encabezado = False
+    if encabezado:
+        yield pd.DataFrame(columns=columnas).to_csv(index=False)
 
-    except Exception as e:
-        print(f"Error en actualizar_graficos: {str(e)}")
-        return ("Error", px.scatter(), px.bar(), px.pie(),
-                px.bar(), px.line(), None, None,
-                px.imshow([[0]]), px.bar(),
-                px.imshow([[0]]), px.line())
+def escribir_xlsx(bloques, columnas, nombre_hoja):
+    """
+    Escribe el libro en modo de solo escritura de openpyxl (memoria constante) sobre un
+    archivo temporal, que se envía desde disco y se borra al cerrarse.
+    Devuelve None en cuanto las filas superan MAXIMO_FILAS_XLSX, sin terminar el libro.
+    """
+    libro = openpyxl.Workbook(write_only=True)
+    hoja = libro.create_sheet(nombre_hoja)
+    hoja.append(columnas)
+    filas = 0
+    for bloque in bloques:
+        filas += len(bloque)
+        if filas > MAXIMO_FILAS_XLSX:
+            hoja.close()  # Cierra y borra el temporal de la hoja
+            return None
+        valores = bloque.astype(object).where(bloque.notna(), None)
+        for fila in valores.itertuples(index=False, name=None):
+            hoja.append(fila)
+    archivo = tempfile.TemporaryFile(suffix='.xlsx')
+    libro.save(archivo)
+    archivo.seek(0)
+    return archivo
 
-# Callbacks para descargar tablas
-@app.callback(
-    Output("descargar-resumen", "data"),
-    [Input("btn-descargar-resumen-excel", "n_clicks"),
-     Input("btn-descargar-resumen-csv", "n_clicks")],
-    [State('tabla-resumen', 'children')],
-    prevent_initial_call=True
-)
-def descargar_resumen(n_clicks_excel, n_clicks_csv, tabla_resumen):
-    ctx = dash.callback_context
-    if not ctx.triggered:
-        raise PreventUpdate
-    button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    
-    if tabla_resumen is None:
-        raise PreventUpdate
-    
-    df = pd.DataFrame(tabla_resumen['props']['data'])
-    if button_id == "btn-descargar-resumen-excel":
-        return dcc.send_data_frame(df.to_excel, "resumen_eventos.xlsx", sheet_name="Resumen")
-    elif button_id == "btn-descargar-resumen-csv":
-        return dcc.send_data_frame(df.to_csv, "resumen_eventos.csv", index=False)
+@app.server.route('/exportar/<tabla>.<formato>')
+def exportar_tabla(tabla, formato):
+    """
+    Exporta el resumen o el detalle completo de los filtros indicados en la URL. El resultado
+    sale de la misma caché que los gráficos, porque la clave es la huella de esos filtros.
+    """
+    if tabla not in ('resumen', 'detalle') or formato not in FORMATOS_EXPORTACION:
+        flask.abort(404)
+    if not ESTADO_CARGA['listo']:
+        flask.abort(503)
+    argumentos = flask.request.args
+    municipio, fuentes_seleccionadas = argumentos.get('municipio'), argumentos.getlist('fuentes')
+    if mensaje_filtros(municipio, fuentes_seleccionadas):
+        flask.abort(400)
+    try:
+        orden = json.loads(argumentos.get('orden') or '[]')
+    except ValueError:
+        flask.abort(400)
+    # El CSV se transmite: un orden mal formado fallaría con la respuesta ya empezada
+    if not orden_valido(orden):
+        flask.abort(400)
+    _, resultado = obtener_resultado_filtros(municipio, argumentos.getlist('tipos'), fuentes_seleccionadas)
+    if resultado['eventos'] is None:
+        flask.abort(404)
 
-@app.callback(
-    Output("descargar-detalle", "data"),
-    [Input("btn-descargar-detalle-excel", "n_clicks"),
-     Input("btn-descargar-detalle-csv", "n_clicks")],
-    [State('tabla-detallada', 'children')],
-    prevent_initial_call=True
-)
-def descargar_detalle(n_clicks_excel, n_clicks_csv, tabla_detallada):
-    ctx = dash.callback_context
-    if not ctx.triggered:
-        raise PreventUpdate
-    button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    
-    if tabla_detallada is None:
-        raise PreventUpdate
-    
-    df = pd.DataFrame(tabla_detallada['props']['data'])
-    if button_id == "btn-descargar-detalle-excel":
-        return dcc.send_data_frame(df.to_excel, "detalle_eventos.xlsx", sheet_name="Detalle")
-    elif button_id == "btn-descargar-detalle-csv":
-        return dcc.send_data_frame(df.to_csv, "detalle_eventos.csv", index=False)
+    nombre = f"{tabla}_eventos.{formato}"
+    columnas = ['Fuente', 'Cantidad de Eventos'] if tabla == 'resumen' else COLUMNAS_TABLA_DETALLADA
+    bloques = bloques_exportacion(tabla, resultado, orden, argumentos.get('filtro', ''))
+    if formato == 'csv':
+        respuesta = flask.Response(flask.stream_with_context(generar_csv(bloques, columnas)),
+                                   mimetype=FORMATOS_EXPORTACION['csv'])
+        respuesta.headers['Content-Disposition'] = f'attachment; filename="{nombre}"'
+        return respuesta
+    try:
+        archivo = escribir_xlsx(bloques, columnas, tabla.capitalize())
+    finally:
+        # Si el libro no se terminó, cierra la consulta en curso (en modo SQL, con su conexión)
+        bloques.close()
+    if archivo is None:
+        flask.abort(422, description=f"La exportación supera las {MAXIMO_FILAS_XLSX} filas permitidas en Excel. "
+                                     f"Descargue el CSV, que no tiene límite de filas.")
+    return flask.send_file(archivo, mimetype=FORMATOS_EXPORTACION['xlsx'], as_attachment=True,
+                           download_name=nombre)
 
 # Agregar una función para contar eventos por municipio
 def contar_eventos_por_municipio(df_eventos_municipio, gdf_eventos_shp, gdf_municipios):
-    # Contar eventos del DataFrame
-    eventos_df = df_eventos_municipio['MUNICIPIO'].value_counts().reset_index()
+    # Contar eventos del DataFrame (en modo SQL, sumando las cantidades del catálogo)
+    if 'CANTIDAD' in df_eventos_municipio.columns:
+        eventos_df = df_eventos_municipio.groupby('MUNICIPIO')['CANTIDAD'].sum().reset_index()
+    else:
+        eventos_df = df_eventos_municipio['MUNICIPIO'].value_counts().reset_index()
     eventos_df.columns = ['MpNombre', 'Eventos']
     
-    # Contar eventos del GeoDataFrame
-    eventos_shp = gdf_eventos_shp.sjoin(gdf_municipios, how="inner", predicate="within")
-    eventos_shp = eventos_shp['MpNombre'].value_counts().reset_index()
+    # Contar eventos del GeoDataFrame con el municipio asignado al cargar los datos
+    codigos_simma = gdf_eventos_shp.loc[gdf_eventos_shp['COD_MUNICIPIO'] >= 0, 'COD_MUNICIPIO']
+    eventos_shp = gdf_municipios['MpNombre'].iloc[codigos_simma].value_counts().reset_index()
     eventos_shp.columns = ['MpNombre', 'Eventos']
     
     # Combinar ambos conteos
@@ -1097,92 +3410,356 @@ def contar_eventos_por_municipio(df_eventos_municipio, gdf_eventos_shp, gdf_muni
     
     return gdf_municipios_eventos
 
-# Modificar la función crear_mapa_colombia
-def crear_mapa_colombia(municipio_seleccionado=None):
-    try:
-        gdf_municipios_eventos = contar_eventos_por_municipio(df_eventos_municipio, gdf_eventos_shp, gdf_municipios)
-        
-        fig = go.Figure(go.Choroplethmapbox(
-            geojson=gdf_municipios_eventos.__geo_interface__,
-            locations=gdf_municipios_eventos.index,
-            z=gdf_municipios_eventos['Densidad_Eventos'],
-            colorscale="Viridis",
-            marker_opacity=0.7,
-            marker_line_width=0,
-            colorbar=dict(
-                title=dict(
-                    text="Densidad de eventos por km²",
-                    side='right',
-                    font=dict(size=12),
-                ),
-                thickness=15,
-                len=0.75,
-                yanchor='middle',
-                y=0.5,
-                ticks='outside'
-            ),
-        ))
+# Vista nacional del mapa cuando no hay municipio seleccionado
+VISTA_NACIONAL = {'center': {"lat": 4.5709, "lon": -74.2973}, 'zoom': 4, 'uirevision': 'constant'}
 
-        # Configuración inicial del mapa
-        layout_inicial = dict(
-            mapbox_style="light",
-            mapbox=dict(
-                accesstoken=mapbox_access_token,
-                center={"lat": 4.5709, "lon": -74.2973},
-                zoom=4
-            ),
-            margin={"r":0,"t":0,"l":0,"b":0},
-            uirevision='constant'  # Mantener el estado del UI entre actualizaciones
+def crear_capa_resaltado(municipio_geom=None, geometria=None):
+    """
+    Crea la traza roja del municipio resaltado (vacía si no hay municipio), con los polígonos
+    de la geometría publicada
+    """
+    if municipio_geom is None:
+        return go.Choroplethmapbox(
+            geojson={'type': 'FeatureCollection', 'features': []},
+            locations=[],
+            z=[],
+            colorscale=[[0, "red"], [1, "red"]],
+            marker_opacity=0.8,
+            showscale=False
         )
+    # Se dibuja con el nivel más detallado de los que se sirven, no con la geometría original
+    filas = municipio_geom.index.to_numpy()
+    geometrias = geometrias_servidas(geometria, len(NIVELES_DETALLE) - 1)[filas]
+    geojson = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'id': int(fila), 'properties': {},
+         'geometry': json.loads(geometria) if geometria else None}
+        for fila, geometria in zip(filas, shapely.to_geojson(geometrias))
+    ]}
+    return go.Choroplethmapbox(
+        geojson=geojson,
+        locations=municipio_geom.index,
+        z=municipio_geom['Densidad_Eventos'],
+        colorscale=[[0, "red"], [1, "red"]],
+        marker_opacity=0.8,
+        showscale=False
+    )
+
+# Decimales de las coordenadas enviadas al navegador (4 decimales son unos 11 m)
+DECIMALES_GEOMETRIA = int(os.getenv('DECIMALES_GEOMETRIA', '4'))
+
+# Niveles de detalle de los límites municipales: (zoom desde el que se usa, tolerancia en grados)
+# Un valor más pequeño preservará más detalles, un valor más grande simplificará más
+NIVELES_DETALLE = [
+    (0, 0.01),     # Vista nacional
+    (5.5, 0.003),  # Departamento
+    (7, 0.001)     # Municipio
+]
+
+def nivel_detalle_para_zoom(zoom):
+    """
+    Devuelve el índice del nivel de detalle que corresponde al zoom del mapa
+    """
+    return max(nivel for nivel, (zoom_minimo, _) in enumerate(NIVELES_DETALLE) if zoom >= zoom_minimo)
+
+def simplificar_topologico(geometrias, tolerancia):
+    """
+    Simplifica los límites sin abrir huecos ni traslapes entre municipios vecinos:
+    los bordes se parten en arcos entre nodos, cada arco compartido se simplifica
+    una sola vez y los polígonos se reconstruyen a partir de los arcos simplificados.
+    Los municipios que no se pueden reconstruir se simplifican por separado.
+    """
+    arcos = shapely.get_parts(shapely.line_merge(shapely.union_all(shapely.boundary(geometrias))))
+    arcos = shapely.simplify(arcos, tolerancia, preserve_topology=True)
+    caras = shapely.get_parts(shapely.polygonize(arcos))
+
+    # Cada cara pertenece al municipio original que contiene uno de sus puntos interiores
+    idx_caras, idx_municipios = STRtree(geometrias).query(shapely.point_on_surface(caras), predicate='within')
+
+    resultado = shapely.simplify(geometrias, tolerancia, preserve_topology=True)
+    for fila, caras_fila in pd.Series(idx_caras).groupby(idx_municipios).indices.items():
+        partes = caras[idx_caras[caras_fila]]
+        resultado[fila] = partes[0] if len(partes) == 1 else shapely.union_all(partes)
+    return resultado
+
+def construir_niveles_detalle(geometria):
+    """
+    Precalcula la geometría de cada nivel de detalle para una versión de la geometría.
+    Se calcula una vez y queda en el 'memo' de esa versión.
+    """
+    memo = geometria['memo']
+    if 'niveles' not in memo:
+        inicio = time.perf_counter()
+        geometrias = shapely.make_valid(geometria['municipios'].geometry.to_numpy())
+        niveles = [simplificar_topologico(geometrias, tolerancia) for _, tolerancia in NIVELES_DETALLE]
+        vertices = ', '.join(str(int(shapely.get_num_coordinates(nivel).sum())) for nivel in niveles)
+        print(f"Niveles de detalle calculados en {time.perf_counter() - inicio:.1f} s "
+              f"(vértices por nivel: {vertices}; original: {int(shapely.get_num_coordinates(geometrias).sum())})")
+        memo['niveles'] = niveles
+    return memo['niveles']
+
+def url_geometria_municipios(version_geometria, nivel):
+    """
+    URL versionada del archivo de límites municipales de un nivel de detalle; cambia cuando cambian los polígonos
+    """
+    return app.get_relative_path(f'/geometria/municipios-{version_geometria}-{nivel}.geojson')
+
+def geometrias_servidas(geometria, nivel):
+    """
+    Límites municipales de un nivel de detalle con las coordenadas cuantizadas a DECIMALES_GEOMETRIA,
+    tal como se envían al navegador (una fila por fila de los municipios)
+    """
+    memo = geometria['memo']
+    if ('servidas', nivel) not in memo:
+        resolucion = 10 ** -DECIMALES_GEOMETRIA
+        geometrias = shapely.set_precision(construir_niveles_detalle(geometria)[nivel], resolucion)
+        memo['servidas', nivel] = shapely.transform(geometrias, lambda coords: np.round(coords, DECIMALES_GEOMETRIA))
+    return memo['servidas', nivel]
+
+def construir_geometria_servida(geometria, nivel):
+    """
+    Serializa una vez por versión y nivel los límites municipales como GeoJSON compacto
+    (ver geometrias_servidas): sin propiedades y comprimido con gzip.
+    El id de cada polígono es su fila en los municipios. Devuelve el cuerpo y su ETag.
+    """
+    memo = geometria['memo']
+    if ('geojson', nivel) not in memo:
+        features = ','.join(
+            f'{{"type":"Feature","id":{fila},"properties":{{}},"geometry":{poligono or "null"}}}'
+            for fila, poligono in enumerate(shapely.to_geojson(geometrias_servidas(geometria, nivel)))
+        )
+        cuerpo = f'{{"type":"FeatureCollection","features":[{features}]}}'.encode('utf-8')
+        memo['geojson', nivel] = gzip.compress(cuerpo), hashlib.sha1(cuerpo).hexdigest()
+    return memo['geojson', nivel]
+
+@app.server.route('/geometria/municipios-<int:version_geometria>-<int:nivel>.geojson')
+def servir_geometria_municipios(version_geometria, nivel):
+    """
+    Sirve los límites municipales desde su propia URL para que el navegador los
+    descargue una vez por versión de la geometría y nivel, y los reutilice desde su caché
+    """
+    if nivel >= len(NIVELES_DETALLE):
+        flask.abort(404)
+    if not ESTADO_CARGA['listo']:
+        flask.abort(503)
+    geometria = DATOS_PUBLICADOS['geometria']
+    cuerpo, etag = construir_geometria_servida(geometria, nivel)
+    if version_geometria == geometria['version']:
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        cache_control = 'no-cache'
+
+    # Cada codificación es una representación distinta y lleva su propio ETag
+    comprimido = 'gzip' in flask.request.accept_encodings
+    if comprimido:
+        etag = f'{etag}-gz'
+    if flask.request.if_none_match.contains(etag):
+        respuesta = flask.Response(status=304)
+    elif comprimido:
+        respuesta = flask.Response(cuerpo, mimetype='application/geo+json')
+        respuesta.headers['Content-Encoding'] = 'gzip'
+    else:
+        respuesta = flask.Response(gzip.decompress(cuerpo), mimetype='application/geo+json')
+    respuesta.set_etag(etag)
+    respuesta.headers['Cache-Control'] = cache_control
+    respuesta.headers['Vary'] = 'Accept-Encoding'
+    return respuesta
+
+def construir_capa_base(datos):
+    """
+    Calcula una vez por publicación de los datos los conteos y la densidad por municipio
+    y la figura base del mapa nacional, convertida a diccionario para reutilizarla sin copiarla
+    """
+    if 'capa_base' in datos['memo']:
+        return datos['memo']['capa_base']
+    gdf_municipios_eventos = contar_eventos_por_municipio(datos['eventos'], datos['simma'], datos['municipios'])
+
+    fig = go.Figure(go.Choroplethmapbox(
+        geojson=url_geometria_municipios(
+            datos['geometria']['version'], nivel_detalle_para_zoom(VISTA_NACIONAL['zoom'])),
+        locations=gdf_municipios_eventos.index,
+        z=gdf_municipios_eventos['Densidad_Eventos'],
+        colorscale="Viridis",
+        marker_opacity=0.7,
+        marker_line_width=0,
+        colorbar=dict(
+            title=dict(
+                text="Densidad de eventos por km²",
+                side='right',
+                font=dict(size=12),
+            ),
+            thickness=15,
+            len=0.75,
+            yanchor='middle',
+            y=0.5,
+            ticks='outside'
+        ),
+    ))
+
+    # Capa de resaltado vacía: las actualizaciones parciales reemplazan solo esta traza
+    fig.add_trace(crear_capa_resaltado())
+
+    # Configuración inicial del mapa
+    layout_inicial = dict(
+        mapbox_style="light",
+        mapbox=dict(
+            accesstoken=mapbox_access_token,
+            center={"lat": 4.5709, "lon": -74.2973},
+            zoom=4
+        ),
+        margin={"r":0,"t":0,"l":0,"b":0},
+        uirevision='constant'  # Mantener el estado del UI entre actualizaciones
+    )
+    
+    fig.update_layout(layout_inicial)
+    datos['memo']['capa_base'] = gdf_municipios_eventos, fig.to_plotly_json()
+    return datos['memo']['capa_base']
+
+def calcular_resaltado_municipio(datos, municipio_seleccionado=None):
+    """
+    Devuelve la traza resaltada (como diccionario) y la vista del mapa para el municipio.
+    Sin municipio, o si no se encuentra, devuelve la capa vacía y la vista nacional.
+    """
+    if municipio_seleccionado:
+        gdf_municipios_eventos, _ = construir_capa_base(datos)
+        municipio_norm = normalizar_texto(municipio_seleccionado)
+        municipio_geom = gdf_municipios_eventos.iloc[poligonos_municipio(datos['indice'], municipio_norm, 'exacto')]
         
-        fig.update_layout(layout_inicial)
-        
-        if municipio_seleccionado:
-            municipio_norm = normalizar_texto(municipio_seleccionado)
-            municipio_geom = gdf_municipios_eventos[
-                gdf_municipios_eventos['MpNombre'].apply(normalizar_texto).str.contains(municipio_norm, case=False)
-            ]
+        if not municipio_geom.empty:
+            # Calcular el centroide y los límites del municipio
+            municipio_geom_proj = municipio_geom.to_crs('EPSG:4326')
+            bounds = municipio_geom_proj.geometry.total_bounds  # [minx, miny, maxx, maxy]
             
-            if not municipio_geom.empty:
-                # Calcular el centroide y los límites del municipio
-                municipio_geom_proj = municipio_geom.to_crs('EPSG:4326')
-                bounds = municipio_geom_proj.geometry.total_bounds  # [minx, miny, maxx, maxy]
-                
-                # Calcular el centro
-                center_lon = (bounds[0] + bounds[2]) / 2
-                center_lat = (bounds[1] + bounds[3]) / 2
-                
-                # Calcular el zoom basado en la extensión del municipio
-                lon_range = bounds[2] - bounds[0]
-                lat_range = bounds[3] - bounds[1]
-                
-                # Ajustar la fórmula del zoom para mostrar más contexto
-                zoom = min(8, max(5, -1.2 * math.log(max(lon_range, lat_range)) + 10))
-                
-                # Agregar el municipio resaltado
-                fig.add_choroplethmapbox(
-                    geojson=municipio_geom.__geo_interface__,
-                    locations=municipio_geom.index,
-                    z=municipio_geom['Densidad_Eventos'],
-                    colorscale=[[0, "red"], [1, "red"]],
-                    marker_opacity=0.8,
-                    showscale=False
-                )
-                
-                # Actualizar la vista del mapa con los nuevos valores
-                fig.update_layout(
-                    mapbox=dict(
-                        center=dict(lat=center_lat, lon=center_lon),
-                        zoom=zoom
-                    ),
-                    uirevision=municipio_seleccionado  # Actualizar uirevision con el municipio actual
-                )
+            # Calcular el centro
+            center_lon = (bounds[0] + bounds[2]) / 2
+            center_lat = (bounds[1] + bounds[3]) / 2
+            
+            # Calcular el zoom basado en la extensión del municipio
+            lon_range = bounds[2] - bounds[0]
+            lat_range = bounds[3] - bounds[1]
+            
+            # Ajustar la fórmula del zoom para mostrar más contexto
+            zoom = min(8, max(5, -1.2 * math.log(max(lon_range, lat_range)) + 10))
+            
+            vista = {
+                'center': dict(lat=center_lat, lon=center_lon),
+                'zoom': zoom,
+                'uirevision': municipio_seleccionado  # Actualizar uirevision con el municipio actual
+            }
+            return crear_capa_resaltado(municipio_geom, datos['geometria']).to_plotly_json(), vista
+
+    return crear_capa_resaltado().to_plotly_json(), VISTA_NACIONAL
+
+# Modificar la función crear_mapa_colombia
+def crear_mapa_colombia(municipio_seleccionado=None):
+    """
+    Crea la figura completa del mapa (capa nacional, resaltado y vista)
+    """
+    try:
+        # La capa nacional se reutiliza; por solicitud solo cambian el resaltado y la vista
+        datos = DATOS_PUBLICADOS
+        _, figura_base = construir_capa_base(datos)
+        resaltado, vista = calcular_resaltado_municipio(datos, municipio_seleccionado)
         
-        return fig
+        nivel = nivel_detalle_para_zoom(vista['zoom'])
+        capa_nacional = dict(figura_base['data'][0], geojson=url_geometria_municipios(datos['geometria']['version'], nivel))
+        
+        layout = dict(figura_base['layout'])
+        layout['mapbox'] = dict(layout['mapbox'], center=vista['center'], zoom=vista['zoom'])
+        layout['uirevision'] = vista['uirevision']
+        return {'data': [capa_nacional, resaltado], 'layout': layout}
     except Exception as e:
         print(f"Error en crear_mapa_colombia: {str(e)}")
         return go.Figure()
 
+def parche_mapa_colombia(municipio_seleccionado=None):
+    """
+    Actualización parcial del mapa: reemplaza solo la capa resaltada, el centro y el zoom.
+    La capa nacional ya está en el navegador y no se vuelve a enviar.
+    """
+    try:
+        datos = DATOS_PUBLICADOS
+        resaltado, vista = calcular_resaltado_municipio(datos, municipio_seleccionado)
+        parche = Patch()
+        # El nivel de detalle de la capa nacional sigue al zoom; el resaltado va con todo el detalle
+        parche['data'][0]['geojson'] = url_geometria_municipios(
+            datos['geometria']['version'], nivel_detalle_para_zoom(vista['zoom']))
+        parche['data'][1] = resaltado
+        parche['layout']['mapbox']['center'] = vista['center']
+        parche['layout']['mapbox']['zoom'] = vista['zoom']
+        parche['layout']['uirevision'] = vista['uirevision']
+        return parche
+    except Exception as e:
+        print(f"Error en parche_mapa_colombia: {str(e)}")
+        return dash.no_update
+
+def crear_mapa_cargando():
+    """
+    Mapa que se muestra mientras cargan los datos: mismas capas que el mapa completo
+    (nacional y resaltado) pero vacías, para que las actualizaciones parciales sigan aplicando
+    """
+    fig = go.Figure([go.Choroplethmapbox(), crear_capa_resaltado()])
+    fig.update_layout(
+        mapbox_style="light",
+        mapbox=dict(
+            accesstoken=mapbox_access_token,
+            center=VISTA_NACIONAL['center'],
+            zoom=VISTA_NACIONAL['zoom']
+        ),
+        margin={"r":0,"t":0,"l":0,"b":0},
+        uirevision=VISTA_NACIONAL['uirevision']
+    )
+    return fig
+
+# Cada cuánto consulta el navegador si hay datos nuevos cuando no hay una carga en curso
+INTERVALO_SONDEO_MS = 30000
+
+# Progreso de la carga y de las actualizaciones; publica la versión de los datos cuando cambia
+@app.callback(
+    [Output('estado-carga-texto', 'children'),
+     Output('estado-carga-progreso', 'value'),
+     Output('estado-carga-progreso', 'style'),
+     Output('intervalo-carga', 'interval'),
+     Output('version-datos', 'data')],
+    [Input('intervalo-carga', 'n_intervals'),
+     Input('btn-actualizar-datos', 'n_clicks')],
+    [State('version-datos', 'data')]
+)
+def actualizar_estado_carga(n_intervals, n_clicks, version_cliente):
+    visible, oculto = {'height': '6px'}, {'display': 'none'}
+    if ESTADO_CARGA['error']:
+        # El botón adelanta el reintento de la carga (ver cargar_datos_con_reintentos)
+        if dash.callback_context.triggered_id == 'btn-actualizar-datos':
+            SOLICITUD_ACTUALIZACION.set()
+            return ("Reintentando la carga...", 0, visible, 1000, dash.no_update)
+        return (f"{ESTADO_CARGA['etapa']}: {ESTADO_CARGA['error']}", 100, oculto, INTERVALO_SONDEO_MS, dash.no_update)
+    if not ESTADO_CARGA['listo']:
+        return (f"{ESTADO_CARGA['etapa']}...", ESTADO_CARGA['progreso'], visible, 1000, dash.no_update)
+
+    if dash.callback_context.triggered_id == 'btn-actualizar-datos':
+        ESTADO_CARGA['actualizando'] = True
+        SOLICITUD_ACTUALIZACION.set()
+    if ESTADO_CARGA['actualizando']:
+        return ("Actualizando datos...", 100, visible, 1000, dash.no_update)
+
+    version = DATOS_PUBLICADOS['version']
+    version = version if version != version_cliente else dash.no_update
+    return (ESTADO_CARGA['etapa'], 100, oculto, INTERVALO_SONDEO_MS, version)
+
+# Con datos nuevos se envían las opciones de tipos y el mapa completo; después solo parches
+@app.callback(
+    [Output('tipo-evento-checklist', 'options'),
+     Output('mapa-colombia', 'figure', allow_duplicate=True)],
+    [Input('version-datos', 'data')],
+    [State('municipio-input', 'value')],
+    prevent_initial_call=True
+)
+def publicar_datos_cargados(version_datos, municipio):
+    if not version_datos:
+        raise PreventUpdate
+    opciones = ([{'label': 'Seleccionar todos', 'value': 'todos'}] +
+                [{'label': tipo, 'value': tipo} for tipo in DATOS_PUBLICADOS['tipos']])
+    return opciones, crear_mapa_colombia(municipio)
+
 # Agregar un callback para validar que siempre haya al menos una fuente seleccionada
 @app.callback(
     Output('fuentes-checklist', 'value'),
@@ -1193,23 +3770,19 @@ def validar_fuentes_seleccionadas(value):
         return ['UNGRD']  # Devolver al menos una fuente por defecto
     return value
 
-def crear_grafico_serie_tiempo_mensual(df):
+def crear_grafico_serie_tiempo_mensual(agregados):
     try:
-        if df.empty:
+        if agregados.empty:
             return px.imshow([[0]], title="No hay datos disponibles")
             
-        # Filtrar solo datos de UNGRD
-        df = df[df['FUENTE'] == 'UNGRD'].copy()
-        df['FECHA'] = pd.to_datetime(df['FECHA'], errors='coerce')
-        df = df.dropna(subset=['FECHA'])
+        # Filtrar solo datos de UNGRD con fecha
+        df = agregados[(agregados['FUENTE'] == 'UNGRD') & (agregados['AÑO'] > 0)]
         
         if df.empty:
             return px.imshow([[0]], title="No hay datos disponibles")
             
-        df['Año'] = df['FECHA'].dt.year
-        df['Mes'] = df['FECHA'].dt.month
-        
-        eventos_por_mes = df.groupby(['Año', 'Mes']).size().reset_index(name='Cantidad')
+        eventos_por_mes = df.groupby(['AÑO', 'MES'])['CANTIDAD'].sum().reset_index()
+        eventos_por_mes.columns = ['Año', 'Mes', 'Cantidad']
         eventos_pivot = eventos_por_mes.pivot(index='Año', columns='Mes', values='Cantidad').fillna(0)
         
         fig = px.imshow(eventos_pivot,
@@ -1254,21 +3827,19 @@ def crear_grafico_serie_tiempo_mensual(df):
         print(f"Error en crear_grafico_serie_tiempo_mensual: {str(e)}")
         return px.imshow([[0]], title="Error al crear el gráfico")
 
-def crear_grafico_estacionalidad(df):
+def crear_grafico_estacionalidad(agregados):
     try:
-        if df.empty:
+        if agregados.empty:
             return px.bar(title="No hay datos disponibles")
             
-        # Filtrar solo datos de UNGRD
-        df = df[df['FUENTE'] == 'UNGRD'].copy()
-        df['FECHA'] = pd.to_datetime(df['FECHA'], errors='coerce')
-        df = df.dropna(subset=['FECHA'])
+        # Filtrar solo datos de UNGRD con fecha
+        df = agregados[(agregados['FUENTE'] == 'UNGRD') & (agregados['AÑO'] > 0)]
         
         if df.empty:
             return px.bar(title="No hay datos disponibles")
             
-        df['Mes'] = df['FECHA'].dt.month
-        eventos_por_mes = df.groupby('Mes').size().reset_index(name='Cantidad')
+        eventos_por_mes = df.groupby('MES')['CANTIDAD'].sum().reset_index()
+        eventos_por_mes.columns = ['Mes', 'Cantidad']
         
         meses = ['Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
                  'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre']
@@ -1311,25 +3882,24 @@ def crear_grafico_estacionalidad(df):
         print(f"Error en crear_grafico_estacionalidad: {str(e)}")
         return px.bar(title="Error al crear el gráfico")
 
-def crear_matriz_correlacion(df):
+def crear_matriz_correlacion(agregados):
     try:
-        if df.empty:
+        if agregados.empty:
             return px.imshow([[0]], title="No hay datos disponibles")
             
-        df = df.copy()
-        df['FECHA'] = pd.to_datetime(df['FECHA'], errors='coerce')
-        df = df.dropna(subset=['FECHA'])
+        df = agregados[agregados['AÑO'] > 0].copy()
         
         if df.empty:
             return px.imshow([[0]], title="No hay datos disponibles")
             
-        df['Mes_Año'] = df['FECHA'].dt.strftime('%Y-%m')
+        df['Mes_Año'] = df['AÑO'].astype(str).str.zfill(4) + '-' + df['MES'].astype(str).str.zfill(2)
         
         eventos_pivot = pd.pivot_table(
             df,
             index='Mes_Año',
             columns='TIPO',
-            aggfunc='size',
+            values='CANTIDAD',
+            aggfunc='sum',
             fill_value=0
         )
         
@@ -1357,20 +3927,18 @@ def crear_matriz_correlacion(df):
         print(f"Error en crear_matriz_correlacion: {str(e)}")
         return px.imshow([[0]], title="Error al crear el gráfico")
 
-def crear_grafico_tendencias(df):
+def crear_grafico_tendencias(agregados):
     try:
-        if df.empty:
+        if agregados.empty:
             return px.line(title="No hay datos disponibles")
             
-        df = df.copy()
-        df['FECHA'] = pd.to_datetime(df['FECHA'], errors='coerce')
-        df = df.dropna(subset=['FECHA'])
+        df = agregados[agregados['AÑO'] > 0]
         
         if df.empty:
             return px.line(title="No hay datos disponibles")
             
-        df['Año'] = df['FECHA'].dt.year
-        eventos_por_año_tipo = df.groupby(['Año', 'TIPO']).size().reset_index(name='Cantidad')
+        eventos_por_año_tipo = df.groupby(['AÑO', 'TIPO'])['CANTIDAD'].sum().reset_index()
+        eventos_por_año_tipo.columns = ['Año', 'TIPO', 'Cantidad']
         
         fig = go.Figure()
         
@@ -1421,18 +3989,24 @@ def crear_grafico_tendencias(df):
         print(f"Error en crear_grafico_tendencias: {str(e)}")
         return px.line(title="Error al crear el gráfico")
 
-def crear_grafico_eventos_tipo(df):
+def contar_por_fuente(agregados):
+    """
+    Total de eventos por fuente, de mayor a menor
+    """
+    return agregados.groupby('FUENTE')['CANTIDAD'].sum().sort_values(ascending=False, kind='stable')
+
+def crear_grafico_eventos_tipo(agregados):
     """
     Crea un gráfico de barras que muestra el total de eventos por tipo
     """
     try:
-        if df.empty:
+        if agregados.empty:
             return px.bar(title="No hay datos disponibles")
         
         # Contar eventos por tipo
-        eventos_por_tipo = df.groupby('TIPO').size().reset_index(name='Cantidad')
+        eventos_por_tipo = agregados.groupby('TIPO')['CANTIDAD'].sum().reset_index(name='Cantidad')
         # Ordenar de mayor a menor
-        eventos_por_tipo = eventos_por_tipo.sort_values('Cantidad', ascending=False)
+        eventos_por_tipo = eventos_por_tipo.sort_values('Cantidad', ascending=False, kind='stable')
         
         fig = px.bar(
             eventos_por_tipo, 
@@ -1460,15 +4034,15 @@ def crear_grafico_eventos_tipo(df):
         print(f"Error en crear_grafico_eventos_tipo: {str(e)}")
         return px.bar(title="Error al crear el gráfico")
 
-def crear_grafico_fuente_datos(df):
+def crear_grafico_fuente_datos(agregados):
     """
     Crea un gráfico de torta que muestra la distribución por fuente de datos
     """
     try:
-        if df.empty:
+        if agregados.empty:
             return px.pie(title="No hay datos disponibles")
         
-        eventos_por_fuente = df['FUENTE'].value_counts()
+        eventos_por_fuente = contar_por_fuente(agregados)
         
         fig = go.Figure(data=[go.Pie(
             labels=eventos_por_fuente.index,
@@ -1494,22 +4068,22 @@ def crear_grafico_fuente_datos(df):
         print(f"Error en crear_grafico_fuente_datos: {str(e)}")
         return px.pie(title="Error al crear el gráfico")
 
-def crear_grafico_eventos_tipo_fuente(df):
+def crear_grafico_eventos_tipo_fuente(agregados):
     """
     Crea un gráfico de barras agrupadas por tipo de evento y fuente
     """
     try:
-        if df.empty:
+        if agregados.empty:
             return px.bar(title="No hay datos disponibles")
         
-        eventos_por_tipo_fuente = df.groupby(['TIPO', 'FUENTE']).size().reset_index(name='Cantidad')
-        total_por_tipo = eventos_por_tipo_fuente.groupby('TIPO')['Cantidad'].sum().sort_values(ascending=False)
+        eventos_por_tipo_fuente = agregados.groupby(['TIPO', 'FUENTE'])['CANTIDAD'].sum().reset_index(name='Cantidad')
+        total_por_tipo = eventos_por_tipo_fuente.groupby('TIPO')['Cantidad'].sum().sort_values(ascending=False, kind='stable')
         orden_tipos = total_por_tipo.index.tolist()
         
         fig = go.Figure()
         
         # Definir posiciones de las barras para cada fuente
-        fuentes = df['FUENTE'].unique()
+        fuentes = [fuente for fuente in FUENTES_DATOS if fuente in set(agregados['FUENTE'])]
         width = 0.25  # Ancho de cada barra
         offsets = np.linspace(-(width * (len(fuentes)-1)/2), width * (len(fuentes)-1)/2, len(fuentes))
         
@@ -1567,27 +4141,33 @@ def crear_grafico_eventos_tipo_fuente(df):
         print(f"Error en crear_grafico_eventos_tipo_fuente: {str(e)}")
         return px.bar(title="Error al crear el gráfico")
 
-def crear_tabla_resumen(df, total_eventos):
+def datos_tabla_resumen(agregados, total_eventos):
+    """
+    Filas de la tabla resumen: eventos por fuente y el total
+    """
+    eventos_por_fuente = contar_por_fuente(agregados)
+    datos_relevantes = pd.DataFrame({
+        'Fuente': eventos_por_fuente.index,
+        'Cantidad de Eventos': eventos_por_fuente.values
+    })
+    
+    return pd.concat([
+        datos_relevantes,
+        pd.DataFrame({
+            'Fuente': ['Total'],
+            'Cantidad de Eventos': [total_eventos]
+        })
+    ])
+
+def crear_tabla_resumen(agregados, total_eventos):
     """
     Crea una tabla resumen con estadísticas básicas
     """
     try:
-        if df.empty:
+        if agregados.empty:
             return None
         
-        eventos_por_fuente = df['FUENTE'].value_counts()
-        datos_relevantes = pd.DataFrame({
-            'Fuente': eventos_por_fuente.index,
-            'Cantidad de Eventos': eventos_por_fuente.values
-        })
-        
-        datos_relevantes = pd.concat([
-            datos_relevantes,
-            pd.DataFrame({
-                'Fuente': ['Total'],
-                'Cantidad de Eventos': [total_eventos]
-            })
-        ])
+        datos_relevantes = datos_tabla_resumen(agregados, total_eventos)
         
         return dash_table.DataTable(
             data=datos_relevantes.to_dict('records'),
@@ -1600,28 +4180,166 @@ def crear_tabla_resumen(df, total_eventos):
         print(f"Error en crear_tabla_resumen: {str(e)}")
         return None
 
-def crear_tabla_detallada(df):
+# Operadores de filtro_query de la tabla (en palabras o en símbolos) y su nombre canónico.
+# Dash también admite los prefijos i/s (sin o con distinción de mayúsculas), que aquí se ignoran.
+OPERADORES_FILTRO = {
+    'ge': 'ge', '>=': 'ge', 'le': 'le', '<=': 'le', 'lt': 'lt', '<': 'lt', 'gt': 'gt', '>': 'gt',
+    'ne': 'ne', '!=': 'ne', 'eq': 'eq', '=': 'eq', 'contains': 'contains', 'datestartswith': 'datestartswith'
+}
+PATRON_FILTRO = re.compile(r'\s*\{(?P<columna>[^}]*)\}\s*(?P<operador>[is]?[<>!=]+|[a-z]+)\s*(?P<valor>.*)', re.DOTALL)
+
+def dividir_filtro(parte):
     """
-    Crea una tabla detallada con todos los eventos
+    Separa una condición del filtro de la tabla ("{TIPO} contains SISMO") en columna, operador y valor.
+    El operador es el token que sigue a {columna}; todo lo demás es el valor, aunque contenga
+    palabras como "le" o "eq".
     """
-    try:
-        if df.empty:
-            return None
-        
-        columnas = ['FUENTE', 'TIPO', 'FECHA', 'COMENTARIOS']
-        df_detalle = df[columnas].copy()
-        
-        return dash_table.DataTable(
-            data=df_detalle.to_dict('records'),
-            columns=[{'name': i, 'id': i} for i in columnas],
-            page_size=10,
-            style_cell={'textAlign': 'left', 'padding': '5px'},
-            style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
-        )
-        
-    except Exception as e:
-        print(f"Error en crear_tabla_detallada: {str(e)}")
-        return None
+    coincidencia = PATRON_FILTRO.fullmatch(parte)
+    if not coincidencia:
+        return None, None, None
+    operador = coincidencia['operador']
+    if operador not in OPERADORES_FILTRO and operador[:1] in ('i', 's'):
+        operador = operador[1:]
+    if operador not in OPERADORES_FILTRO:
+        return None, None, None
+    valor = coincidencia['valor'].strip()
+    if len(valor) > 1 and valor[0] == valor[-1] and valor[0] in ('"', "'", '`'):
+        valor = valor[1:-1].replace('\\' + valor[0], valor[0])
+    return coincidencia['columna'], OPERADORES_FILTRO[operador], valor
+
+def filtrar_tabla_detallada(df, filtro):
+    """
+    Aplica los filtros por columna de la tabla detallada con máscaras vectorizadas.
+    FECHA se compara como fecha; las demás columnas como texto, sin distinguir mayúsculas.
+    """
+    for parte in (filtro or '').split(' && '):
+        columna, operador, valor = dividir_filtro(parte)
+        if columna not in df.columns or valor == '':
+            continue
+        if columna == 'FECHA':
+            if operador in ('contains', 'datestartswith'):
+                serie, valor = df['FECHA'].dt.strftime('%Y-%m-%d %H:%M:%S'), str(valor)
+            else:
+                serie, valor = df['FECHA'], pd.to_datetime(str(valor), errors='coerce')
+                if pd.isna(valor):
+                    continue
+        else:
+            serie, valor = df[columna].astype(str).str.upper(), str(valor).upper()
+
+        if operador == 'contains':
+            mascara = serie.str.contains(valor, regex=False, na=False)
+        elif operador == 'datestartswith':
+            mascara = serie.str.startswith(valor, na=False)
+        else:
+            mascara = {'eq': serie == valor, 'ne': serie != valor, 'lt': serie < valor,
+                       'le': serie <= valor, 'gt': serie > valor, 'ge': serie >= valor}[operador]
+        df = df[mascara]
+    return df
+
+def orden_valido(orden):
+    """
+    True si orden tiene la forma del sort_by de la tabla: una lista de {column_id, direction}
+    con columnas de la tabla detallada
+    """
+    return isinstance(orden, list) and all(
+        isinstance(criterio, dict) and criterio.get('column_id') in COLUMNAS_TABLA_DETALLADA
+        and criterio.get('direction') in ('asc', 'desc')
+        for criterio in orden
+    )
+
+def ordenar_tabla_detallada(df, orden):
+    """
+    Ordena la tabla detallada según el sort_by de la tabla (orden estable, vacíos al final)
+    """
+    columnas = [criterio for criterio in (orden or []) if criterio['column_id'] in df.columns]
+    if not columnas:
+        return df
+    return df.sort_values(
+        [criterio['column_id'] for criterio in columnas],
+        ascending=[criterio['direction'] == 'asc' for criterio in columnas],
+        kind='stable', na_position='last'
+    )
+
+# Operadores de comparación de PostgreSQL para los operadores canónicos del filtro
+OPERADORES_SQL = {'eq': '=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+
+def condicion_filtro_sql(filtro):
+    """
+    Modo SQL: los filtros por columna de la tabla detallada como condición de PostgreSQL,
+    con la misma semántica que filtrar_tabla_detallada (el texto se compara en mayúsculas y
+    byte a byte, como en Python). Devuelve la condición y sus parámetros.
+    """
+    condiciones, parametros = ['TRUE'], {}
+    for i, parte in enumerate((filtro or '').split(' && ')):
+        columna, operador, valor = dividir_filtro(parte)
+        if columna not in COLUMNAS_TABLA_DETALLADA or valor == '':
+            continue
+        nombre = f'filtro_{i}'
+        if columna == 'FECHA' and operador not in ('contains', 'datestartswith'):
+            fecha = pd.to_datetime(str(valor), errors='coerce')
+            if pd.isna(fecha):
+                continue
+            expresion, parametros[nombre] = '"FECHA"', fecha.to_pydatetime()
+        elif columna == 'FECHA':
+            expresion, parametros[nombre] = """to_char("FECHA", 'YYYY-MM-DD HH24:MI:SS')""", str(valor)
+        else:
+            expresion, parametros[nombre] = f'UPPER("{columna}") COLLATE "C"', str(valor).upper()
+
+        if operador == 'contains':
+            condiciones.append(f'STRPOS({expresion}, :{nombre}) > 0')
+        elif operador == 'datestartswith':
+            condiciones.append(f'STRPOS({expresion}, :{nombre}) = 1')
+        elif operador == 'ne':
+            condiciones.append(f'{expresion} IS DISTINCT FROM :{nombre}')
+        else:
+            condiciones.append(f'{expresion} {OPERADORES_SQL[operador]} :{nombre}')
+    return ' AND '.join(condiciones), parametros
+
+def orden_sql(orden):
+    """
+    Modo SQL: ORDER BY equivalente a ordenar_tabla_detallada (vacíos al final). Se desempata
+    por fuente y clave primaria para que las páginas no se solapen entre consultas.
+    """
+    criterios = []
+    for criterio in orden or []:
+        columna = criterio['column_id']
+        if columna not in COLUMNAS_TABLA_DETALLADA:
+            continue
+        expresion = f'"{columna}"' if columna == 'FECHA' else f'"{columna}" COLLATE "C"'
+        criterios.append(f"{expresion} {'ASC' if criterio['direction'] == 'asc' else 'DESC'} NULLS LAST")
+    return ', '.join(criterios + ['"CODIGO_FUENTE"', '"ID"'])
+
+def consultar_tabla_detallada(detalle, filtro, orden):
+    """
+    Filas de la tabla detallada con los filtros y el orden de la tabla. Los comentarios solo
+    se buscan para todas las filas si se filtra u ordena por ellos.
+    """
+    if 'COMENTARIOS' in (filtro or '') or any(criterio['column_id'] == 'COMENTARIOS' for criterio in (orden or [])):
+        detalle = detalle.assign(COMENTARIOS=comentarios_detalle(detalle))
+    return ordenar_tabla_detallada(filtrar_tabla_detallada(detalle, filtro), orden)
+
+def contar_tabla_detallada(detalle, filtro):
+    """
+    Cantidad de filas de la tabla detallada que pasan los filtros de la tabla
+    """
+    if MODO_CONSULTA == 'sql':
+        return contar_tabla_detallada_bd(detalle, filtro)
+    return len(consultar_tabla_detallada(detalle, filtro, None))
+
+def pagina_tabla_detallada(detalle, pagina, filtro, orden):
+    """
+    Página visible de la tabla detallada (con sus comentarios) y la cantidad de páginas.
+    El tamaño de la respuesta no depende de cuántos eventos coinciden.
+    """
+    if MODO_CONSULTA == 'sql':
+        return pagina_tabla_detallada_bd(detalle, pagina, filtro, orden)
+    filas = consultar_tabla_detallada(detalle, filtro, orden)
+    paginas = max(1, math.ceil(len(filas) / TAMAÑO_PAGINA_DETALLE))
+    pagina = min(pagina or 0, paginas - 1)
+    visibles = filas.iloc[pagina * TAMAÑO_PAGINA_DETALLE:(pagina + 1) * TAMAÑO_PAGINA_DETALLE]
+    if 'COMENTARIOS' not in visibles.columns:
+        visibles = visibles.assign(COMENTARIOS=comentarios_detalle(visibles))
+    return visibles[COLUMNAS_TABLA_DETALLADA].to_dict('records'), paginas, pagina
 
 # Agregar nuevo callback para el switch de análisis avanzados
 @app.callback(
@@ -1792,9 +4510,69 @@ app.index_string = '''
 </html>
 '''
 
+# Layout principal
+def servir_layout():
+    """
+    Arma el layout sin esperar a los datos: el mapa llega vacío y su figura completa se envía
+    al publicar la versión de los datos; después los callbacks solo envían actualizaciones parciales
+    """
+    grafico_mapa.figure = crear_mapa_cargando()
+    return html.Div([sidebar, content])
+
+app.layout = servir_layout
+
+try:
+    from gunicorn.app.base import BaseApplication
+    GUNICORN_DISPONIBLE = True
+except ImportError:
+    GUNICORN_DISPONIBLE = False
+
+def servir_produccion():
+    """
+    Carga los datos en el proceso principal y sirve la aplicación con gunicorn: PROCESOS_TRABAJO
+    procesos de HILOS_POR_PROCESO hilos cada uno. El proceso principal hace las actualizaciones
+    periódicas y los procesos de trabajo recargan lo que publica (ver seguir_publicaciones).
+    """
+    if not GUNICORN_DISPONIBLE:
+        print("gunicorn no está instalado (no funciona en Windows); se usa el servidor de desarrollo")
+        iniciar_carga_datos()
+        app.run_server(debug=False, host=HOST_SERVIDOR, port=PUERTO_SERVIDOR, threaded=True)
+        return
+
+    global ALMACEN_ACTIVO
+    ALMACEN_ACTIVO = SNAPSHOT_DISPONIBLE
+    # Los procesos de trabajo se bifurcan con los datos ya cargados
+    cargar_datos_con_reintentos()
+    # Los objetos ya cargados no se vuelven a recorrer en las recolecciones de basura,
+    # que de otro modo tocarían sus páginas y las copiarían en cada proceso de trabajo
+    gc.freeze()
+    threading.Thread(target=ciclo_actualizacion, name='actualizacion-datos', daemon=True).start()
+
+    class ServidorProduccion(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{HOST_SERVIDOR}:{PUERTO_SERVIDOR}")
+            self.cfg.set('workers', PROCESOS_TRABAJO)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', HILOS_POR_PROCESO)
+            self.cfg.set('timeout', 120)
+            self.cfg.set('post_fork', lambda servidor, proceso: iniciar_proceso_trabajo())
+
+        def load(self):
+            return app.server
+
+    print(f"Sirviendo en http://{HOST_SERVIDOR}:{PUERTO_SERVIDOR} con {PROCESOS_TRABAJO} procesos "
+          f"de {HILOS_POR_PROCESO} hilos")
+    ServidorProduccion().run()
+
+# En desarrollo el servidor arranca sin esperar a la base de datos
+if MODO_SERVIDOR != 'produccion':
+    iniciar_carga_datos()
+
 # Ejecutar la aplicación
 if __name__ == '__main__':
-    if not is_port_in_use(8050):
-        app.run_server(debug=False, host='127.0.0.1', port=8050)
+    if is_port_in_use(PUERTO_SERVIDOR):
+        print(f"La aplicación ya está corriendo en el puerto {PUERTO_SERVIDOR}")
+    elif MODO_SERVIDOR == 'produccion':
+        servir_produccion()
     else:
-        print("La aplicación ya está corriendo en el puerto 8050")
\ No newline at end of file
+        app.run_server(debug=False, host=HOST_SERVIDOR, port=PUERTO_SERVIDOR)
\ No newline at end of file
@@ -38,6 +38,9 @@ echo Instalando numpy...
 echo.
 echo Instalando shapely...
 "%~dp0python\python.exe" -m pip install shapely
+echo.
+echo Instalando pyarrow...
+"%~dp0python\python.exe" -m pip install pyarrow
 
 del get-pip.py
 